@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 
-import platform
+import sys
+import errno as _errno
+import functools as _functools
 
 __version__ = '0.4.1'
 
 # Note: names are added to __all__ depending on what system we're on
 __all__ = []
 
-if platform.system() == 'Windows':
+if sys.platform == 'win32':
     from wrwlock import RWLockWindows as RWLock
 else:
     from . import prwlock as _prwlock
@@ -28,44 +30,292 @@ else:
     __all__.append('set_pthread_process_shared')
     __all__.append('get_pthread_process_shared')
 
-    if platform.system() == 'Darwin':
+    if sys.platform == 'darwin':
         RWLock = _prwlock.RWLockOSX
+        RWLockArena = _prwlock.RWLockArenaOSX
     else:
         # Uses the default posix implementation
         RWLock = _prwlock.RWLockPosix
+        RWLockArena = _prwlock.RWLockArena
+
+    __all__.append('RWLockArena')
+
+    # Values for the policy argument of RWLock
+    PREFER_READER = _prwlock.PREFER_READER
+    PREFER_WRITER = _prwlock.PREFER_WRITER
+    FAIR = _prwlock.FAIR
+    __all__.extend(['PREFER_READER', 'PREFER_WRITER', 'FAIR'])
+
+    # Raised when a robust lock is reclaimed from a dead writer
+    OwnerDeadError = _prwlock.OwnerDeadError
+    __all__.append('OwnerDeadError')
+
+    if sys.platform.startswith('linux'):
+        from . import frwlock as _frwlock
+        if _frwlock.available:
+            RWLockFutex = _frwlock.RWLockFutex
+            __all__.append('RWLockFutex')
+        from . import brlock as _brlock
+        if _brlock.available:
+            BigReaderLock = _brlock.BigReaderLock
+            __all__.append('BigReaderLock')
+
+# Error of acquisitions that reclaimed a robust lock from a dead writer
+_EOWNERDEAD = getattr(_errno, 'EOWNERDEAD', 130)
 
 # Monkey patch resolved RWLock class to implement __enter__ and __exit__
 class GenericLockContextManager(object):
-    def __init__(self, lock, method, timeout=None):
+    def __init__(self, lock, method, timeout=None, hooks=None):
         self.lock = lock
         self.locked = False
         self.method = method
         self.timeout = timeout
-        if method not in ['read', 'write']:
+        self.hooks = hooks
+        self.acquired_at = None
+        if method not in ['read', 'write', 'upgradeable']:
             raise ValueError('GenericLock called with invalid method %s'
                              % self.method)
 
     def __enter__(self):
         locker = getattr(self.lock, 'acquire_' + self.method)
-        self.locked = locker(timeout=self.timeout)
+        try:
+            if self.hooks is None or not self.hooks.sampled():
+                self.locked = locker(timeout=self.timeout)
+            else:
+                start = self.hooks.wait_start(self.lock, self.method)
+                self.locked = locker(timeout=self.timeout)
+                if self.locked:
+                    self.acquired_at = self.hooks.acquired(
+                        self.lock, self.method, start)
+        except OSError as e:
+            if e.errno == _EOWNERDEAD:
+                # A robust lock was acquired, but the with block won't run,
+                # so nobody would release it
+                self.lock.release()
+            raise
         if not self.locked:
             # We have to return from the __enter__ method, but we failed to
             # acquire the lock. The only thing we can do is to fail
             raise ValueError('Unable to acquire lock in context manager')
+        # The data region of locks that have one, read-only unless written
+        buffer = getattr(self.lock, 'buffer', None)
+        if buffer is not None and self.method != 'write':
+            buffer = self.lock._readonly_buffer
+        return buffer
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         if self.locked:
             self.lock.release()
+            if self.acquired_at is not None:
+                self.hooks.released(self.lock, self.acquired_at)
         self.locked = False
+        self.acquired_at = None
+
+class UpgradeContextManager(object):
+    """Upgrades an upgradeable lock for the duration of a with block"""
+    def __init__(self, lock, timeout=None):
+        self.lock = lock
+        self.timeout = timeout
+
+    def __enter__(self):
+        if not self.lock.upgrade(timeout=self.timeout):
+            raise ValueError('Unable to upgrade lock in context manager')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.downgrade()
 
-def reader_lock(self, timeout=None):
-    return GenericLockContextManager(self, 'read', timeout=timeout)
+class ReaderContextManager(object):
+    """Takes a lock in read mode for the duration of a with block.
 
-def writer_lock(self, timeout=None):
-    return GenericLockContextManager(self, 'write', timeout=timeout)
+    Unlike GenericLockContextManager, it keeps no state between __enter__
+    and __exit__, so a single instance per lock, created by the first call
+    to reader_lock() without arguments, serves every with block, nested
+    ones and those of other threads included. Locks served by the compiled
+    core use an equivalent compiled context manager instead.
+    """
+    __slots__ = ('lock', 'view')
+
+    def __init__(self, lock, view=None):
+        # The lock caches us, but temporary locks, as in
+        # ``with RWLock().reader_lock():``, must outlive the call
+        self.lock = lock
+        self.view = view
+
+    def __enter__(self):
+        lock = self.lock
+        try:
+            acquired = lock.acquire_read()
+        except OSError as e:
+            if e.errno == _EOWNERDEAD:
+                lock.release()
+            raise
+        if not acquired:
+            raise ValueError('Unable to acquire lock in context manager')
+        return self.view
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+
+class WriterContextManager(ReaderContextManager):
+    """Takes a lock in write mode for the duration of a with block, see
+    ReaderContextManager"""
+    __slots__ = ()
+
+    def __enter__(self):
+        lock = self.lock
+        try:
+            acquired = lock.acquire_write()
+        except OSError as e:
+            if e.errno == _EOWNERDEAD:
+                lock.release()
+            raise
+        if not acquired:
+            raise ValueError('Unable to acquire lock in context manager')
+        return self.view
+
+
+def _context_manager(lock, write):
+    # Returns the context manager cached by reader_lock() or writer_lock()
+    view = getattr(lock, 'buffer', None)
+    if view is not None and not write:
+        view = lock._readonly_buffer
+    compiled = getattr(lock, '_context', None)
+    if compiled is not None:
+        manager = compiled(write, view)
+        if manager is not None:
+            return manager
+    if write:
+        return WriterContextManager(lock, view)
+    return ReaderContextManager(lock, view)
+
+def reader_lock(self, timeout=None, hooks=None):
+    if timeout is None and hooks is None:
+        try:
+            return self._reader_context
+        except AttributeError:
+            self._reader_context = _context_manager(self, False)
+            return self._reader_context
+    return GenericLockContextManager(self, 'read', timeout=timeout,
+                                     hooks=hooks)
+
+def writer_lock(self, timeout=None, hooks=None):
+    if timeout is None and hooks is None:
+        try:
+            return self._writer_context
+        except AttributeError:
+            self._writer_context = _context_manager(self, True)
+            return self._writer_context
+    return GenericLockContextManager(self, 'write', timeout=timeout,
+                                     hooks=hooks)
+
+
+def _decorator(context, function, timeout):
+    # Wraps *function* so that it runs within the context manager returned
+    # by *context* (a bound reader_lock or writer_lock)
+    if function is None:
+        return _functools.partial(_decorator, context, timeout=timeout)
+    if timeout is None:
+        # The context manager is looked up on every call, since installing
+        # hooks replaces it
+        @_functools.wraps(function)
+        def locked(*args, **kwargs):
+            with context():
+                return function(*args, **kwargs)
+    else:
+        @_functools.wraps(function)
+        def locked(*args, **kwargs):
+            with context(timeout=timeout):
+                return function(*args, **kwargs)
+    locked.lock = context.__self__
+    return locked
+
+def reads(self, function=None, timeout=None):
+    """Decorator running the decorated function with the lock held in read
+    mode, used as @rwlock.reads or @rwlock.reads(timeout=seconds)"""
+    return _decorator(self.reader_lock, function, timeout)
+
+def writes(self, function=None, timeout=None):
+    """Decorator running the decorated function with the lock held in write
+    mode, used as @rwlock.writes or @rwlock.writes(timeout=seconds)"""
+    return _decorator(self.writer_lock, function, timeout)
+
+
+def upgradeable_lock(self, timeout=None, hooks=None):
+    return GenericLockContextManager(self, 'upgradeable', timeout=timeout,
+                                     hooks=hooks)
+
+def upgraded_lock(self, timeout=None):
+    return UpgradeContextManager(self, timeout=timeout)
 
 
 RWLock.reader_lock = reader_lock
 RWLock.writer_lock = writer_lock
+RWLock.reads = reads
+RWLock.writes = writes
+if hasattr(RWLock, 'acquire_upgradeable'):
+    RWLock.upgradeable_lock = upgradeable_lock
+    RWLock.upgraded_lock = upgraded_lock
+
+if 'RWLockArena' in __all__:
+    _prwlock.RWLockHandle.reader_lock = reader_lock
+    _prwlock.RWLockHandle.writer_lock = writer_lock
+    _prwlock.RWLockHandle.reads = reads
+    _prwlock.RWLockHandle.writes = writes
+
+    from .locktable import LockTable
+    __all__.append('LockTable')
+
+if 'RWLockFutex' in __all__:
+    RWLockFutex.reader_lock = reader_lock
+    RWLockFutex.writer_lock = writer_lock
+    RWLockFutex.reads = reads
+    RWLockFutex.writes = writes
+
+if 'BigReaderLock' in __all__:
+    BigReaderLock.reader_lock = reader_lock
+    BigReaderLock.writer_lock = writer_lock
+    BigReaderLock.reads = reads
+    BigReaderLock.writes = writes
 
 __all__.append('RWLock')
+
+if 'RWLockArena' in __all__:
+    from .seqlock import SeqLock
+    __all__.append('SeqLock')
+
+from .hooks import LockHooks
+__all__.append('LockHooks')
+
+from .multilock import acquire_all
+__all__.append('acquire_all')
+
+from .workers import install_locks, installed_lock
+__all__.extend(['install_locks', 'installed_lock'])
+
+from .hybridrwlock import HybridRWLock
+HybridRWLock.reader_lock = reader_lock
+HybridRWLock.writer_lock = writer_lock
+HybridRWLock.reads = reads
+HybridRWLock.writes = writes
+__all__.append('HybridRWLock')
+
+if sys.version_info >= (3, 7):
+    # Coroutines are a syntax error on older Pythons. asyncio (and socket,
+    # for the lock server) take longer to import than everything else, so
+    # they're only imported once used (PEP 562).
+    def __getattr__(name):
+        if name == 'AsyncRWLock':
+            from .asyncrwlock import AsyncRWLock
+            globals()['AsyncRWLock'] = AsyncRWLock
+            return AsyncRWLock
+        if name in ('LockServer', 'RemoteRWLock'):
+            from . import server
+            globals()[name] = getattr(server, name)
+            return globals()[name]
+        raise AttributeError('module {!r} has no attribute {!r}'.format(
+            __name__, name))
+    __all__.append('AsyncRWLock')
+else:
+    from .server import LockServer, RemoteRWLock
+__all__.extend(['LockServer', 'RemoteRWLock'])
@@ -0,0 +1,1717 @@
+/*
+ * Optional accelerator for prwlock.
+ *
+ * RWLockCore implements the lock operations of RWLockPosix natively, over a
+ * pthread_rwlock_t that was already laid out and initialized by the Python
+ * code. That way the layout of the shared memory is the same whether the
+ * accelerator is available or not, and processes using either path can
+ * share locks.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include "structmember.h"
+#include "pythread.h"
+
+#include <errno.h>
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+#include <pthread.h>
+#include <sched.h>
+
+#ifndef __APPLE__
+#define HAVE_TIMEDLOCK 1
+#endif
+
+/* pthread_rwlock_clock{rd,wr}lock, which take deadlines on any clock */
+#if defined(__GLIBC__) && defined(__GLIBC_PREREQ)
+#if __GLIBC_PREREQ(2, 30)
+#define HAVE_CLOCKLOCK 1
+#endif
+#endif
+
+/* Clock the deadlines of timed acquisitions are measured against. Without
+ * timed locks the deadline is only checked by our own polling loop. */
+#if defined(HAVE_CLOCKLOCK) || !defined(HAVE_TIMEDLOCK)
+#define LOCK_CLOCK CLOCK_MONOTONIC
+#else
+#define LOCK_CLOCK CLOCK_REALTIME
+#endif
+
+/* Names timed acquisition errors are reported under, as in prwlock.py */
+#ifdef HAVE_CLOCKLOCK
+#define TIMED_RDLOCK_NAME "pthread_rwlock_clockrdlock"
+#define TIMED_WRLOCK_NAME "pthread_rwlock_clockwrlock"
+#else
+#define TIMED_RDLOCK_NAME "pthread_rwlock_timedrdlock"
+#define TIMED_WRLOCK_NAME "pthread_rwlock_timedwrlock"
+#endif
+
+/* Same as SPIN_TRIES, YIELD_TRIES, MIN_BACKOFF and MAX_BACKOFF in
+ * prwlock.py, for the polling loop of systems without timed locks */
+#define SPIN_TRIES 64
+#define YIELD_TRIES 16
+#define MIN_BACKOFF_NS 10000L
+#define MAX_BACKOFF_NS 1000000L
+
+/* Contention statistics, same layout as lock_stats_t in prwlock.py */
+#define STATS_BUCKETS 32
+typedef struct {
+    uint64_t reads;
+    uint64_t writes;
+    uint64_t contended;
+    uint64_t timeouts;
+    uint64_t wait_ns;
+    uint64_t wait_max_ns;
+    uint64_t hold_ns;
+    uint64_t hold_max_ns;
+    uint64_t wait_histogram[STATS_BUCKETS];
+} lock_stats_t;
+
+/* Spinning state of adaptive locks, same layout as lock_spin_t in
+ * prwlock.py, and the bounds of the time spent spinning */
+typedef struct {
+    uint32_t budget_ns;
+    uint32_t reserved;
+    uint64_t spins;
+    uint64_t spin_acquired;
+} lock_spin_t;
+
+#define MIN_SPIN_NS 1000
+#define MAX_SPIN_NS 50000
+
+typedef struct {
+    PyObject_HEAD
+    /* The (ctypes) object whose memory holds the lock. Keeping a reference
+     * to it keeps the underlying mapping alive. */
+    PyObject *owner;
+    pthread_rwlock_t *lock;
+    /* Optional lock every acquirer goes through first, see RWLockPosix */
+    PyObject *turnstile_owner;
+    pthread_rwlock_t *turnstile;
+    /* Optional statistics, updated by every process using the lock */
+    PyObject *stats_owner;
+    lock_stats_t *stats;
+    uint64_t hold_start;
+    /* Optional lock writers and upgradeable readers hold exclusively, how
+     * this process holds it, see HOLD_* in prwlock.py, and the value of
+     * nlocks once the acquisition that took it was accounted for */
+    PyObject *upgrade_owner;
+    pthread_rwlock_t *upgrade;
+    int mode;
+    Py_ssize_t mode_depth;
+    /* Optional spinning state of adaptive locks, and when this process
+     * took the lock, for learning how long it is held */
+    PyObject *spin_owner;
+    lock_spin_t *spin;
+    uint64_t spin_since;
+    Py_ssize_t nlocks;
+} RWLockCore;
+
+#define HOLD_WRITE 3
+
+static PyObject *
+raise_error(int error, const char *name)
+{
+    /* Mimic the exceptions raised by default_error_check */
+    PyObject *exc = PyObject_CallFunction(PyExc_OSError, "iN", error,
+                                          PyUnicode_FromFormat(
+                                              "%s failed %s", name,
+                                              strerror(error)));
+    if (exc != NULL) {
+        PyErr_SetObject(PyExc_OSError, exc);
+        Py_DECREF(exc);
+    }
+    return NULL;
+}
+
+/* Points *memory* to the at least *size* bytes in the buffer of *owner* */
+static int
+get_memory(PyObject *owner, void **memory, size_t size, const char *what)
+{
+    Py_buffer view;
+
+    if (PyObject_GetBuffer(owner, &view, PyBUF_SIMPLE) < 0)
+        return -1;
+    if ((size_t) view.len < size) {
+        PyBuffer_Release(&view);
+        PyErr_Format(PyExc_ValueError, "%s buffer has %zd bytes, needs %zu",
+                     what, view.len, size);
+        return -1;
+    }
+    /* The pointer stays valid for as long as the owner is alive */
+    *memory = view.buf;
+    PyBuffer_Release(&view);
+    return 0;
+}
+
+/* Points *lock* to the pthread_rwlock_t in the memory of *owner* */
+static int
+get_rwlock(PyObject *owner, pthread_rwlock_t **lock)
+{
+    return get_memory(owner, (void **) lock, sizeof(pthread_rwlock_t),
+                      "lock");
+}
+
+static uint64_t
+now_ns(void)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    return (uint64_t) now.tv_sec * 1000000000ULL + now.tv_nsec;
+}
+
+static void
+stats_max(uint64_t *field, uint64_t value)
+{
+    uint64_t current = __atomic_load_n(field, __ATOMIC_RELAXED);
+
+    while (value > current && !__atomic_compare_exchange_n(
+               field, &current, value, 1, __ATOMIC_RELAXED, __ATOMIC_RELAXED))
+        ;
+}
+
+#define STATS_ADD(field, value) \
+    __atomic_fetch_add(&(field), (value), __ATOMIC_RELAXED)
+
+/* Accounts for an acquisition that waited *wait* nanoseconds */
+static void
+stats_acquired(RWLockCore *self, int write, int contended, uint64_t wait)
+{
+    lock_stats_t *stats = self->stats;
+    uint64_t us = wait / 1000;
+    int bucket = 0;
+
+    /* Bucket 0 holds waits under 1us, bucket i waits in [2^(i-1), 2^i)us */
+    while (us && bucket < STATS_BUCKETS - 1) {
+        us >>= 1;
+        bucket++;
+    }
+    if (write)
+        STATS_ADD(stats->writes, 1);
+    else
+        STATS_ADD(stats->reads, 1);
+    if (contended)
+        STATS_ADD(stats->contended, 1);
+    STATS_ADD(stats->wait_ns, wait);
+    stats_max(&stats->wait_max_ns, wait);
+    STATS_ADD(stats->wait_histogram[bucket], 1);
+    if (self->nlocks == 0)
+        self->hold_start = now_ns();
+}
+
+static int
+RWLockCore_init(RWLockCore *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"lock", "turnstile", "stats", "upgrade", "spin",
+                             NULL};
+    PyObject *owner, *turnstile_owner = Py_None, *stats_owner = Py_None;
+    PyObject *upgrade_owner = Py_None, *spin_owner = Py_None;
+    pthread_rwlock_t *lock, *turnstile = NULL, *upgrade = NULL;
+    lock_stats_t *stats = NULL;
+    lock_spin_t *spin = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOOO", kwlist, &owner,
+                                     &turnstile_owner, &stats_owner,
+                                     &upgrade_owner, &spin_owner))
+        return -1;
+    if (get_rwlock(owner, &lock) < 0)
+        return -1;
+    if (turnstile_owner != Py_None && get_rwlock(turnstile_owner,
+                                                 &turnstile) < 0)
+        return -1;
+    if (stats_owner != Py_None && get_memory(stats_owner, (void **) &stats,
+                                             sizeof(lock_stats_t),
+                                             "stats") < 0)
+        return -1;
+    if (upgrade_owner != Py_None && get_rwlock(upgrade_owner, &upgrade) < 0)
+        return -1;
+    if (spin_owner != Py_None && get_memory(spin_owner, (void **) &spin,
+                                            sizeof(lock_spin_t),
+                                            "spin") < 0)
+        return -1;
+
+    self->lock = lock;
+    self->turnstile = turnstile;
+    self->stats = stats;
+    self->upgrade = upgrade;
+    self->spin = spin;
+    self->mode = 0;
+    Py_INCREF(owner);
+    Py_XSETREF(self->owner, owner);
+    Py_INCREF(turnstile_owner);
+    Py_XSETREF(self->turnstile_owner, turnstile_owner);
+    Py_INCREF(stats_owner);
+    Py_XSETREF(self->stats_owner, stats_owner);
+    Py_INCREF(upgrade_owner);
+    Py_XSETREF(self->upgrade_owner, upgrade_owner);
+    Py_INCREF(spin_owner);
+    Py_XSETREF(self->spin_owner, spin_owner);
+    self->nlocks = 0;
+    return 0;
+}
+
+static void
+RWLockCore_dealloc(RWLockCore *self)
+{
+    Py_XDECREF(self->owner);
+    Py_XDECREF(self->turnstile_owner);
+    Py_XDECREF(self->stats_owner);
+    Py_XDECREF(self->upgrade_owner);
+    Py_XDECREF(self->spin_owner);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+#define CHECK_BOUND(self)                                               \
+    if ((self)->lock == NULL) {                                         \
+        PyErr_SetString(PyExc_ValueError, "RWLockCore is not bound");   \
+        return NULL;                                                    \
+    }
+
+/* Fills *ts* with the absolute deadline *timeout* seconds from now */
+static void
+deadline(double timeout, struct timespec *ts)
+{
+    time_t seconds = (time_t) timeout;
+
+    clock_gettime(LOCK_CLOCK, ts);
+    ts->tv_sec += seconds;
+    ts->tv_nsec += (long) ((timeout - seconds) * 1e9);
+    if (ts->tv_nsec >= 1000000000L) {
+        ts->tv_sec += 1;
+        ts->tv_nsec -= 1000000000L;
+    } else if (ts->tv_nsec < 0) {
+        ts->tv_sec -= 1;
+        ts->tv_nsec += 1000000000L;
+    }
+}
+
+/*
+ * Locks *lock* for reading or writing. When *ts* isn't NULL, gives up with
+ * ETIMEDOUT once that (LOCK_CLOCK) deadline passes. Must be called without
+ * holding the GIL, since it may block.
+ */
+static int
+lock_until(pthread_rwlock_t *lock, int write, const struct timespec *ts)
+{
+    if (ts == NULL)
+        return write ? pthread_rwlock_wrlock(lock)
+                     : pthread_rwlock_rdlock(lock);
+#if defined(HAVE_CLOCKLOCK)
+    return write ? pthread_rwlock_clockwrlock(lock, LOCK_CLOCK, ts)
+                 : pthread_rwlock_clockrdlock(lock, LOCK_CLOCK, ts);
+#elif defined(HAVE_TIMEDLOCK)
+    return write ? pthread_rwlock_timedwrlock(lock, ts)
+                 : pthread_rwlock_timedrdlock(lock, ts);
+#else
+    {
+        /* Spin, then yield, then sleep for exponentially longer periods */
+        struct timespec nap = {0, MIN_BACKOFF_NS}, now;
+        long remaining;
+        int attempt, result;
+
+        for (attempt = 1;; attempt++) {
+            result = write ? pthread_rwlock_trywrlock(lock)
+                           : pthread_rwlock_tryrdlock(lock);
+            if (result != EBUSY && result != EAGAIN)
+                return result;
+            clock_gettime(LOCK_CLOCK, &now);
+            if (now.tv_sec > ts->tv_sec || (now.tv_sec == ts->tv_sec
+                                            && now.tv_nsec >= ts->tv_nsec))
+                return ETIMEDOUT;
+            if (attempt < SPIN_TRIES)
+                continue;
+            if (attempt < SPIN_TRIES + YIELD_TRIES) {
+                sched_yield();
+                continue;
+            }
+            /* Don't sleep past the deadline */
+            remaining = ts->tv_sec - now.tv_sec > 1 ? 1000000000L
+                : (ts->tv_sec - now.tv_sec) * 1000000000L
+                  + ts->tv_nsec - now.tv_nsec;
+            if (nap.tv_nsec > remaining) {
+                struct timespec last = {0, remaining};
+                nanosleep(&last, NULL);
+            } else {
+                nanosleep(&nap, NULL);
+                nap.tv_nsec = nap.tv_nsec * 2 > MAX_BACKOFF_NS
+                              ? MAX_BACKOFF_NS : nap.tv_nsec * 2;
+            }
+        }
+    }
+#endif
+}
+
+/* Same as lock_until, but going through the turnstile, if any */
+static int
+turnstile_lock_until(RWLockCore *self, int write, const struct timespec *ts)
+{
+    int result;
+
+    if (self->turnstile == NULL)
+        return lock_until(self->lock, write, ts);
+    /* Holding the turnstile keeps new readers out, so a writer waiting for
+     * the lock can't be starved. Readers just pass through it. */
+    result = lock_until(self->turnstile, 1, ts);
+    if (result != 0)
+        return result;
+    if (!write)
+        pthread_rwlock_unlock(self->turnstile);
+    result = lock_until(self->lock, write, ts);
+    if (write)
+        pthread_rwlock_unlock(self->turnstile);
+    return result;
+}
+
+static int
+turnstile_trylock(RWLockCore *self, int write)
+{
+    int result;
+
+    if (self->turnstile != NULL && pthread_rwlock_trywrlock(self->turnstile))
+        return EBUSY;
+    result = write ? pthread_rwlock_trywrlock(self->lock)
+                   : pthread_rwlock_tryrdlock(self->lock);
+    if (self->turnstile != NULL)
+        pthread_rwlock_unlock(self->turnstile);
+    return result;
+}
+
+/* Writers of upgradeable locks take the upgrade lock first, which keeps
+ * them out while an upgradeable reader holds it */
+
+static int
+exclusive_lock_until(RWLockCore *self, int write, const struct timespec *ts)
+{
+    int result;
+
+    if (!write || self->upgrade == NULL)
+        return turnstile_lock_until(self, write, ts);
+    result = lock_until(self->upgrade, 1, ts);
+    if (result != 0)
+        return result;
+    result = turnstile_lock_until(self, write, ts);
+    if (result != 0)
+        pthread_rwlock_unlock(self->upgrade);
+    return result;
+}
+
+static int
+exclusive_trylock(RWLockCore *self, int write)
+{
+    int result;
+
+    if (!write || self->upgrade == NULL)
+        return turnstile_trylock(self, write);
+    if (pthread_rwlock_trywrlock(self->upgrade))
+        return EBUSY;
+    result = turnstile_trylock(self, write);
+    if (result != 0)
+        pthread_rwlock_unlock(self->upgrade);
+    return result;
+}
+
+/* Moves the spin budget of an adaptive lock towards *sample*, a hold or
+ * wait time. Times too long to be worth spinning for pull it towards 0.
+ * Updates from several processes may race, in which case some samples are
+ * just lost. */
+static void
+spin_learn(lock_spin_t *spin, uint64_t sample)
+{
+    int64_t budget = __atomic_load_n(&spin->budget_ns, __ATOMIC_RELAXED);
+
+    if (sample > MAX_SPIN_NS)
+        sample = 0;
+    budget += ((int64_t) sample - budget) / 8;
+    __atomic_store_n(&spin->budget_ns, (uint32_t) budget, __ATOMIC_RELAXED);
+}
+
+static inline void
+cpu_relax(void)
+{
+#if defined(__x86_64__) || defined(__i386__)
+    __builtin_ia32_pause();
+#elif defined(__aarch64__)
+    __asm__ __volatile__("yield");
+#endif
+}
+
+/* Tries to take the lock of an adaptive lock, and if it's busy, keeps
+ * trying for a while before blocking: for at most *max_ns* nanoseconds and
+ * about as long as its recent holders kept it. Returns 0 if the lock was
+ * acquired. Must be called without holding the GIL. */
+static int
+spin_lock(RWLockCore *self, int write, uint64_t max_ns)
+{
+    lock_spin_t *spin = self->spin;
+    uint64_t limit, start, elapsed;
+    int attempt, result;
+
+    result = exclusive_trylock(self, write);
+    if (result != EBUSY && result != EAGAIN)
+        return result;
+    limit = 2 * (uint64_t) __atomic_load_n(&spin->budget_ns,
+                                           __ATOMIC_RELAXED) + MIN_SPIN_NS;
+    if (limit > MAX_SPIN_NS)
+        limit = MAX_SPIN_NS;
+    if (limit > max_ns)
+        limit = max_ns;
+    STATS_ADD(spin->spins, 1);
+    start = now_ns();
+    for (attempt = 1;; attempt++) {
+        cpu_relax();
+        if (attempt % SPIN_TRIES == 0)
+            sched_yield();
+        result = exclusive_trylock(self, write);
+        elapsed = now_ns() - start;
+        if (result == 0) {
+            STATS_ADD(spin->spin_acquired, 1);
+            spin_learn(spin, elapsed);
+            return 0;
+        }
+        /* Errors are for the blocking path to report */
+        if ((result != EBUSY && result != EAGAIN) || elapsed >= limit)
+            return result;
+    }
+}
+
+/* Accounts for a successful acquisition */
+static void
+acquired(RWLockCore *self, int write)
+{
+    if (self->spin != NULL && self->nlocks == 0)
+        self->spin_since = now_ns();
+    self->nlocks++;
+    if (write && self->upgrade != NULL) {
+        self->mode = HOLD_WRITE;
+        self->mode_depth = self->nlocks;
+    }
+}
+
+/* Acquires the lock, waiting for at most *timeout_obj* seconds unless it
+ * is None */
+static PyObject *
+acquire_until(RWLockCore *self, int write, PyObject *timeout_obj)
+{
+    struct timespec ts, *ts_p = NULL;
+    double timeout;
+    uint64_t start = 0, max_spin_ns = MAX_SPIN_NS;
+    int result;
+
+    CHECK_BOUND(self);
+    if (self->stats != NULL) {
+        /* Telling contended acquisitions apart takes a first attempt that
+         * doesn't wait */
+        if (exclusive_trylock(self, write) == 0) {
+            stats_acquired(self, write, 0, 0);
+            acquired(self, write);
+            Py_RETURN_TRUE;
+        }
+        start = now_ns();
+    }
+    if (timeout_obj != Py_None) {
+        timeout = PyFloat_AsDouble(timeout_obj);
+        if (timeout == -1.0 && PyErr_Occurred())
+            return NULL;
+        deadline(timeout, &ts);
+        ts_p = &ts;
+        if (timeout < MAX_SPIN_NS / 1e9)
+            max_spin_ns = timeout > 0 ? (uint64_t) (timeout * 1e9) : 0;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    result = EBUSY;
+    if (self->spin != NULL && max_spin_ns > 0)
+        result = spin_lock(self, write, max_spin_ns);
+    if (result != 0)
+        result = exclusive_lock_until(self, write, ts_p);
+    Py_END_ALLOW_THREADS
+    if (result == ETIMEDOUT && ts_p != NULL) {
+        if (self->stats != NULL) {
+            STATS_ADD(self->stats->contended, 1);
+            STATS_ADD(self->stats->timeouts, 1);
+        }
+        Py_RETURN_FALSE;
+    }
+    if (result != 0) {
+        if (ts_p != NULL)
+            return raise_error(result, write ? TIMED_WRLOCK_NAME
+                                             : TIMED_RDLOCK_NAME);
+        return raise_error(result, write ? "pthread_rwlock_wrlock"
+                                         : "pthread_rwlock_rdlock");
+    }
+    if (self->stats != NULL)
+        stats_acquired(self, write, 1, now_ns() - start);
+    acquired(self, write);
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+acquire(RWLockCore *self, PyObject *args, PyObject *kwds, int write)
+{
+    static char *kwlist[] = {"timeout", NULL};
+    PyObject *timeout_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O", kwlist, &timeout_obj))
+        return NULL;
+    return acquire_until(self, write, timeout_obj);
+}
+
+PyDoc_STRVAR(acquire_read_doc,
+"acquire_read([timeout=None])\n\n"
+"Request a read lock, returning True if the lock is acquired;\n"
+"False otherwise. If provided, *timeout* specifies the number of\n"
+"seconds to wait for the lock before cancelling and returning False.");
+
+static PyObject *
+RWLockCore_acquire_read(RWLockCore *self, PyObject *args, PyObject *kwds)
+{
+    return acquire(self, args, kwds, 0);
+}
+
+PyDoc_STRVAR(acquire_write_doc,
+"acquire_write([timeout=None])\n\n"
+"Request a write lock, returning True if the lock is acquired;\n"
+"False otherwise. If provided, *timeout* specifies the number of\n"
+"seconds to wait for the lock before cancelling and returning False.");
+
+static PyObject *
+RWLockCore_acquire_write(RWLockCore *self, PyObject *args, PyObject *kwds)
+{
+    return acquire(self, args, kwds, 1);
+}
+
+PyDoc_STRVAR(try_acquire_read_doc,
+"Try to obtain a read lock, immediately returning True if\n"
+"the lock is acquired; False otherwise.");
+
+static PyObject *
+RWLockCore_try_acquire_read(RWLockCore *self, PyObject *unused)
+{
+    CHECK_BOUND(self);
+    /* Non-blocking, so there's no point in releasing the GIL */
+    if (turnstile_trylock(self, 0) == 0) {
+        if (self->stats != NULL)
+            stats_acquired(self, 0, 0, 0);
+        acquired(self, 0);
+        Py_RETURN_TRUE;
+    }
+    if (self->stats != NULL)
+        STATS_ADD(self->stats->contended, 1);
+    Py_RETURN_FALSE;
+}
+
+PyDoc_STRVAR(try_acquire_write_doc,
+"Try to obtain a write lock, returning True immediately if\n"
+"the lock can be acquired; False otherwise.");
+
+static PyObject *
+RWLockCore_try_acquire_write(RWLockCore *self, PyObject *unused)
+{
+    CHECK_BOUND(self);
+    if (exclusive_trylock(self, 1) == 0) {
+        if (self->stats != NULL)
+            stats_acquired(self, 1, 0, 0);
+        acquired(self, 1);
+        Py_RETURN_TRUE;
+    }
+    if (self->stats != NULL)
+        STATS_ADD(self->stats->contended, 1);
+    Py_RETURN_FALSE;
+}
+
+PyDoc_STRVAR(release_doc,
+"Release a previously acquired read/write lock.");
+
+static PyObject *
+RWLockCore_release(RWLockCore *self, PyObject *unused)
+{
+    int result;
+
+    CHECK_BOUND(self);
+    if (self->nlocks == 0) {
+        PyErr_SetString(PyExc_ValueError, "Tried to release a released lock");
+        return NULL;
+    }
+    result = pthread_rwlock_unlock(self->lock);
+    if (result != 0)
+        return raise_error(result, "pthread_rwlock_unlock");
+    self->nlocks--;
+    if (self->mode && self->nlocks < self->mode_depth) {
+        /* Taken along with the lock just released */
+        self->mode = 0;
+        result = pthread_rwlock_unlock(self->upgrade);
+        if (result != 0)
+            return raise_error(result, "pthread_rwlock_unlock");
+    }
+    if (self->stats != NULL && self->nlocks == 0) {
+        uint64_t held = now_ns() - self->hold_start;
+
+        STATS_ADD(self->stats->hold_ns, held);
+        stats_max(&self->stats->hold_max_ns, held);
+    }
+    if (self->spin != NULL && self->nlocks == 0)
+        spin_learn(self->spin, now_ns() - self->spin_since);
+    Py_RETURN_NONE;
+}
+
+PyDoc_STRVAR(unbind_doc,
+"Lets go of the memory of the lock, which can then be unmapped. The\n"
+"core can't be used afterwards.");
+
+static PyObject *
+RWLockCore_unbind(RWLockCore *self, PyObject *unused)
+{
+    self->lock = self->turnstile = self->upgrade = NULL;
+    self->stats = NULL;
+    self->spin = NULL;
+    Py_CLEAR(self->owner);
+    Py_CLEAR(self->turnstile_owner);
+    Py_CLEAR(self->stats_owner);
+    Py_CLEAR(self->upgrade_owner);
+    Py_CLEAR(self->spin_owner);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef RWLockCore_methods[] = {
+    {"acquire_read", (PyCFunction) RWLockCore_acquire_read,
+     METH_VARARGS | METH_KEYWORDS, acquire_read_doc},
+    {"acquire_write", (PyCFunction) RWLockCore_acquire_write,
+     METH_VARARGS | METH_KEYWORDS, acquire_write_doc},
+    {"try_acquire_read", (PyCFunction) RWLockCore_try_acquire_read,
+     METH_NOARGS, try_acquire_read_doc},
+    {"try_acquire_write", (PyCFunction) RWLockCore_try_acquire_write,
+     METH_NOARGS, try_acquire_write_doc},
+    {"release", (PyCFunction) RWLockCore_release,
+     METH_NOARGS, release_doc},
+    {"unbind", (PyCFunction) RWLockCore_unbind,
+     METH_NOARGS, unbind_doc},
+    {NULL}
+};
+
+static PyMemberDef RWLockCore_members[] = {
+    {"mode", T_INT, offsetof(RWLockCore, mode), 0,
+     "How this process holds the upgrade lock, if at all"},
+    {"mode_depth", T_PYSSIZET, offsetof(RWLockCore, mode_depth), 0,
+     "Value of nlocks once the upgrade lock was taken"},
+    {"nlocks", T_PYSSIZET, offsetof(RWLockCore, nlocks), 0,
+     "Number of times this process holds the lock"},
+    {"owner", T_OBJECT, offsetof(RWLockCore, owner), READONLY,
+     "Object whose memory holds the pthread_rwlock_t"},
+    {NULL}
+};
+
+static PyTypeObject RWLockCoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "prwlock._speedups.RWLockCore",
+    .tp_doc = "RWLockCore(lock[, turnstile[, stats[, upgrade[, spin]]]])\n\n"
+              "Native lock operations over the pthread_rwlock_t stored in "
+              "the memory of *lock*, going through the one in *turnstile* "
+              "first, if given. Contention statistics are kept in the "
+              "memory of *stats*, if given. Writers take the lock in "
+              "*upgrade* first, if given. Acquisitions spin for a while "
+              "before blocking, learning for how long in the memory of "
+              "*spin*, if given.",
+    .tp_basicsize = sizeof(RWLockCore),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc) RWLockCore_init,
+    .tp_dealloc = (destructor) RWLockCore_dealloc,
+    .tp_methods = RWLockCore_methods,
+    .tp_members = RWLockCore_members,
+};
+
+/*
+ * RWLockContext is the context manager reader_lock() and writer_lock()
+ * return when the methods of a lock are those of its core: entering and
+ * leaving with blocks then costs about as much as acquire_*() and release()
+ * themselves.
+ */
+typedef struct {
+    PyObject_HEAD
+    RWLockCore *core;
+    /* What __enter__ returns, the data region of the lock or None */
+    PyObject *view;
+    /* The lock caching the context, kept alive for as long as we are */
+    PyObject *lock;
+    int write;
+} RWLockContext;
+
+static int
+RWLockContext_init(RWLockContext *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"core", "write", "view", "lock", NULL};
+    PyObject *core, *view = Py_None, *lock = Py_None;
+    int write = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O!|pOO", kwlist,
+                                     &RWLockCoreType, &core, &write, &view,
+                                     &lock))
+        return -1;
+    Py_INCREF(core);
+    Py_XSETREF(self->core, (RWLockCore *) core);
+    Py_INCREF(view);
+    Py_XSETREF(self->view, view);
+    Py_INCREF(lock);
+    Py_XSETREF(self->lock, lock);
+    self->write = write;
+    return 0;
+}
+
+/* The lock caches its context, hence the support for the cyclic GC */
+static int
+RWLockContext_traverse(RWLockContext *self, visitproc visit, void *arg)
+{
+    Py_VISIT(self->view);
+    Py_VISIT(self->lock);
+    return 0;
+}
+
+static int
+RWLockContext_clear(RWLockContext *self)
+{
+    Py_CLEAR(self->view);
+    Py_CLEAR(self->lock);
+    return 0;
+}
+
+static void
+RWLockContext_dealloc(RWLockContext *self)
+{
+    PyObject_GC_UnTrack(self);
+    Py_XDECREF(self->core);
+    RWLockContext_clear(self);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static PyObject *
+RWLockContext_enter(RWLockContext *self, PyObject *unused)
+{
+    PyObject *result;
+
+    if (self->core == NULL) {
+        PyErr_SetString(PyExc_ValueError, "RWLockContext is not bound");
+        return NULL;
+    }
+    /* Without a timeout, acquisitions either succeed or raise */
+    result = acquire_until(self->core, self->write, Py_None);
+    if (result == NULL)
+        return NULL;
+    Py_DECREF(result);
+    if (self->view == NULL)
+        Py_RETURN_NONE;
+    Py_INCREF(self->view);
+    return self->view;
+}
+
+static PyObject *
+RWLockContext_exit(RWLockContext *self, PyObject *args)
+{
+    if (self->core == NULL) {
+        PyErr_SetString(PyExc_ValueError, "RWLockContext is not bound");
+        return NULL;
+    }
+    return RWLockCore_release(self->core, NULL);
+}
+
+static PyMethodDef RWLockContext_methods[] = {
+    {"__enter__", (PyCFunction) RWLockContext_enter, METH_NOARGS, NULL},
+    {"__exit__", (PyCFunction) RWLockContext_exit, METH_VARARGS, NULL},
+    {NULL}
+};
+
+static PyTypeObject RWLockContextType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "prwlock._speedups.RWLockContext",
+    .tp_doc = "RWLockContext(core[, write[, view[, lock]]])\n\n"
+              "Context manager acquiring *core* in read (or, if *write* is "
+              "true, write) mode, yielding *view*. It keeps *lock*, the "
+              "lock of the core, alive.",
+    .tp_basicsize = sizeof(RWLockContext),
+    .tp_flags = Py_TPFLAGS_DEFAULT | Py_TPFLAGS_HAVE_GC,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc) RWLockContext_init,
+    .tp_dealloc = (destructor) RWLockContext_dealloc,
+    .tp_traverse = (traverseproc) RWLockContext_traverse,
+    .tp_clear = (inquiry) RWLockContext_clear,
+    .tp_methods = RWLockContext_methods,
+};
+
+#ifdef __linux__
+/*
+ * FutexCore implements the lock operations of RWLockFutex. The lock state
+ * is a single 64-bit word, changed with atomic operations only, and a
+ * 32-bit sequence number that waiters sleep on with futex(2). The layout
+ * and the protocol must be kept in sync with frwlock.py.
+ */
+#include <limits.h>
+#include <unistd.h>
+#include <sys/syscall.h>
+#include <linux/futex.h>
+
+#define F_READER        ((uint64_t) 1)
+#define F_READERS       ((uint64_t) 0xffffff)
+#define F_WRITER        ((uint64_t) 1 << 24)
+#define F_READ_WAITER   ((uint64_t) 1 << 32)
+#define F_READ_WAITERS  ((uint64_t) 0xffff << 32)
+#define F_WRITE_WAITER  ((uint64_t) 1 << 48)
+#define F_WRITE_WAITERS ((uint64_t) 0xffff << 48)
+#define F_WAITERS       (F_READ_WAITERS | F_WRITE_WAITERS)
+
+typedef struct {
+    uint64_t state;
+    uint32_t seq;
+} futex_rwlock_t;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *owner;
+    futex_rwlock_t *lock;
+    Py_ssize_t nlocks;
+    /* Identifier of the thread of this process holding the write lock. The
+     * pid tells whether this process is the one holding it, since forked
+     * children inherit the thread identifier. */
+    unsigned long writer;
+    pid_t writer_pid;
+} FutexCore;
+
+/* getpid() is a system call, so the pid is cached and refreshed on fork */
+static pid_t current_pid;
+
+static void
+refresh_pid(void)
+{
+    current_pid = getpid();
+}
+
+static int
+is_writer(FutexCore *self)
+{
+    return self->writer == PyThread_get_thread_ident()
+           && self->writer_pid == current_pid;
+}
+
+static int
+FutexCore_init(FutexCore *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"lock", NULL};
+    PyObject *owner;
+    Py_buffer view;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", kwlist, &owner))
+        return -1;
+    if (PyObject_GetBuffer(owner, &view, PyBUF_SIMPLE) < 0)
+        return -1;
+    if ((size_t) view.len < sizeof(futex_rwlock_t)
+            || ((uintptr_t) view.buf) % sizeof(uint64_t) != 0) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError,
+                        "lock buffer is too small or misaligned");
+        return -1;
+    }
+    self->lock = (futex_rwlock_t *) view.buf;
+    PyBuffer_Release(&view);
+
+    Py_INCREF(owner);
+    Py_XSETREF(self->owner, owner);
+    self->nlocks = 0;
+    self->writer = 0;
+    self->writer_pid = 0;
+    return 0;
+}
+
+static void
+FutexCore_dealloc(FutexCore *self)
+{
+    Py_XDECREF(self->owner);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+static void
+futex_wake_all(futex_rwlock_t *lock)
+{
+    /* Bumping the sequence makes waiters that are about to sleep return */
+    __atomic_fetch_add(&lock->seq, 1, __ATOMIC_SEQ_CST);
+    syscall(SYS_futex, &lock->seq, FUTEX_WAKE, INT_MAX, NULL, NULL, 0);
+}
+
+/*
+ * Takes the lock once the bits in *blocked* are clear, by adding
+ * *increment* to the state. While blocked, the caller is accounted for by
+ * adding *waiter* to the state. Returns 1 if the lock was acquired, 0 if
+ * it wasn't (immediately, when *wait* is zero, or before the deadline).
+ */
+static int
+futex_acquire(futex_rwlock_t *lock, uint64_t blocked, uint64_t increment,
+              uint64_t waiter, int wait, const struct timespec *deadline)
+{
+    uint64_t s = __atomic_load_n(&lock->state, __ATOMIC_SEQ_CST);
+    struct timespec now, remaining;
+    uint32_t seq;
+
+    for (;;) {
+        if (!(s & blocked)) {
+            if (__atomic_compare_exchange_n(&lock->state, &s, s + increment,
+                                            1, __ATOMIC_SEQ_CST,
+                                            __ATOMIC_SEQ_CST))
+                return 1;
+            continue;
+        }
+        if (!wait)
+            return 0;
+        if (deadline != NULL) {
+            clock_gettime(CLOCK_MONOTONIC, &now);
+            remaining.tv_sec = deadline->tv_sec - now.tv_sec;
+            remaining.tv_nsec = deadline->tv_nsec - now.tv_nsec;
+            if (remaining.tv_nsec < 0) {
+                remaining.tv_sec -= 1;
+                remaining.tv_nsec += 1000000000L;
+            }
+            if (remaining.tv_sec < 0)
+                return 0;
+        }
+        if (!__atomic_compare_exchange_n(&lock->state, &s, s + waiter, 1,
+                                         __ATOMIC_SEQ_CST, __ATOMIC_SEQ_CST))
+            continue;
+        seq = __atomic_load_n(&lock->seq, __ATOMIC_SEQ_CST);
+        if (__atomic_load_n(&lock->state, __ATOMIC_SEQ_CST) & blocked) {
+            Py_BEGIN_ALLOW_THREADS
+            syscall(SYS_futex, &lock->seq, FUTEX_WAIT, seq,
+                    deadline != NULL ? &remaining : NULL, NULL, 0);
+            Py_END_ALLOW_THREADS
+        }
+        s = __atomic_sub_fetch(&lock->state, waiter, __ATOMIC_SEQ_CST);
+    }
+}
+
+static PyObject *
+futex_acquire_method(FutexCore *self, PyObject *args, PyObject *kwds,
+                     int write)
+{
+    static char *kwlist[] = {"timeout", NULL};
+    PyObject *timeout_obj = Py_None;
+    struct timespec deadline, *deadline_p = NULL;
+    double timeout;
+    int acquired;
+
+    CHECK_BOUND(self);
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O", kwlist, &timeout_obj))
+        return NULL;
+    if (self->writer != 0 && is_writer(self))
+        return raise_error(EDEADLK, write ? "futex_wrlock" : "futex_rdlock");
+    if (timeout_obj != Py_None) {
+        timeout = PyFloat_AsDouble(timeout_obj);
+        if (timeout == -1.0 && PyErr_Occurred())
+            return NULL;
+        if (timeout < 0.0)
+            timeout = 0.0;
+        clock_gettime(CLOCK_MONOTONIC, &deadline);
+        deadline.tv_sec += (time_t) timeout;
+        deadline.tv_nsec += (long) ((timeout - (time_t) timeout) * 1e9);
+        if (deadline.tv_nsec >= 1000000000L) {
+            deadline.tv_sec += 1;
+            deadline.tv_nsec -= 1000000000L;
+        }
+        deadline_p = &deadline;
+    }
+    if (write)
+        acquired = futex_acquire(self->lock, F_WRITER | F_READERS, F_WRITER,
+                                 F_WRITE_WAITER, 1, deadline_p);
+    else
+        acquired = futex_acquire(self->lock, F_WRITER, F_READER,
+                                 F_READ_WAITER, 1, deadline_p);
+    if (!acquired)
+        Py_RETURN_FALSE;
+    if (write) {
+        self->writer = PyThread_get_thread_ident();
+        self->writer_pid = current_pid;
+    }
+    self->nlocks++;
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+FutexCore_acquire_read(FutexCore *self, PyObject *args, PyObject *kwds)
+{
+    return futex_acquire_method(self, args, kwds, 0);
+}
+
+static PyObject *
+FutexCore_acquire_write(FutexCore *self, PyObject *args, PyObject *kwds)
+{
+    return futex_acquire_method(self, args, kwds, 1);
+}
+
+static PyObject *
+FutexCore_try_acquire_read(FutexCore *self, PyObject *unused)
+{
+    CHECK_BOUND(self);
+    if (!(self->writer != 0 && is_writer(self))
+            && futex_acquire(self->lock, F_WRITER, F_READER, 0, 0, NULL)) {
+        self->nlocks++;
+        Py_RETURN_TRUE;
+    }
+    Py_RETURN_FALSE;
+}
+
+static PyObject *
+FutexCore_try_acquire_write(FutexCore *self, PyObject *unused)
+{
+    CHECK_BOUND(self);
+    if (!(self->writer != 0 && is_writer(self))
+            && futex_acquire(self->lock, F_WRITER | F_READERS, F_WRITER, 0, 0,
+                             NULL)) {
+        self->writer = PyThread_get_thread_ident();
+        self->writer_pid = current_pid;
+        self->nlocks++;
+        Py_RETURN_TRUE;
+    }
+    Py_RETURN_FALSE;
+}
+
+static PyObject *
+FutexCore_release(FutexCore *self, PyObject *unused)
+{
+    uint64_t s;
+
+    CHECK_BOUND(self);
+    if (self->nlocks == 0) {
+        PyErr_SetString(PyExc_ValueError, "Tried to release a released lock");
+        return NULL;
+    }
+    if (self->writer != 0 && self->writer_pid == current_pid) {
+        s = __atomic_sub_fetch(&self->lock->state, F_WRITER,
+                               __ATOMIC_SEQ_CST);
+        self->writer = 0;
+    } else {
+        s = __atomic_sub_fetch(&self->lock->state, F_READER,
+                               __ATOMIC_SEQ_CST);
+    }
+    self->nlocks--;
+    /* Only wake waiters up when one of them can actually make progress */
+    if ((s & F_WAITERS) && !(s & (F_WRITER | F_READERS)))
+        futex_wake_all(self->lock);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef FutexCore_methods[] = {
+    {"acquire_read", (PyCFunction) FutexCore_acquire_read,
+     METH_VARARGS | METH_KEYWORDS, acquire_read_doc},
+    {"acquire_write", (PyCFunction) FutexCore_acquire_write,
+     METH_VARARGS | METH_KEYWORDS, acquire_write_doc},
+    {"try_acquire_read", (PyCFunction) FutexCore_try_acquire_read,
+     METH_NOARGS, try_acquire_read_doc},
+    {"try_acquire_write", (PyCFunction) FutexCore_try_acquire_write,
+     METH_NOARGS, try_acquire_write_doc},
+    {"release", (PyCFunction) FutexCore_release,
+     METH_NOARGS, release_doc},
+    {NULL}
+};
+
+static PyMemberDef FutexCore_members[] = {
+    {"nlocks", T_PYSSIZET, offsetof(FutexCore, nlocks), 0,
+     "Number of times this process holds the lock"},
+    {"writer", T_ULONG, offsetof(FutexCore, writer), READONLY,
+     "Identifier of the thread holding the write lock, or 0"},
+    {"owner", T_OBJECT, offsetof(FutexCore, owner), READONLY,
+     "Object whose memory holds the lock state"},
+    {NULL}
+};
+
+static PyTypeObject FutexCoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "prwlock._speedups.FutexCore",
+    .tp_doc = "FutexCore(lock)\n\n"
+              "Native lock operations over the futex-based lock state "
+              "stored in the memory of *lock*.",
+    .tp_basicsize = sizeof(FutexCore),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc) FutexCore_init,
+    .tp_dealloc = (destructor) FutexCore_dealloc,
+    .tp_methods = FutexCore_methods,
+    .tp_members = FutexCore_members,
+};
+
+/*
+ * BRLockCore implements the lock operations of BigReaderLock. Readers
+ * count themselves in the slot of the CPU they run on, each slot being on
+ * a cache line of its own, so readers on different CPUs don't write to the
+ * same memory. Writers raise the writer word and wait for every slot to
+ * drain. The layout and the protocol must be kept in sync with brlock.py.
+ */
+#define BR_CACHE_LINE 64    /* Same as CACHE_LINE in prwlock.py */
+
+typedef struct {
+    uint32_t writer;        /* 1 while a writer holds or drains the lock */
+    uint32_t waiters;       /* Processes sleeping until writer drops */
+    uint32_t nslots;
+} br_header_t;
+
+typedef struct {
+    PyObject_HEAD
+    PyObject *owner;
+    br_header_t *lock;
+    uint32_t nslots;
+    /* Read locks this object holds, by slot. They are released from the
+     * slots they were taken in, wherever the process runs by then. */
+    Py_ssize_t *reads;
+    Py_ssize_t nreads;
+    Py_ssize_t nlocks;
+    unsigned long writer;
+    pid_t writer_pid;
+    pid_t pid;              /* Of the process the reads were taken in */
+} BRLockCore;
+
+static inline uint64_t *
+br_slot(br_header_t *lock, uint32_t index)
+{
+    return (uint64_t *) ((char *) lock + BR_CACHE_LINE * (index + 1));
+}
+
+static uint32_t
+br_current_slot(uint32_t nslots)
+{
+    int cpu = sched_getcpu();
+
+    if (cpu < 0)
+        cpu = current_pid;
+    return (uint32_t) cpu % nslots;
+}
+
+/* Forked children don't hold the locks of their parent */
+static void
+br_check_fork(BRLockCore *self)
+{
+    if (self->pid != current_pid) {
+        memset(self->reads, 0, self->nslots * sizeof(Py_ssize_t));
+        self->nreads = 0;
+        self->nlocks = 0;
+        self->writer = 0;
+        self->pid = current_pid;
+    }
+}
+
+static int
+br_is_writer(BRLockCore *self)
+{
+    return self->writer != 0 && self->writer == PyThread_get_thread_ident()
+           && self->writer_pid == current_pid;
+}
+
+static int
+BRLockCore_init(BRLockCore *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"lock", NULL};
+    PyObject *owner;
+    Py_buffer view;
+    br_header_t *lock;
+    Py_ssize_t *reads;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O", kwlist, &owner))
+        return -1;
+    if (PyObject_GetBuffer(owner, &view, PyBUF_SIMPLE) < 0)
+        return -1;
+    lock = (br_header_t *) view.buf;
+    if ((size_t) view.len < BR_CACHE_LINE
+            || ((uintptr_t) view.buf) % BR_CACHE_LINE != 0
+            || lock->nslots == 0
+            || (size_t) view.len < (size_t) BR_CACHE_LINE
+                                   * (lock->nslots + 1)) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError,
+                        "lock buffer is too small or misaligned");
+        return -1;
+    }
+    PyBuffer_Release(&view);
+    reads = PyMem_Calloc(lock->nslots, sizeof(Py_ssize_t));
+    if (reads == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+
+    Py_INCREF(owner);
+    Py_XSETREF(self->owner, owner);
+    PyMem_Free(self->reads);
+    self->lock = lock;
+    self->nslots = lock->nslots;
+    self->reads = reads;
+    self->nreads = 0;
+    self->nlocks = 0;
+    self->writer = 0;
+    self->writer_pid = 0;
+    self->pid = current_pid;
+    return 0;
+}
+
+static void
+BRLockCore_dealloc(BRLockCore *self)
+{
+    Py_XDECREF(self->owner);
+    PyMem_Free(self->reads);
+    Py_TYPE(self)->tp_free((PyObject *) self);
+}
+
+/* Fills *remaining* with the time left until *deadline*, returning 0 if it
+ * already passed */
+static int
+br_remaining(const struct timespec *deadline, struct timespec *remaining)
+{
+    struct timespec now;
+
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    remaining->tv_sec = deadline->tv_sec - now.tv_sec;
+    remaining->tv_nsec = deadline->tv_nsec - now.tv_nsec;
+    if (remaining->tv_nsec < 0) {
+        remaining->tv_sec -= 1;
+        remaining->tv_nsec += 1000000000L;
+    }
+    return remaining->tv_sec >= 0;
+}
+
+/* Sleeps until the writer word drops, returning 0 if *deadline* passed
+ * first. Must be called with the GIL. */
+static int
+br_wait_writer(br_header_t *lock, const struct timespec *deadline)
+{
+    struct timespec remaining;
+
+    if (deadline != NULL && !br_remaining(deadline, &remaining))
+        return 0;
+    __atomic_fetch_add(&lock->waiters, 1, __ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&lock->writer, __ATOMIC_SEQ_CST)) {
+        Py_BEGIN_ALLOW_THREADS
+        syscall(SYS_futex, &lock->writer, FUTEX_WAIT, 1,
+                deadline != NULL ? &remaining : NULL, NULL, 0);
+        Py_END_ALLOW_THREADS
+    }
+    __atomic_fetch_sub(&lock->waiters, 1, __ATOMIC_SEQ_CST);
+    return 1;
+}
+
+static void
+br_drop_writer(br_header_t *lock)
+{
+    __atomic_store_n(&lock->writer, 0, __ATOMIC_SEQ_CST);
+    if (__atomic_load_n(&lock->waiters, __ATOMIC_SEQ_CST))
+        syscall(SYS_futex, &lock->writer, FUTEX_WAKE, INT_MAX, NULL, NULL, 0);
+}
+
+/* Counts a reader in the slot of the current CPU, returning the slot, or
+ * -1 if the lock wasn't acquired (immediately, when *wait* is zero, or
+ * before the deadline) */
+static long
+br_read(BRLockCore *self, int wait, const struct timespec *deadline)
+{
+    br_header_t *lock = self->lock;
+    uint32_t index;
+    uint64_t *slot;
+
+    for (;;) {
+        if (!__atomic_load_n(&lock->writer, __ATOMIC_SEQ_CST)) {
+            index = br_current_slot(self->nslots);
+            slot = br_slot(lock, index);
+            __atomic_fetch_add(slot, 1, __ATOMIC_SEQ_CST);
+            /* A writer raising the word meanwhile either sees our count or
+             * is seen by us */
+            if (!__atomic_load_n(&lock->writer, __ATOMIC_SEQ_CST))
+                return index;
+            __atomic_fetch_sub(slot, 1, __ATOMIC_SEQ_CST);
+        }
+        if (!wait || !br_wait_writer(lock, deadline))
+            return -1;
+    }
+}
+
+/* Raises the writer word and waits for the readers to drain, returning 1
+ * if the lock was acquired */
+static int
+br_write(BRLockCore *self, int wait, const struct timespec *deadline)
+{
+    br_header_t *lock = self->lock;
+    struct timespec nap = {0, MIN_BACKOFF_NS}, remaining;
+    uint32_t expected, index;
+    int attempt, drained = 1;
+
+    for (;;) {
+        expected = 0;
+        if (__atomic_compare_exchange_n(&lock->writer, &expected, 1, 0,
+                                        __ATOMIC_SEQ_CST, __ATOMIC_SEQ_CST))
+            break;
+        if (!wait || !br_wait_writer(lock, deadline))
+            return 0;
+    }
+    Py_BEGIN_ALLOW_THREADS
+    for (index = 0; index < self->nslots && drained; index++) {
+        for (attempt = 1;
+             __atomic_load_n(br_slot(lock, index), __ATOMIC_SEQ_CST) != 0;
+             attempt++) {
+            if (!wait || (deadline != NULL
+                          && !br_remaining(deadline, &remaining))) {
+                drained = 0;
+                break;
+            }
+            /* Spin, then yield, then sleep for exponentially longer */
+            if (attempt < SPIN_TRIES) {
+                cpu_relax();
+            } else if (attempt < SPIN_TRIES + YIELD_TRIES) {
+                sched_yield();
+            } else {
+                if (deadline != NULL && remaining.tv_sec == 0
+                        && remaining.tv_nsec < nap.tv_nsec)
+                    nanosleep(&remaining, NULL);
+                else
+                    nanosleep(&nap, NULL);
+                nap.tv_nsec = nap.tv_nsec * 2 > MAX_BACKOFF_NS
+                              ? MAX_BACKOFF_NS : nap.tv_nsec * 2;
+            }
+        }
+    }
+    if (!drained)
+        br_drop_writer(lock);
+    Py_END_ALLOW_THREADS
+    return drained;
+}
+
+static PyObject *
+br_acquire_method(BRLockCore *self, PyObject *args, PyObject *kwds,
+                  int write)
+{
+    static char *kwlist[] = {"timeout", NULL};
+    PyObject *timeout_obj = Py_None;
+    struct timespec deadline, *deadline_p = NULL;
+    double timeout;
+    long index;
+
+    CHECK_BOUND(self);
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O", kwlist, &timeout_obj))
+        return NULL;
+    br_check_fork(self);
+    /* Writers would wait for themselves, readers behind themselves */
+    if (br_is_writer(self) || (write && self->nreads))
+        return raise_error(EDEADLK, write ? "br_wrlock" : "br_rdlock");
+    if (timeout_obj != Py_None) {
+        timeout = PyFloat_AsDouble(timeout_obj);
+        if (timeout == -1.0 && PyErr_Occurred())
+            return NULL;
+        if (timeout < 0.0)
+            timeout = 0.0;
+        clock_gettime(CLOCK_MONOTONIC, &deadline);
+        deadline.tv_sec += (time_t) timeout;
+        deadline.tv_nsec += (long) ((timeout - (time_t) timeout) * 1e9);
+        if (deadline.tv_nsec >= 1000000000L) {
+            deadline.tv_sec += 1;
+            deadline.tv_nsec -= 1000000000L;
+        }
+        deadline_p = &deadline;
+    }
+    if (write) {
+        if (!br_write(self, 1, deadline_p))
+            Py_RETURN_FALSE;
+        self->writer = PyThread_get_thread_ident();
+        self->writer_pid = current_pid;
+    } else {
+        index = br_read(self, 1, deadline_p);
+        if (index < 0)
+            Py_RETURN_FALSE;
+        self->reads[index]++;
+        self->nreads++;
+    }
+    self->nlocks++;
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+BRLockCore_acquire_read(BRLockCore *self, PyObject *args, PyObject *kwds)
+{
+    return br_acquire_method(self, args, kwds, 0);
+}
+
+static PyObject *
+BRLockCore_acquire_write(BRLockCore *self, PyObject *args, PyObject *kwds)
+{
+    return br_acquire_method(self, args, kwds, 1);
+}
+
+static PyObject *
+BRLockCore_try_acquire_read(BRLockCore *self, PyObject *unused)
+{
+    long index;
+
+    CHECK_BOUND(self);
+    br_check_fork(self);
+    if (br_is_writer(self) || (index = br_read(self, 0, NULL)) < 0)
+        Py_RETURN_FALSE;
+    self->reads[index]++;
+    self->nreads++;
+    self->nlocks++;
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+BRLockCore_try_acquire_write(BRLockCore *self, PyObject *unused)
+{
+    CHECK_BOUND(self);
+    br_check_fork(self);
+    if (br_is_writer(self) || self->nreads || !br_write(self, 0, NULL))
+        Py_RETURN_FALSE;
+    self->writer = PyThread_get_thread_ident();
+    self->writer_pid = current_pid;
+    self->nlocks++;
+    Py_RETURN_TRUE;
+}
+
+static PyObject *
+BRLockCore_release(BRLockCore *self, PyObject *unused)
+{
+    uint32_t index;
+
+    CHECK_BOUND(self);
+    br_check_fork(self);
+    if (self->nlocks == 0) {
+        PyErr_SetString(PyExc_ValueError, "Tried to release a released lock");
+        return NULL;
+    }
+    if (self->writer != 0 && self->writer_pid == current_pid) {
+        self->writer = 0;
+        br_drop_writer(self->lock);
+    } else {
+        /* Preferably from the slot of the CPU we're on, which is likely
+         * in our cache already */
+        index = br_current_slot(self->nslots);
+        if (self->reads[index] == 0)
+            for (index = 0; self->reads[index] == 0; index++)
+                ;
+        self->reads[index]--;
+        self->nreads--;
+        __atomic_fetch_sub(br_slot(self->lock, index), 1, __ATOMIC_SEQ_CST);
+    }
+    self->nlocks--;
+    Py_RETURN_NONE;
+}
+
+static PyObject *
+BRLockCore_unbind(BRLockCore *self, PyObject *unused)
+{
+    self->lock = NULL;
+    Py_CLEAR(self->owner);
+    Py_RETURN_NONE;
+}
+
+static PyMethodDef BRLockCore_methods[] = {
+    {"acquire_read", (PyCFunction) BRLockCore_acquire_read,
+     METH_VARARGS | METH_KEYWORDS, acquire_read_doc},
+    {"acquire_write", (PyCFunction) BRLockCore_acquire_write,
+     METH_VARARGS | METH_KEYWORDS, acquire_write_doc},
+    {"try_acquire_read", (PyCFunction) BRLockCore_try_acquire_read,
+     METH_NOARGS, try_acquire_read_doc},
+    {"try_acquire_write", (PyCFunction) BRLockCore_try_acquire_write,
+     METH_NOARGS, try_acquire_write_doc},
+    {"release", (PyCFunction) BRLockCore_release,
+     METH_NOARGS, release_doc},
+    {"unbind", (PyCFunction) BRLockCore_unbind,
+     METH_NOARGS, unbind_doc},
+    {NULL}
+};
+
+static PyMemberDef BRLockCore_members[] = {
+    {"nlocks", T_PYSSIZET, offsetof(BRLockCore, nlocks), 0,
+     "Number of times this process holds the lock"},
+    {"writer", T_ULONG, offsetof(BRLockCore, writer), READONLY,
+     "Identifier of the thread holding the write lock, or 0"},
+    {"owner", T_OBJECT, offsetof(BRLockCore, owner), READONLY,
+     "Object whose memory holds the lock state"},
+    {NULL}
+};
+
+static PyTypeObject BRLockCoreType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "prwlock._speedups.BRLockCore",
+    .tp_doc = "BRLockCore(lock)\n\n"
+              "Native lock operations over the big-reader lock state "
+              "stored in the memory of *lock*.",
+    .tp_basicsize = sizeof(BRLockCore),
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc) BRLockCore_init,
+    .tp_dealloc = (destructor) BRLockCore_dealloc,
+    .tp_methods = BRLockCore_methods,
+    .tp_members = BRLockCore_members,
+};
+#endif /* __linux__ */
+
+/*
+ * Sequence counter of SeqLock. Writers make it odd while they update the
+ * data, readers copy the data out and retry if the counter moved. The
+ * fences are what Python code can't express: they keep the data accesses
+ * between the two counter accesses on weakly ordered CPUs.
+ */
+
+/* Points *seq* to the counter at *offset* in *view*, checking that the
+ * *size* bytes at *data* are in the buffer, too */
+static int
+get_seq(Py_buffer *view, Py_ssize_t offset, Py_ssize_t data,
+        Py_ssize_t size, uint64_t **seq)
+{
+    if (offset < 0 || offset % sizeof(uint64_t)
+            || offset + (Py_ssize_t) sizeof(uint64_t) > view->len
+            || data < 0 || size < 0 || data + size > view->len) {
+        PyErr_SetString(PyExc_ValueError, "seqlock offsets out of range");
+        return -1;
+    }
+    *seq = (uint64_t *) ((char *) view->buf + offset);
+    return 0;
+}
+
+PyDoc_STRVAR(seq_read_doc,
+"seq_read(buffer, seq_offset, offset, size)\n\n"
+"Returns a consistent copy of the *size* bytes at *offset* of *buffer*,\n"
+"as guarded by the sequence counter at *seq_offset*.");
+
+static PyObject *
+seq_read(PyObject *module, PyObject *args)
+{
+    PyObject *owner, *result;
+    Py_ssize_t offset, data, size;
+    Py_buffer view;
+    uint64_t *seq, before, after;
+    char *copy;
+    int attempt = 0;
+
+    if (!PyArg_ParseTuple(args, "Onnn", &owner, &offset, &data, &size))
+        return NULL;
+    if (PyObject_GetBuffer(owner, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if (get_seq(&view, offset, data, size, &seq) < 0) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    result = PyBytes_FromStringAndSize(NULL, size);
+    if (result == NULL) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    copy = PyBytes_AS_STRING(result);
+    /* A writer of this process may need the GIL to finish */
+    Py_BEGIN_ALLOW_THREADS
+    for (;;) {
+        before = __atomic_load_n(seq, __ATOMIC_ACQUIRE);
+        if (!(before & 1)) {
+            memcpy(copy, (char *) view.buf + data, size);
+            __atomic_thread_fence(__ATOMIC_ACQUIRE);
+            after = __atomic_load_n(seq, __ATOMIC_RELAXED);
+            if (before == after)
+                break;
+        }
+        if (++attempt >= SPIN_TRIES)
+            sched_yield();
+    }
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&view);
+    return result;
+}
+
+/* Changes the counter of a SeqLock, which the caller holds the writer lock
+ * of, from even to odd or the other way around */
+static PyObject *
+seq_bump(PyObject *args, int begin)
+{
+    PyObject *owner;
+    Py_ssize_t offset;
+    Py_buffer view;
+    uint64_t *seq, value;
+
+    if (!PyArg_ParseTuple(args, "On", &owner, &offset))
+        return NULL;
+    if (PyObject_GetBuffer(owner, &view, PyBUF_SIMPLE) < 0)
+        return NULL;
+    if (get_seq(&view, offset, 0, 0, &seq) < 0) {
+        PyBuffer_Release(&view);
+        return NULL;
+    }
+    value = __atomic_load_n(seq, __ATOMIC_RELAXED) + 1;
+    if (begin) {
+        /* Readers must see the odd counter before any of the new data */
+        __atomic_store_n(seq, value, __ATOMIC_RELAXED);
+        __atomic_thread_fence(__ATOMIC_RELEASE);
+    } else {
+        __atomic_store_n(seq, value, __ATOMIC_RELEASE);
+    }
+    PyBuffer_Release(&view);
+    return PyLong_FromUnsignedLongLong(value);
+}
+
+PyDoc_STRVAR(seq_write_begin_doc,
+"seq_write_begin(buffer, seq_offset)\n\n"
+"Makes the sequence counter at *seq_offset* of *buffer* odd, returning it.");
+
+static PyObject *
+seq_write_begin(PyObject *module, PyObject *args)
+{
+    return seq_bump(args, 1);
+}
+
+PyDoc_STRVAR(seq_write_end_doc,
+"seq_write_end(buffer, seq_offset)\n\n"
+"Makes the sequence counter at *seq_offset* of *buffer* even, returning it.");
+
+static PyObject *
+seq_write_end(PyObject *module, PyObject *args)
+{
+    return seq_bump(args, 0);
+}
+
+static PyMethodDef speedups_methods[] = {
+    {"seq_read", seq_read, METH_VARARGS, seq_read_doc},
+    {"seq_write_begin", seq_write_begin, METH_VARARGS, seq_write_begin_doc},
+    {"seq_write_end", seq_write_end, METH_VARARGS, seq_write_end_doc},
+    {NULL}
+};
+
+static struct PyModuleDef speedups_module = {
+    PyModuleDef_HEAD_INIT,
+    .m_name = "prwlock._speedups",
+    .m_doc = "Compiled fast path for prwlock's lock operations",
+    .m_size = -1,
+    .m_methods = speedups_methods,
+};
+
+static int
+add_type(PyObject *module, const char *name, PyTypeObject *type)
+{
+    if (PyType_Ready(type) < 0)
+        return -1;
+    Py_INCREF(type);
+    if (PyModule_AddObject(module, name, (PyObject *) type) < 0) {
+        Py_DECREF(type);
+        return -1;
+    }
+    return 0;
+}
+
+PyMODINIT_FUNC
+PyInit__speedups(void)
+{
+    PyObject *module;
+
+    module = PyModule_Create(&speedups_module);
+    if (module == NULL)
+        return NULL;
+    if (add_type(module, "RWLockCore", &RWLockCoreType) < 0)
+        goto error;
+    if (add_type(module, "RWLockContext", &RWLockContextType) < 0)
+        goto error;
+#ifdef __linux__
+    if (add_type(module, "FutexCore", &FutexCoreType) < 0)
+        goto error;
+    if (add_type(module, "BRLockCore", &BRLockCoreType) < 0)
+        goto error;
+    refresh_pid();
+    pthread_atfork(NULL, NULL, refresh_pid);
+#endif
+    return module;
+
+error:
+    Py_DECREF(module);
+    return NULL;
+}
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""asyncio support for process-shared rwlocks.
+
+Blocking in pthread_rwlock_rdlock from a coroutine would stall every other
+coroutine of the event loop. AsyncRWLock never blocks the loop: it only
+ever makes non-blocking attempts at the lock, from the event loop's own
+thread, sleeping between them while the lock is busy. Lock statistics,
+hooks and lock counts thus see each acquisition once, and the lock is
+always held by whoever releases it later, as pthreads expects.
+"""
+
+import asyncio       # For sleeping between attempts
+
+POLL_MIN = 0.0005    # Seconds between the first attempts at a busy lock
+POLL_MAX = 0.05      # Longest the lock is left alone between attempts
+
+
+class AsyncRWLock(object):
+    """A process-shared rwlock that can be awaited from asyncio code.
+
+    Wraps *lock* (a new RWLock if not provided), which remains usable from
+    synchronous code, also in other processes. Timeouts and cancellation
+    behave as with the blocking methods: a wait that times out or is
+    cancelled doesn't leave the lock held.
+    """
+
+    def __init__(self, lock=None):
+        if lock is None:
+            from . import RWLock
+            lock = RWLock()
+        self.lock = lock
+
+    async def _acquire(self, method, timeout):
+        try_acquire = getattr(self.lock, 'try_acquire_' + method)
+        if try_acquire():
+            return True
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # Backs off exponentially, so long waits don't keep the loop busy
+        delay = POLL_MIN
+        while True:
+            seconds = delay
+            if deadline is not None:
+                seconds = min(seconds, deadline - loop.time())
+                if seconds <= 0:
+                    return False
+            await asyncio.sleep(seconds)
+            if try_acquire():
+                return True
+            delay = min(delay * 2, POLL_MAX)
+
+    async def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        return await self._acquire('read', timeout)
+
+    async def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        return await self._acquire('write', timeout)
+
+    def try_acquire_read(self):
+        return self.lock.try_acquire_read()
+
+    def try_acquire_write(self):
+        return self.lock.try_acquire_write()
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        self.lock.release()
+
+    @property
+    def nlocks(self):
+        return self.lock.nlocks
+
+    def reader_lock(self, timeout=None):
+        return AsyncLockContextManager(self, 'read', timeout=timeout)
+
+    def writer_lock(self, timeout=None):
+        return AsyncLockContextManager(self, 'write', timeout=timeout)
+
+    def __getstate__(self):
+        return {'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.lock = state['lock']
+
+
+class AsyncLockContextManager(object):
+    def __init__(self, lock, method, timeout=None):
+        self.lock = lock
+        self.locked = False
+        self.method = method
+        self.timeout = timeout
+        if method not in ['read', 'write']:
+            raise ValueError('AsyncLock called with invalid method %s'
+                             % self.method)
+
+    async def __aenter__(self):
+        locker = getattr(self.lock, 'acquire_' + self.method)
+        self.locked = await locker(timeout=self.timeout)
+        if not self.locked:
+            # Same as GenericLockContextManager
+            raise ValueError('Unable to acquire lock in context manager')
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.locked:
+            self.lock.release()
+        self.locked = False
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Atomic operations on shared memory, by address.
+
+ctypes has no notion of atomicity, so the operations are delegated to
+libatomic, which implements the same (lock-free, for these sizes) operations
+the compiler would inline. Since they are lock-free, they interoperate with
+the inline atomics used by the compiled accelerator on the same memory.
+"""
+
+import ctypes    # For calling into libatomic
+
+from .libraries import find_library
+
+SEQ_CST = 5      # __ATOMIC_SEQ_CST
+
+
+def _load():
+    for soname in ('libatomic.so.1', 'libatomic.1.dylib'):
+        try:
+            return ctypes.CDLL(soname)
+        except OSError:
+            pass
+    path = find_library('atomic')
+    if path is None:
+        raise ImportError('libatomic is not available')
+    return ctypes.CDLL(path)
+
+
+libatomic = _load()
+
+_TYPES = {4: ctypes.c_uint32, 8: ctypes.c_uint64}
+_MASKS = {4: 0xffffffff, 8: 0xffffffffffffffff}
+_LOAD, _STORE, _CAS, _ADD = {}, {}, {}, {}
+
+for _size, _type in _TYPES.items():
+    _LOAD[_size] = _load = getattr(libatomic, '__atomic_load_%d' % _size)
+    _load.argtypes = [ctypes.c_void_p, ctypes.c_int]
+    _load.restype = _type
+    _STORE[_size] = _store = getattr(libatomic, '__atomic_store_%d' % _size)
+    _store.argtypes = [ctypes.c_void_p, _type, ctypes.c_int]
+    _store.restype = None
+    _CAS[_size] = _cas = getattr(libatomic,
+                                 '__atomic_compare_exchange_%d' % _size)
+    _cas.argtypes = [ctypes.c_void_p, ctypes.POINTER(_type), _type,
+                     ctypes.c_int, ctypes.c_int]
+    _cas.restype = ctypes.c_bool
+    _ADD[_size] = _add = getattr(libatomic, '__atomic_fetch_add_%d' % _size)
+    _add.argtypes = [ctypes.c_void_p, _type, ctypes.c_int]
+    _add.restype = _type
+
+
+def load(address, size=8):
+    """Atomically reads the unsigned integer of *size* bytes at *address*"""
+    return _LOAD[size](address, SEQ_CST)
+
+
+def store(address, value, size=8):
+    """Atomically writes *value* to the integer at *address*"""
+    _STORE[size](address, value & _MASKS[size], SEQ_CST)
+
+
+def compare_exchange(address, expected, desired, size=8):
+    """Atomically replaces the integer at *address* with *desired* if it
+    still holds *expected*. Returns whether the exchange happened."""
+    expected = _TYPES[size](expected)
+    return _CAS[size](address, ctypes.byref(expected),
+                      desired & _MASKS[size], SEQ_CST, SEQ_CST)
+
+
+def fetch_add(address, delta, size=8):
+    """Atomically adds *delta* (which may be negative) to the integer at
+    *address*, returning its previous value"""
+    return _ADD[size](address, delta & _MASKS[size], SEQ_CST)
@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""Micro-benchmarks for prwlock.
+
+Run them with ``python -m prwlock.benchmarks``. Results are printed as a
+single JSON document so that runs on different machines, lock kinds or
+versions can be compared by other tools.
+"""
+
+from __future__ import print_function, division
+
+import os
+import sys
+import json
+import mmap
+import time
+import pickle
+import struct
+import random
+import platform
+import argparse
+import subprocess
+import multiprocessing as mp
+from collections import OrderedDict
+
+import prwlock
+from prwlock import prwlock as _prwlock
+
+timer = getattr(time, 'perf_counter', time.time)
+
+# Lock kinds that can be benchmarked, by name. Each entry is a callable
+# returning a new lock with the RWLock interface.
+LOCKS = OrderedDict()
+LOCKS['rwlock'] = prwlock.RWLock
+LOCKS['rwlock_stats'] = lambda: prwlock.RWLock(stats=True)
+LOCKS['arena'] = lambda: prwlock.RWLockArena(1)[0]
+if hasattr(prwlock, 'RWLockFutex'):
+    LOCKS['futex'] = prwlock.RWLockFutex
+if hasattr(prwlock, 'BigReaderLock'):
+    LOCKS['brlock'] = prwlock.BigReaderLock
+
+# Benchmarks by name, in the order they are run
+BENCHMARKS = OrderedDict()
+
+# Percentage of reads performed by the workers of the contended benchmark
+DEFAULT_RATIOS = [100, 90, 50, 10, 0]
+
+# Interpreters started by the import benchmark, for each measurement
+IMPORT_RUNS = 10
+
+
+def benchmark(name):
+    """Registers the decorated function as the benchmark *name*. Benchmarks
+    receive the parsed command line options and return JSON-serializable
+    results."""
+    def decorator(function):
+        BENCHMARKS[name] = function
+        return function
+    return decorator
+
+
+def measure(function, iterations, repeat=5):
+    """Returns statistics about the time, in nanoseconds, taken by one call
+    to *function*, which is called *iterations* times per repetition"""
+    samples = []
+    for _ in range(repeat):
+        start = timer()
+        for _ in range(iterations):
+            function()
+        samples.append((timer() - start) * 1e9 / iterations)
+    samples.sort()
+    return OrderedDict([
+        ('min_ns', samples[0]),
+        ('median_ns', samples[len(samples) // 2]),
+        ('max_ns', samples[-1]),
+        ('iterations', iterations),
+        ('repeat', repeat),
+    ])
+
+
+def percentiles(samples, points=(50, 90, 99, 99.9)):
+    """Returns the given percentiles of *samples* (nearest-rank)"""
+    samples = sorted(samples)
+    result = OrderedDict()
+    for point in points:
+        if not samples:
+            result['p%s' % point] = None
+            continue
+        index = min(len(samples) - 1, int(len(samples) * point / 100.0))
+        result['p%s' % point] = samples[index]
+    return result
+
+
+@benchmark('uncontended')
+def bench_uncontended(options):
+    """Cost of acquiring and immediately releasing a free lock"""
+    rwlock = options.factory()
+
+    def read():
+        rwlock.acquire_read()
+        rwlock.release()
+
+    def write():
+        rwlock.acquire_write()
+        rwlock.release()
+
+    return OrderedDict([
+        ('read', measure(read, options.iterations)),
+        ('write', measure(write, options.iterations)),
+    ])
+
+
+@benchmark('speedups')
+def bench_speedups(options):
+    """Cost of acquiring and releasing a free lock through the compiled core
+    and through the Python fallback, side by side, and how many times
+    faster the core is"""
+    compiled = options.factory()
+    if getattr(compiled, '_core', None) is None:
+        # Built without the accelerator, or a lock kind without a core
+        return OrderedDict([('compiled', None)])
+    fallback = options.factory()
+    fallback._unbind_core()
+    results = OrderedDict()
+    for mode in ('read', 'write'):
+        timings = OrderedDict()
+        for name, rwlock in (('compiled', compiled), ('fallback', fallback)):
+            def cycle(acquire=getattr(rwlock, 'acquire_' + mode),
+                      release=rwlock.release):
+                acquire()
+                release()
+            timings[name] = measure(cycle, options.iterations)
+        timings['speedup'] = (timings['fallback']['median_ns'] /
+                              timings['compiled']['median_ns'])
+        results[mode] = timings
+    return results
+
+
+@benchmark('context_manager')
+def bench_context_manager(options):
+    """Overhead of the with statement compared to raw acquire/release"""
+    rwlock = options.factory()
+
+    def raw():
+        rwlock.acquire_read()
+        rwlock.release()
+
+    def with_reader():
+        with rwlock.reader_lock():
+            pass
+
+    def with_writer():
+        with rwlock.writer_lock():
+            pass
+
+    def with_timeout():
+        # Not cached: a new context manager per with statement
+        with rwlock.reader_lock(timeout=1):
+            pass
+
+    reads = rwlock.reads(lambda: None)
+
+    return OrderedDict([
+        ('raw', measure(raw, options.iterations)),
+        ('reader_lock', measure(with_reader, options.iterations)),
+        ('writer_lock', measure(with_writer, options.iterations)),
+        ('reader_lock_timeout', measure(with_timeout, options.iterations)),
+        ('reads_decorator', measure(reads, options.iterations)),
+    ])
+
+
+@benchmark('timed_and_try')
+def bench_timed_and_try(options):
+    """Cost of timed and non-blocking acquisition, free and busy"""
+    rwlock = options.factory()
+    busy = options.factory()
+    busy.acquire_write()
+
+    def timed_read():
+        rwlock.acquire_read(timeout=1)
+        rwlock.release()
+
+    def timed_write():
+        rwlock.acquire_write(timeout=1)
+        rwlock.release()
+
+    def try_read():
+        rwlock.try_acquire_read()
+        rwlock.release()
+
+    def try_write():
+        rwlock.try_acquire_write()
+        rwlock.release()
+
+    def try_busy():
+        # EDEADLK/EBUSY path: the lock is held, so this fails right away
+        busy.try_acquire_read()
+
+    results = OrderedDict([
+        ('timed_read', measure(timed_read, options.iterations)),
+        ('timed_write', measure(timed_write, options.iterations)),
+        ('try_read', measure(try_read, options.iterations)),
+        ('try_write', measure(try_write, options.iterations)),
+        ('try_busy', measure(try_busy, options.iterations)),
+    ])
+    busy.release()
+    return results
+
+
+@benchmark('create')
+def bench_create(options):
+    """Cost of creating (and destroying) a lock, and of creating the file
+    backing it with each available backend"""
+    iterations = max(1, options.iterations // 10)
+    results = OrderedDict([('lock', measure(options.factory, iterations))])
+    # Creating locks settled the default
+    results['default_backend'] = _prwlock.DEFAULT_BACKEND
+    for backend in _prwlock.FALLBACK_BACKENDS:
+        def create():
+            os.close(_prwlock.create_backing_file(mmap.PAGESIZE, backend))
+        results[backend] = measure(create, iterations)
+
+    # Attaching to an existing named lock, as unrelated processes do
+    name = 'benchmark-%d' % os.getpid()
+    named = prwlock.RWLock.open(name)
+    try:
+        results['open_named'] = measure(lambda: prwlock.RWLock.open(name),
+                                        iterations)
+    finally:
+        # Only now may the lock go away
+        del named
+        prwlock.RWLock.unlink(name)
+    return results
+
+
+@benchmark('pickle')
+def bench_pickle(options):
+    """Cost of serializing a lock and of attaching to it again"""
+    rwlock = options.factory()
+    data = pickle.dumps(rwlock)
+    attached = []
+
+    def dumps():
+        pickle.dumps(rwlock)
+
+    def loads():
+        # Keep the copies alive so that their cleanup isn't measured.
+        # Attaching to a lock in the process that created it shares the
+        # descriptor, hence the copies are never collected here.
+        attached.append(pickle.loads(data))
+
+    iterations = max(1, options.iterations // 10)
+    results = OrderedDict([
+        ('dumps', measure(dumps, iterations)),
+        ('loads', measure(loads, iterations, repeat=1)),
+    ])
+    return results
+
+
+@benchmark('import')
+def bench_import(options):
+    """Time a new interpreter takes to import prwlock, on top of the time it
+    takes to start. Matters to short-lived workers and scripts."""
+    env = dict(os.environ)
+    path = os.path.dirname(os.path.dirname(os.path.abspath(prwlock.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [path] + [env['PYTHONPATH']] if env.get('PYTHONPATH') else [path])
+
+    def start(code):
+        samples = []
+        for _ in range(IMPORT_RUNS):
+            begin = timer()
+            subprocess.check_call([sys.executable, '-c', code], env=env)
+            samples.append((timer() - begin) * 1e9)
+        return min(samples)
+
+    interpreter = start('pass')
+    imported = start('import prwlock')
+    first_lock = start('import prwlock; lock = prwlock.RWLock(); '
+                       'lock.acquire_read()')
+    return OrderedDict([
+        ('interpreter_ns', interpreter),
+        ('import_ns', imported - interpreter),
+        ('first_lock_ns', first_lock - imported),
+        ('runs', IMPORT_RUNS),
+    ])
+
+
+def _contended_worker(rwlock, ratio, duration, start, queue):
+    rng = random.Random(os.getpid())
+    acquire_read, acquire_write = rwlock.acquire_read, rwlock.acquire_write
+    release = rwlock.release
+    reads = writes = 0
+    start.wait()
+    deadline = timer() + duration
+    while True:
+        # Check the clock every few operations only, it isn't free either
+        for _ in range(64):
+            if rng.random() * 100 < ratio:
+                acquire_read()
+                release()
+                reads += 1
+            else:
+                acquire_write()
+                release()
+                writes += 1
+        if timer() >= deadline:
+            break
+    queue.put((reads, writes))
+
+
+def run_workers(target, processes, args):
+    """Runs *target* in *processes* workers that start together, returning
+    what each of them put in the queue appended to *args*"""
+    start = mp.Event()
+    queue = mp.Queue()
+    workers = [mp.Process(target=target, args=tuple(args) + (start, queue))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    results = [queue.get() for _ in workers]
+    for worker in workers:
+        worker.join()
+    return results
+
+
+@benchmark('contended')
+def bench_contended(options):
+    """Aggregate throughput of workers hammering a single lock"""
+    results = []
+    for processes in range(1, options.processes + 1):
+        for ratio in options.ratios:
+            rwlock = options.factory()
+            counts = run_workers(_contended_worker, processes,
+                                 (rwlock, ratio, options.duration))
+            reads = sum(r for r, w in counts)
+            writes = sum(w for r, w in counts)
+            results.append(OrderedDict([
+                ('processes', processes),
+                ('read_ratio', ratio),
+                ('reads', reads),
+                ('writes', writes),
+                ('ops_per_sec', (reads + writes) / options.duration),
+            ]))
+    return results
+
+
+@benchmark('scaling')
+def bench_scaling(options):
+    """Read-only throughput as readers are added, for an RWLock and a
+    BigReaderLock, along with the cost of writing to each"""
+    kinds = OrderedDict([('rwlock', prwlock.RWLock)])
+    if hasattr(prwlock, 'BigReaderLock'):
+        kinds['brlock'] = prwlock.BigReaderLock
+    results = OrderedDict()
+    for name, factory in kinds.items():
+        rwlock = factory()
+
+        def write():
+            rwlock.acquire_write()
+            rwlock.release()
+
+        reads = []
+        for processes in range(1, options.processes + 1):
+            counts = run_workers(_contended_worker, processes,
+                                 (rwlock, 100, options.duration))
+            reads.append(OrderedDict([
+                ('processes', processes),
+                ('reads_per_sec', sum(r for r, w in counts) /
+                 options.duration),
+            ]))
+        results[name] = OrderedDict([
+            ('reads', reads),
+            ('write', measure(write, options.iterations)),
+        ])
+    return results
+
+
+def _policy_reader(rwlock, hold, stop, start, queue):
+    reads = 0
+    start.wait()
+    while not stop.is_set():
+        rwlock.acquire_read()
+        # Hold the lock for a while, so that readers overlap
+        time.sleep(hold)
+        rwlock.release()
+        reads += 1
+    queue.put(reads)
+
+
+def _policy_writer(rwlock, duration, start, queue):
+    waits, starved = [], 0
+    start.wait()
+    deadline = timer() + duration
+    while True:
+        remaining = deadline - timer()
+        if remaining <= 0:
+            break
+        begin = timer()
+        if rwlock.acquire_write(timeout=remaining):
+            waits.append((timer() - begin) * 1e9)
+            rwlock.release()
+        else:
+            starved += 1
+        # Let readers pile up again before the next attempt
+        time.sleep(0.001)
+    queue.put((waits, starved))
+
+
+@benchmark('policies')
+def bench_policies(options):
+    """Time a writer waits for the lock while readers keep it busy, for each
+    RWLock policy"""
+    results = []
+    readers = max(2, options.processes)
+    for policy in _prwlock.POLICIES:
+        rwlock = prwlock.RWLock(policy=policy)
+        start, stop, queue = mp.Event(), mp.Event(), mp.Queue()
+        workers = [mp.Process(target=_policy_reader,
+                              args=(rwlock, 0.002, stop, start, queue))
+                   for _ in range(readers)]
+        writer = mp.Process(target=_policy_writer,
+                            args=(rwlock, options.duration, start, queue))
+        for worker in workers + [writer]:
+            worker.start()
+        start.set()
+        writer.join()
+        waits, starved = queue.get()
+        stop.set()
+        reads = sum(queue.get() for _ in workers)
+        for worker in workers:
+            worker.join()
+        result = OrderedDict([
+            ('policy', policy),
+            ('readers', readers),
+            ('reads', reads),
+            ('writes', len(waits)),
+            ('starved', starved),
+        ])
+        result.update(('write_wait_%s_ns' % key, value)
+                      for key, value in percentiles(waits).items())
+        results.append(result)
+    return results
+
+
+@benchmark('seqlock')
+def bench_seqlock(options):
+    """Cost of reading and updating a small record through a SeqLock,
+    compared to copying it under the read lock of *lock*"""
+    record = struct.Struct('=Qd')
+    seqlock = prwlock.SeqLock(record.size)
+    seqlock.write(record.pack(1, 1.0))
+    rwlock = options.factory()
+    data = bytearray(record.pack(1, 1.0))
+
+    def locked_read():
+        rwlock.acquire_read()
+        record.unpack(bytes(data))
+        rwlock.release()
+
+    return OrderedDict([
+        ('read', measure(lambda: seqlock.read(record), options.iterations)),
+        ('locked_read', measure(locked_read, options.iterations)),
+        ('write', measure(lambda: seqlock.write(b'\0' * record.size),
+                          options.iterations)),
+    ])
+
+
+def environment():
+    """Describes where the benchmarks ran, so results can be compared"""
+    return OrderedDict([
+        ('prwlock', prwlock.__version__),
+        ('python', platform.python_version()),
+        ('implementation', platform.python_implementation()),
+        ('system', platform.system()),
+        ('machine', platform.machine()),
+        ('cpus', mp.cpu_count()),
+        ('speedups', _prwlock.RWLockCore is not None),
+    ])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m prwlock.benchmarks',
+        description='Measures the latency and throughput of prwlock locks.')
+    parser.add_argument('--lock', choices=list(LOCKS), default='rwlock',
+                        help='kind of lock to benchmark (default: %(default)s)')
+    parser.add_argument('--only', action='append', choices=list(BENCHMARKS),
+                        help='run only this benchmark (may be repeated)')
+    parser.add_argument('--iterations', type=int, default=100000,
+                        help='operations per latency sample '
+                             '(default: %(default)s)')
+    parser.add_argument('--processes', type=int,
+                        default=min(mp.cpu_count(), 8),
+                        help='maximum number of worker processes '
+                             '(default: %(default)s)')
+    parser.add_argument('--ratios', type=lambda s: [int(r) for r in s.split(',')],
+                        default=DEFAULT_RATIOS,
+                        help='comma-separated read percentages for the '
+                             'contended benchmarks (default: 100,90,50,10,0)')
+    parser.add_argument('--duration', type=float, default=1.0,
+                        help='seconds each contended run lasts '
+                             '(default: %(default)s)')
+    parser.add_argument('--output', default='-',
+                        help='file to write the JSON results to '
+                             '(default: stdout)')
+    options = parser.parse_args(argv)
+    options.factory = LOCKS[options.lock]
+    return options
+
+
+def run(options):
+    results = OrderedDict([
+        ('environment', environment()),
+        ('lock', options.lock),
+        ('benchmarks', OrderedDict()),
+    ])
+    for name, function in BENCHMARKS.items():
+        if options.only and name not in options.only:
+            continue
+        results['benchmarks'][name] = function(options)
+    return results
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    results = run(options)
+    if options.output == '-':
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2)
+            output.write('\n')
+    return 0
@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os        # For strerror
+import mmap      # For sizing the shared memory region
+import time      # For backing off while readers drain
+import ctypes    # For the layout of the lock
+import errno     # To report deadlocks the way pthreads does
+import threading # To tell which thread holds the write lock
+
+from .prwlock import (CoreBound, create_backing_file, librt, align,
+                      CACHE_LINE, SPIN_TRIES, YIELD_TRIES, MIN_BACKOFF,
+                      MAX_BACKOFF)
+from .mappings import attach, detach
+from .frwlock import futex_wait, futex_wake, atomics, SYS_futex
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    if os.environ.get('PRWLOCK_NO_SPEEDUPS'):
+        raise ImportError('prwlock speedups disabled by the environment')
+    from ._speedups import BRLockCore
+except ImportError:
+    BRLockCore = None
+
+# The Python fallback needs libatomic and the futex syscall number
+available = BRLockCore is not None or (atomics is not None and
+                                       SYS_futex is not None)
+
+
+class br_header_t(ctypes.Structure):
+    """First cache line of the lock, followed by one cache line per reader
+    slot, each holding the number of readers counted in it as a 64-bit
+    word. Must be kept in sync with br_header_t in _speedups.c."""
+    _fields_ = [
+        ('writer', ctypes.c_uint32),    # 1 while a writer holds or drains it
+        ('waiters', ctypes.c_uint32),   # Processes sleeping until it drops
+        ('nslots', ctypes.c_uint32),
+    ]
+
+
+def _cpu_count():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.sysconf('SC_NPROCESSORS_CONF')
+
+
+class BigReaderLock(CoreBound):
+    """A reader-writer lock for data that is read far more often than it's
+    written, whose readers scale with the number of CPUs.
+
+    Every reader of a pthread or futex lock updates the same reader count,
+    so readers on different CPUs keep stealing its cache line from each
+    other. Readers of a big-reader lock instead count themselves in the
+    slot of the CPU they run on (see sched_getcpu(3)), each slot on a cache
+    line of its own. In exchange, writers have to raise a flag that keeps
+    new readers out and then wait for every slot to drain, so writes get
+    slower the more *slots* the lock has (by default, one per CPU the
+    process may run on). Writers go first once they're waiting.
+    """
+    core_class = BRLockCore
+
+    def __init__(self, slots=None):
+        if slots is None:
+            slots = _cpu_count()
+        if slots < 1:
+            raise ValueError('A big-reader lock needs at least one slot')
+        self.__setup(slots)
+        self.nlocks = 0
+        self.pid = os.getpid()
+
+    def _length(self, slots):
+        return align(CACHE_LINE * (slots + 1), mmap.PAGESIZE)
+
+    def __setup(self, slots, _fd=None):
+        try:
+            mapping, fd = None, None
+
+            length = self._length(slots)
+            fd = _fd if _fd else create_backing_file(length)
+            mapping = attach(fd, length)
+            buf = mapping.buf
+
+            header = br_header_t.from_buffer(buf)
+            if _fd is None:
+                header.nslots = slots
+            state = (ctypes.c_char * (CACHE_LINE * (slots + 1))).from_buffer(
+                buf)
+            address = ctypes.addressof(header)
+
+            self._mapping = mapping
+            self._fd = mapping.fd
+            self._buf = buf
+            self._header = header
+            self._lock = state
+            self.slots = slots
+            self._writer_addr = address + br_header_t.writer.offset
+            self._waiters_addr = address + br_header_t.waiters.offset
+            self._slot_addrs = [address + CACHE_LINE * (index + 1)
+                                for index in range(slots)]
+            self._reset()
+            self._bind_core(state)
+        except:
+            buf = header = state = None
+            if mapping:
+                detach(mapping)
+            elif fd and not _fd:
+                try:
+                    os.close(fd)
+                except:
+                    pass
+            raise
+
+    # The methods below are the Python fallback of BRLockCore, and follow
+    # the same protocol
+
+    def _current_slot(self):
+        cpu = librt.sched_getcpu()
+        if cpu < 0:
+            cpu = os.getpid()
+        return cpu % self.slots
+
+    def _reset(self):
+        # Read locks this object holds, by slot. They are released from the
+        # slots they were taken in, wherever the process runs by then.
+        self._reads = [0] * self.slots
+        self._writer = None
+        self._nlocks = 0
+        self._reads_pid = os.getpid()
+
+    def _check_fork(self):
+        # Forked children don't hold the locks of their parent
+        if self._reads_pid != os.getpid():
+            self._reset()
+
+    @staticmethod
+    def _thread():
+        # Forked children inherit thread identifiers, hence the pid
+        return os.getpid(), threading.current_thread().ident
+
+    def _check_deadlock(self, name, write):
+        # Writers would wait for themselves, readers behind themselves
+        self._check_fork()
+        if self._writer == self._thread() or (write and any(self._reads)):
+            raise OSError(errno.EDEADLK, '{} failed {}'.format(
+                name, os.strerror(errno.EDEADLK)))
+
+    def _wait_writer(self, deadline):
+        # Sleeps until the writer flag drops, returning False if *deadline*
+        # passed first
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return False
+        atomics.fetch_add(self._waiters_addr, 1, 4)
+        if atomics.load(self._writer_addr, 4):
+            futex_wait(self._writer_addr, 1, remaining)
+        atomics.fetch_add(self._waiters_addr, -1, 4)
+        return True
+
+    def _drop_writer(self):
+        atomics.store(self._writer_addr, 0, 4)
+        if atomics.load(self._waiters_addr, 4):
+            futex_wake(self._writer_addr)
+
+    def _read(self, wait=True, deadline=None):
+        # Counts a reader in the slot of the current CPU, returning the
+        # slot, or None if the lock wasn't acquired
+        while True:
+            if not atomics.load(self._writer_addr, 4):
+                index = self._current_slot()
+                slot = self._slot_addrs[index]
+                atomics.fetch_add(slot, 1)
+                # A writer raising the flag meanwhile either sees our count
+                # or is seen by us
+                if not atomics.load(self._writer_addr, 4):
+                    return index
+                atomics.fetch_add(slot, -1)
+            if not wait or not self._wait_writer(deadline):
+                return None
+
+    def _write(self, wait=True, deadline=None):
+        # Raises the writer flag and waits for the readers to drain
+        while not atomics.compare_exchange(self._writer_addr, 0, 1, 4):
+            if not wait or not self._wait_writer(deadline):
+                return False
+        for slot in self._slot_addrs:
+            delay = MIN_BACKOFF
+            attempt = 0
+            while atomics.load(slot):
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                if not wait or (remaining is not None and remaining <= 0):
+                    self._drop_writer()
+                    return False
+                attempt += 1
+                if attempt < SPIN_TRIES:
+                    continue
+                elif attempt < SPIN_TRIES + YIELD_TRIES:
+                    time.sleep(0)
+                else:
+                    time.sleep(delay if remaining is None
+                               else min(delay, remaining))
+                    delay = min(delay * 2, MAX_BACKOFF)
+        return True
+
+    def _read_acquired(self, index):
+        self._reads[index] += 1
+        self._nlocks += 1
+        return True
+
+    def _write_acquired(self):
+        self._writer = self._thread()
+        self._nlocks += 1
+        return True
+
+    def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        self._check_deadlock('br_rdlock', False)
+        deadline = None if timeout is None else monotonic() + timeout
+        index = self._read(deadline=deadline)
+        if index is None:
+            return False
+        return self._read_acquired(index)
+
+    def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        self._check_deadlock('br_wrlock', True)
+        deadline = None if timeout is None else monotonic() + timeout
+        if not self._write(deadline=deadline):
+            return False
+        return self._write_acquired()
+
+    def try_acquire_read(self):
+        """Try to obtain a read lock, immediately returning True if
+        the lock is acquired; False otherwise.
+        """
+        self._check_fork()
+        if self._writer == self._thread():
+            return False
+        index = self._read(wait=False)
+        if index is None:
+            return False
+        return self._read_acquired(index)
+
+    def try_acquire_write(self):
+        """Try to obtain a write lock, returning True immediately if
+        the lock can be acquired; False otherwise.
+        """
+        self._check_fork()
+        if (self._writer == self._thread() or any(self._reads) or
+                not self._write(wait=False)):
+            return False
+        return self._write_acquired()
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        self._check_fork()
+        if self._nlocks == 0:
+            raise ValueError(
+                'Tried to release a released lock'
+            )
+        if self._writer is not None:
+            self._writer = None
+            self._drop_writer()
+        else:
+            # Preferably from the slot of the CPU we're on
+            index = self._current_slot()
+            if not self._reads[index]:
+                index = next(i for i, n in enumerate(self._reads) if n)
+            self._reads[index] -= 1
+            atomics.fetch_add(self._slot_addrs[index], -1)
+        self._nlocks -= 1
+
+    def state(self):
+        """Returns a snapshot of the shared lock state"""
+        return {
+            'writer': bool(self._header.writer),
+            'waiters': self._header.waiters,
+            'readers': [ctypes.c_uint64.from_address(slot).value
+                        for slot in self._slot_addrs],
+        }
+
+    def __getstate__(self):
+        return {
+                '_fd': self._fd,
+                'pid': self.pid,
+                'nlocks': self.nlocks,
+                'slots': self.slots,
+                }
+
+    def __setstate__(self, state):
+        self.__setup(state['slots'], state['_fd'])
+        self.pid = os.getpid()
+        # Only held read locks could be told apart by slot, so copies start
+        # out holding nothing
+        self.nlocks = 0
+
+    def _del_lock(self):
+        for i in range(self.nlocks):
+            self.release()
+        self._unbind_core(detach=True)
+        self._lock = self._header = None
+
+    def _del_buf(self):
+        self._buf = None
+        detach(self._mapping)
+        self._mapping = None
+
+    def __del__(self):
+        for name in '_lock _buf'.split():
+            attr = getattr(self, name, None)
+            if attr is not None:
+                func = getattr(self, '_del{}'.format(name))
+                func()
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os        # For strerror
+import mmap      # For setting up a shared memory region
+import ctypes    # For doing the actual wrapping of the futex syscall
+import errno     # To interpret errors of the futex syscall
+import sys       # To figure which system we're running in
+import threading # To tell which thread holds the write lock
+
+from .prwlock import CoreBound, create_backing_file, librt
+from .mappings import attach, detach
+
+if not sys.platform.startswith('linux'):
+    raise Exception("Unsupported operating system.")
+
+try:
+    from . import atomics
+except ImportError:
+    atomics = None
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+try:
+    if os.environ.get('PRWLOCK_NO_SPEEDUPS'):
+        raise ImportError('prwlock speedups disabled by the environment')
+    from ._speedups import FutexCore
+except ImportError:
+    FutexCore = None
+
+# Numbers of the futex syscall, which ctypes can't find by itself
+SYS_futex = {
+    'x86_64': 202,
+    'i386': 240,
+    'i686': 240,
+    'armv7l': 240,
+    'aarch64': 98,
+    'riscv64': 98,
+    'ppc64le': 221,
+    's390x': 238,
+}.get(os.uname()[4])
+FUTEX_WAIT = 0
+FUTEX_WAKE = 1
+INT_MAX = 0x7fffffff
+
+# The lock state is a single 64-bit word, laid out as below. Changes to it
+# must be kept in sync with FutexCore in _speedups.c.
+READER = 1
+READERS = 0xffffff              # Number of readers holding the lock
+WRITER = 1 << 24                # Set while a writer holds the lock
+READ_WAITER = 1 << 32
+READ_WAITERS = 0xffff << 32     # Number of readers waiting for the lock
+WRITE_WAITER = 1 << 48
+WRITE_WAITERS = 0xffff << 48    # Number of writers waiting for the lock
+WAITERS = READ_WAITERS | WRITE_WAITERS
+
+# The Python fallback needs libatomic and the futex syscall number
+available = FutexCore is not None or (atomics is not None and
+                                      SYS_futex is not None)
+
+
+class futex_rwlock_t(ctypes.Structure):
+    _fields_ = [
+        ('state', ctypes.c_uint64),
+        # Waiters sleep on this word, which is bumped when they may proceed
+        ('seq', ctypes.c_uint32),
+    ]
+
+
+class TimeSpec(ctypes.Structure):
+    _fields_ = [
+        ('tv_sec', ctypes.c_long),
+        ('tv_nsec', ctypes.c_long),
+    ]
+
+
+if SYS_futex is not None:
+    librt.syscall.argtypes = [ctypes.c_long, ctypes.c_void_p, ctypes.c_int,
+                              ctypes.c_uint32, ctypes.c_void_p,
+                              ctypes.c_void_p, ctypes.c_int]
+    librt.syscall.restype = ctypes.c_long
+
+
+def futex_wait(address, value, timeout=None):
+    """Sleeps while the 32-bit word at *address* holds *value*, for at most
+    *timeout* seconds. Returns False on timeout; True otherwise."""
+    ts = None
+    if timeout is not None:
+        ts = TimeSpec(int(timeout), int((timeout - int(timeout)) * 1e+9))
+        ts = ctypes.byref(ts)
+    if librt.syscall(SYS_futex, address, FUTEX_WAIT, value, ts, None, 0) == 0:
+        return True
+    error = ctypes.get_errno()
+    if error == errno.ETIMEDOUT:
+        return False
+    elif error in (errno.EAGAIN, errno.EINTR):
+        return True
+    raise OSError(error, 'futex wait failed {}'.format(os.strerror(error)))
+
+
+def futex_wake(address, count=INT_MAX):
+    """Wakes up to *count* processes sleeping on the word at *address*"""
+    librt.syscall(SYS_futex, address, FUTEX_WAKE, count, None, None, 0)
+
+
+class RWLockFutex(CoreBound):
+    """A reader-writer lock implemented directly on top of futexes.
+
+    The whole lock state lives in one 64-bit word of the shared page, so
+    uncontended acquisitions and releases are a single atomic operation and
+    the kernel is only entered to sleep or to wake waiters up. Unlike
+    pthread_rwlock_t, the layout doesn't depend on the C library and can be
+    inspected with state().
+    """
+    core_class = FutexCore
+
+    def __init__(self):
+        self.__setup(None)
+        self.nlocks = 0
+        self.pid = os.getpid()
+
+    def __setup(self, _fd=None):
+        try:
+            mapping, fd = None, None
+
+            fd = _fd if _fd else create_backing_file(mmap.PAGESIZE)
+            mapping = attach(fd, mmap.PAGESIZE)
+            buf = mapping.buf
+
+            # An all-zeros state is an unlocked lock, so unlike pthread locks
+            # there's nothing to initialize
+            lock = futex_rwlock_t.from_buffer(buf)
+            address = ctypes.addressof(lock)
+
+            self._mapping = mapping
+            self._fd = mapping.fd
+            self._buf = buf
+            self._lock = lock
+            self._state_addr = address + futex_rwlock_t.state.offset
+            self._seq_addr = address + futex_rwlock_t.seq.offset
+            self._writer = None
+            self._bind_core(lock)
+        except:
+            buf = lock = None
+            if mapping:
+                detach(mapping)
+            elif fd and not _fd:
+                try:
+                    os.close(fd)
+                except:
+                    pass
+            raise
+
+    def _acquire(self, blocked, increment, waiter, wait=True, timeout=None):
+        # Python version of futex_acquire in _speedups.c
+        state = self._state_addr
+        deadline = None if timeout is None else monotonic() + timeout
+        remaining = None
+        s = atomics.load(state)
+        while True:
+            if not s & blocked:
+                if atomics.compare_exchange(state, s, s + increment):
+                    return True
+                s = atomics.load(state)
+                continue
+            if not wait:
+                return False
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+            if not atomics.compare_exchange(state, s, s + waiter):
+                s = atomics.load(state)
+                continue
+            seq = atomics.load(self._seq_addr, 4)
+            if atomics.load(state) & blocked:
+                futex_wait(self._seq_addr, seq, remaining)
+            s = atomics.fetch_add(state, -waiter) - waiter
+
+    @staticmethod
+    def _thread():
+        # Forked children inherit thread identifiers, hence the pid
+        return os.getpid(), threading.current_thread().ident
+
+    def _check_deadlock(self, name):
+        if self._writer is not None and self._writer == self._thread():
+            raise OSError(errno.EDEADLK, '{} failed {}'.format(
+                name, os.strerror(errno.EDEADLK)))
+
+    def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        self._check_deadlock('futex_rdlock')
+        if not self._acquire(WRITER, READER, READ_WAITER, timeout=timeout):
+            return False
+        self._nlocks += 1
+        return True
+
+    def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        self._check_deadlock('futex_wrlock')
+        if not self._acquire(WRITER | READERS, WRITER, WRITE_WAITER,
+                             timeout=timeout):
+            return False
+        self._writer = self._thread()
+        self._nlocks += 1
+        return True
+
+    def try_acquire_read(self):
+        """Try to obtain a read lock, immediately returning True if
+        the lock is acquired; False otherwise.
+        """
+        if self._writer != self._thread() and self._acquire(WRITER, READER, 0,
+                                                            wait=False):
+            self._nlocks += 1
+            return True
+        return False
+
+    def try_acquire_write(self):
+        """Try to obtain a write lock, returning True immediately if
+        the lock can be acquired; False otherwise.
+        """
+        if self._writer != self._thread() and self._acquire(
+                WRITER | READERS, WRITER, 0, wait=False):
+            self._writer = self._thread()
+            self._nlocks += 1
+            return True
+        return False
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        if self._nlocks == 0:
+            raise ValueError(
+                'Tried to release a released lock'
+            )
+        if self._writer is not None and self._writer[0] == os.getpid():
+            s = atomics.fetch_add(self._state_addr, -WRITER) - WRITER
+            self._writer = None
+        else:
+            s = atomics.fetch_add(self._state_addr, -READER) - READER
+        self._nlocks -= 1
+        # Only wake waiters up when one of them can actually make progress
+        if s & WAITERS and not s & (WRITER | READERS):
+            atomics.fetch_add(self._seq_addr, 1, 4)
+            futex_wake(self._seq_addr)
+
+    def state(self):
+        """Returns a snapshot of the shared lock state"""
+        s = self._lock.state
+        return {
+            'readers': s & READERS,
+            'writer': bool(s & WRITER),
+            'read_waiters': (s & READ_WAITERS) >> 32,
+            'write_waiters': (s & WRITE_WAITERS) >> 48,
+        }
+
+    def __getstate__(self):
+        return {
+                '_fd': self._fd,
+                'pid': self.pid,
+                'nlocks': self.nlocks,
+                }
+
+    def __setstate__(self, state):
+        self.__setup(state['_fd'])
+        self.pid = os.getpid()
+        if self.pid == state['pid']:
+            self.nlocks = state['nlocks']
+        else:
+            self.nlocks = 0
+
+    def _del_lock(self):
+        for i in range(self.nlocks):
+            self.release()
+        self._unbind_core()
+        self._lock = None
+
+    def _del_buf(self):
+        self._buf = None
+        detach(self._mapping)
+        self._mapping = None
+
+    def __del__(self):
+        for name in '_lock _buf'.split():
+            attr = getattr(self, name, None)
+            if attr is not None:
+                func = getattr(self, '_del{}'.format(name))
+                func()
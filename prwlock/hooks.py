@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import weakref   # So that instrumented locks can still be collected
+import itertools # For counting operations when sampling
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+READ, WRITE = 'read', 'write'
+
+
+class LockHooks(object):
+    """Callbacks reporting lock events, e.g. to a tracing system.
+
+    on_wait_start(lock, mode) is called before trying to acquire *lock* in
+    *mode* ('read' or 'write'), on_acquired(lock, mode, wait) once it was
+    acquired, after *wait* seconds, and on_release(lock, hold) when it is
+    released, having been held for *hold* seconds. Any callback may be None.
+
+    Only one in *sample* acquisitions (and their releases) is timed and
+    reported, which bounds the overhead on busy locks.
+    """
+
+    def __init__(self, on_wait_start=None, on_acquired=None, on_release=None,
+                 sample=1):
+        if int(sample) < 1:
+            raise ValueError('sample must be a positive integer')
+        self.on_wait_start = on_wait_start
+        self.on_acquired = on_acquired
+        self.on_release = on_release
+        self.sample = int(sample)
+        self._counter = itertools.count()
+
+    def sampled(self):
+        """Returns whether the next operation should be reported"""
+        return self.sample == 1 or next(self._counter) % self.sample == 0
+
+    def wait_start(self, lock, mode):
+        if self.on_wait_start is not None:
+            self.on_wait_start(lock, mode)
+        return monotonic()
+
+    def acquired(self, lock, mode, start):
+        now = monotonic()
+        if self.on_acquired is not None:
+            self.on_acquired(lock, mode, now - start)
+        return now
+
+    def released(self, lock, acquired_at):
+        if self.on_release is not None:
+            self.on_release(lock, monotonic() - acquired_at)
+
+    def instrument(self, lock, methods):
+        """Returns instrumented versions of the bound lock *methods*, a
+        dictionary with the acquire_*, try_acquire_* and release methods of
+        *lock*"""
+        ref = weakref.ref(lock)
+        # When each lock held by this process was acquired, None for those
+        # that weren't sampled. Locks are released in the reverse order.
+        held = []
+
+        def acquirer(mode, inner):
+            def acquire(*args, **kwargs):
+                if not self.sampled():
+                    acquired = inner(*args, **kwargs)
+                    if acquired:
+                        held.append(None)
+                    return acquired
+                start = self.wait_start(ref(), mode)
+                acquired = inner(*args, **kwargs)
+                if acquired:
+                    held.append(self.acquired(ref(), mode, start))
+                return acquired
+            acquire.__doc__ = inner.__doc__
+            return acquire
+
+        release_lock = methods['release']
+
+        def release():
+            release_lock()
+            acquired_at = held.pop() if held else None
+            if acquired_at is not None:
+                self.released(ref(), acquired_at)
+        release.__doc__ = release_lock.__doc__
+
+        return {
+            'acquire_read': acquirer(READ, methods['acquire_read']),
+            'acquire_write': acquirer(WRITE, methods['acquire_write']),
+            'try_acquire_read': acquirer(READ, methods['try_acquire_read']),
+            'try_acquire_write': acquirer(WRITE,
+                                          methods['try_acquire_write']),
+            'release': release,
+        }
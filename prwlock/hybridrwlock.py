@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os        # For strerror
+import errno     # To report deadlocks the way pthreads does
+import weakref   # To find the locks to reset in forked children
+import threading # For the in-process layer of the lock
+
+try:
+    from threading import get_ident
+except ImportError:
+    from thread import get_ident
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# Every HybridRWLock of this process. Forked children start with a single
+# thread, so the in-process state inherited from the parent (which may even
+# show the child's thread as a holder) must be thrown away.
+_instances = weakref.WeakSet()
+
+
+def _after_fork():
+    for lock in list(_instances):
+        lock._reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+class HybridRWLock(object):
+    """A process-shared rwlock that is also safe to share among threads.
+
+    Threads of a process coordinate through an in-process reader-writer
+    layer in front of the process-shared *lock* (a new RWLock if not
+    provided): the first reader thread takes the process-level read lock,
+    further reader threads only bump a local count and the last reader out
+    releases it. Writers take the process-level lock in write mode, once no
+    local thread holds the lock. That way threads reading concurrently cost
+    one cross-process acquisition instead of one each, and nlocks is kept
+    consistent across threads.
+
+    Threads that don't hold a read lock yet wait for local writers that are
+    already waiting, so readers can't starve writers of the same process.
+    The process-level read lock may be released by a thread other than the
+    one that took it, which pthreads (and RWLockFutex) support for readers.
+    """
+
+    def __init__(self, lock=None):
+        if lock is None:
+            from . import RWLock
+            lock = RWLock()
+        self.__setup(lock)
+
+    def __setup(self, lock):
+        self.lock = lock
+        self._reset()
+        _instances.add(self)
+
+    def _reset(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}          # Thread ident -> read locks it holds
+        self._nreaders = 0
+        self._writer = None         # Ident of the thread holding the lock
+        self._write_waiters = 0
+        # Set while a thread acquires the process-level lock, during which
+        # the condition isn't held
+        self._busy = False
+
+    def _wait(self, predicate, deadline):
+        # Waits on the condition (which must be held) until *predicate* is
+        # true, returning False if *deadline* passes first
+        while not predicate():
+            if deadline is None:
+                self._cond.wait()
+            else:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _check_deadlock(self, ident, name, readers=False):
+        if self._writer == ident or (readers and ident in self._readers):
+            raise OSError(errno.EDEADLK, '{} failed {}'.format(
+                name, os.strerror(errno.EDEADLK)))
+
+    def _acquire_shared(self, method, deadline):
+        # Takes the process-level lock with the condition released, so
+        # other threads can check the state meanwhile. self._busy must have
+        # been set by the caller.
+        locker = getattr(self.lock, 'acquire_' + method)
+        self._cond.release()
+        try:
+            if deadline is None:
+                return locker()
+            return locker(timeout=max(0.0, deadline - monotonic()))
+        finally:
+            self._cond.acquire()
+            self._busy = False
+            self._cond.notify_all()
+
+    def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        ident = get_ident()
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            self._check_deadlock(ident, 'hybrid_rdlock')
+            if ident in self._readers:
+                # Recursive reads mustn't wait for writers, or they deadlock
+                ready = lambda: not self._busy
+            else:
+                ready = lambda: not (self._busy or self._write_waiters or
+                                     self._writer is not None)
+            if not self._wait(ready, deadline):
+                return False
+            if not self._nreaders:
+                self._busy = True
+                if not self._acquire_shared('read', deadline):
+                    return False
+            self._readers[ident] = self._readers.get(ident, 0) + 1
+            self._nreaders += 1
+            return True
+
+    def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        ident = get_ident()
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            # Waiting for our own read lock to go away would never end
+            self._check_deadlock(ident, 'hybrid_wrlock', readers=True)
+            self._write_waiters += 1
+            try:
+                if not self._wait(lambda: not (self._busy or self._nreaders or
+                                               self._writer is not None),
+                                  deadline):
+                    return False
+                self._busy = True
+            finally:
+                self._write_waiters -= 1
+                if not self._busy:
+                    # Timed out: readers may have been waiting for us
+                    self._cond.notify_all()
+            if not self._acquire_shared('write', deadline):
+                return False
+            self._writer = ident
+            return True
+
+    def try_acquire_read(self):
+        """Try to obtain a read lock, immediately returning True if
+        the lock is acquired; False otherwise.
+        """
+        ident = get_ident()
+        with self._cond:
+            if self._busy or self._writer is not None:
+                return False
+            if not self._nreaders and not self.lock.try_acquire_read():
+                return False
+            self._readers[ident] = self._readers.get(ident, 0) + 1
+            self._nreaders += 1
+            return True
+
+    def try_acquire_write(self):
+        """Try to obtain a write lock, returning True immediately if
+        the lock can be acquired; False otherwise.
+        """
+        with self._cond:
+            if self._busy or self._nreaders or self._writer is not None:
+                return False
+            if not self.lock.try_acquire_write():
+                return False
+            self._writer = get_ident()
+            return True
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        ident = get_ident()
+        with self._cond:
+            if self._writer == ident:
+                self.lock.release()
+                self._writer = None
+                self._cond.notify_all()
+            elif ident in self._readers:
+                if self._readers[ident] == 1:
+                    del self._readers[ident]
+                else:
+                    self._readers[ident] -= 1
+                self._nreaders -= 1
+                if not self._nreaders:
+                    self.lock.release()
+                    self._cond.notify_all()
+            else:
+                raise ValueError(
+                    'Tried to release a released lock'
+                )
+
+    @property
+    def nlocks(self):
+        """Number of locks held by the threads of this process"""
+        with self._cond:
+            return self._nreaders + (self._writer is not None)
+
+    def __getstate__(self):
+        return {'lock': self.lock}
+
+    def __setstate__(self, state):
+        self.__setup(state['lock'])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Loading of the C libraries prwlock calls into through ctypes.
+
+ctypes.util.find_library() looks libraries up by running ldconfig (or even
+a compiler), which takes longer than everything else importing prwlock does.
+Libraries are opened by their usual sonames instead, and only looked up when
+none of those works, at most once per process and library.
+"""
+
+import ctypes    # For opening the libraries
+
+_found = {}      # Results of find_library, by library name
+
+
+def find_library(name):
+    """Same as ctypes.util.find_library(), remembering its results"""
+    try:
+        return _found[name]
+    except KeyError:
+        pass
+    # ctypes.util is itself slow to import
+    from ctypes.util import find_library as _find_library
+    _found[name] = path = _find_library(name)
+    return path
+
+
+def load_library(sonames, name, library_class=ctypes.CDLL, **kwargs):
+    """Opens the first of *sonames* that can be opened, falling back to the
+    library find_library(*name*) finds. Keyword arguments are passed on to
+    *library_class*."""
+    for soname in sonames:
+        try:
+            return library_class(soname, **kwargs)
+        except OSError:
+            pass
+    return library_class(find_library(name), **kwargs)
+
+
+class Library(ctypes.CDLL):
+    """A library whose functions get the argument types and error checking
+    given by *signatures*, a sequence of (name, argtypes, error_check)
+    triples, when they are first looked up rather than all up front."""
+
+    def __init__(self, name, signatures=(), **kwargs):
+        self._signatures = dict((function, (argtypes, error_check))
+                                for function, argtypes, error_check
+                                in signatures)
+        ctypes.CDLL.__init__(self, name, **kwargs)
+
+    def __getattr__(self, name):
+        # Caches the function as an attribute, so this runs once per name
+        function = ctypes.CDLL.__getattr__(self, name)
+        if name in self._signatures:
+            argtypes, error_check = self._signatures[name]
+            function.argtypes = argtypes
+            if error_check:
+                function.errcheck = error_check
+        return function
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import zlib      # For hashing keys the same way in every process
+
+try:
+    # For sharing a single deadline among many acquisitions
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+
+def stable_hash(key):
+    """Hashes *key* consistently across processes.
+
+    The builtin hash() is salted per interpreter for strings, so processes
+    started with the spawn method would map the same key to different
+    stripes. Keys that aren't bytes or text are hashed through their repr,
+    so they should have a stable one (numbers and tuples of those do).
+    """
+    if not isinstance(key, bytes):
+        if not isinstance(key, type(u'')):
+            key = repr(key)
+        key = key.encode('utf-8')
+    return zlib.crc32(key) & 0xffffffff
+
+
+class LockTable(object):
+    """Maps an unbounded number of keys to a fixed set of rwlocks.
+
+    Keys are hashed to one of *stripes* process-shared locks living in an
+    RWLockArena, so concurrency grows with the key space while memory and
+    file descriptor usage stay constant. Keys that collide share a lock,
+    which is safe but may add some contention.
+    """
+
+    def __init__(self, stripes=64):
+        # Imported here to pick the arena flavor of the running platform
+        from . import RWLockArena
+        self.__setup(RWLockArena(stripes))
+
+    def __setup(self, arena):
+        self.arena = arena
+        self.stripes = len(arena)
+        self._locks = [arena[i] for i in range(self.stripes)]
+
+    def stripe(self, key):
+        """Returns the index of the lock that guards *key*"""
+        return stable_hash(key) % self.stripes
+
+    def lock_for(self, key):
+        """Returns the lock that guards *key*"""
+        return self._locks[self.stripe(key)]
+
+    def reader_lock(self, key, timeout=None):
+        return self.lock_for(key).reader_lock(timeout=timeout)
+
+    def writer_lock(self, key, timeout=None):
+        return self.lock_for(key).writer_lock(timeout=timeout)
+
+    def _locks_for(self, keys):
+        # Acquiring in stripe order is what makes multi-key acquisition
+        # deadlock-free. Keys that hash to the same stripe take it only once.
+        return [self._locks[i] for i in sorted(set(map(self.stripe, keys)))]
+
+    def acquire_many(self, keys, method='read', timeout=None):
+        """acquire_many(keys[, method='read'[, timeout=None]])
+
+        Locks every stripe guarding *keys* in *method* ('read' or 'write')
+        mode, returning True if all of them were acquired; False otherwise.
+        If provided, *timeout* bounds the time spent acquiring all locks.
+        On failure no lock is left held.
+        """
+        if method not in ['read', 'write']:
+            raise ValueError('acquire_many called with invalid method %s'
+                             % method)
+        deadline = None if timeout is None else monotonic() + timeout
+        acquired = []
+        for lock in self._locks_for(keys):
+            locker = getattr(lock, 'acquire_' + method)
+            if deadline is None:
+                ok = locker()
+            else:
+                ok = locker(timeout=max(0.0, deadline - monotonic()))
+            if not ok:
+                for held in reversed(acquired):
+                    held.release()
+                return False
+            acquired.append(lock)
+        return True
+
+    def release_many(self, keys):
+        """Releases the stripes previously locked by acquire_many(keys)"""
+        for lock in reversed(self._locks_for(keys)):
+            lock.release()
+
+    def reader_locks(self, keys, timeout=None):
+        return MultiLockContextManager(self, keys, 'read', timeout=timeout)
+
+    def writer_locks(self, keys, timeout=None):
+        return MultiLockContextManager(self, keys, 'write', timeout=timeout)
+
+    def __getstate__(self):
+        return {'arena': self.arena}
+
+    def __setstate__(self, state):
+        self.__setup(state['arena'])
+
+
+class MultiLockContextManager(object):
+    def __init__(self, table, keys, method, timeout=None):
+        self.table = table
+        self.keys = list(keys)
+        self.locked = False
+        self.method = method
+        self.timeout = timeout
+
+    def __enter__(self):
+        self.locked = self.table.acquire_many(self.keys, self.method,
+                                              timeout=self.timeout)
+        if not self.locked:
+            # Same as GenericLockContextManager: there is no way of entering
+            # the block without the locks, so fail loudly
+            raise ValueError('Unable to acquire locks in context manager')
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.locked:
+            self.table.release_many(self.keys)
+        self.locked = False
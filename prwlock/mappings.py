@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Mappings of the files backing shared locks, shared within a process.
+
+Every unpickled copy of a lock refers to the same backing file as the
+original. Rather than mapping the file once per copy, and closing its
+descriptor (or destroying the lock) whenever any copy goes away, objects
+attach to a per-process registry keyed by the identity of the file: the
+first one maps it, later ones reuse that mapping, and the last one to
+detach closes it.
+"""
+
+import os           # For identifying and closing backing files
+import mmap         # For mapping them
+import threading    # For guarding the registry
+
+_mappings = {}      # By (device, inode) of the backing file
+# Reentrant, since detaching happens in __del__, which the garbage collector
+# may run while the registry is being updated
+_mappings_lock = threading.RLock()
+
+
+class Mapping(object):
+    """A shared mapping of the file open as *fd*, along with the number of
+    objects of this process using it and the process that initialized the
+    objects living in it, if any did."""
+
+    def __init__(self, fd, length, key, creator=None):
+        self.buf = mmap.mmap(fd, length, mmap.MAP_SHARED)
+        self.fd = fd
+        self.key = key
+        self.creator = creator
+        self.refs = 0
+
+    def destroys(self):
+        """Whether the object about to detach from the mapping is the last
+        one of the process that initialized it, and so must destroy what it
+        initialized. Other processes and other copies never do."""
+        return self.refs == 1 and self.creator == os.getpid()
+
+    def close(self):
+        try:
+            self.buf.close()
+        except BufferError:
+            # Someone still holds a view of the mapping. It goes away along
+            # with the last of them.
+            pass
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+def attach(fd, length, created=False):
+    """Returns the Mapping of *length* bytes of the file open as *fd*,
+    reusing the one other objects of this process have if there's one.
+    *created* tells that the caller is about to initialize the file, making
+    this process the one to destroy what it holds.
+
+    The mapping takes over *fd*, which is closed along with the mapping, or
+    right away if the file is already mapped through another descriptor.
+    """
+    st = os.fstat(fd)
+    key = st.st_dev, st.st_ino
+    with _mappings_lock:
+        mapping = _mappings.get(key)
+        if mapping is None:
+            mapping = Mapping(fd, length, key,
+                              os.getpid() if created else None)
+            _mappings[key] = mapping
+        elif fd != mapping.fd:
+            os.close(fd)
+        if created:
+            mapping.creator = os.getpid()
+        mapping.refs += 1
+        return mapping
+
+
+def detach(mapping):
+    """Drops a reference to *mapping*, closing it with the last one"""
+    with _mappings_lock:
+        mapping.refs -= 1
+        if mapping.refs > 0:
+            return
+        if _mappings.get(mapping.key) is mapping:
+            del _mappings[mapping.key]
+    mapping.close()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os        # For identifying the memory backing a lock
+import errno     # For recognizing locks reclaimed from dead owners
+import time      # For backing off between attempts
+import random    # For spreading the retries of competing processes
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+METHODS = ('read', 'write')
+MIN_BACKOFF = 0.00001       # In seconds, as in prwlock.prwlock
+MAX_BACKOFF = 0.001
+
+# Acquisitions of robust locks reclaimed from a dead writer raise this, with
+# the lock held
+_EOWNERDEAD = getattr(errno, 'EOWNERDEAD', 130)
+
+
+def lock_order(lock):
+    """Returns the key *lock* is sorted by when acquiring several locks.
+
+    The key identifies the shared memory behind the lock, so every process
+    (and every copy of the lock, e.g. unpickled ones) orders the same locks
+    the same way. Locks without a backing file can only be ordered within
+    a process, and come last.
+    """
+    # HybridRWLocks wrap a process-shared lock, which is what's shared
+    inner = getattr(lock, 'lock', None)
+    if inner is not None:
+        lock = inner
+    arena = getattr(lock, 'arena', None)
+    if arena is not None:
+        fd, index = arena._fd, lock.index
+    else:
+        fd, index = getattr(lock, '_fd', None), 0
+    if fd is None:
+        return (1, 0, 0, id(lock))
+    st = os.fstat(fd)
+    return (0, st.st_dev, st.st_ino, index)
+
+
+def _canonical(requests):
+    # Sorts the (lock, method) pairs of *requests* by lock_order(), taking
+    # locks requested more than once a single time, in write mode if any of
+    # the requests is a write
+    by_key = {}
+    for lock, method in requests:
+        if method not in METHODS:
+            raise ValueError('acquire_all called with invalid method %s'
+                             % method)
+        key = lock_order(lock)
+        if key in by_key and by_key[key][1] == 'write':
+            continue
+        by_key[key] = (by_key[key][0] if key in by_key else lock, method)
+    return [by_key[key] for key in sorted(by_key)]
+
+
+class AcquiredLocks(object):
+    """The result of acquire_all(): true if the locks were acquired, in
+    which case release() releases all of them. Used as a context manager,
+    it fails like reader_lock() and writer_lock() if the locks couldn't be
+    acquired, and releases them at the end of the with block."""
+
+    def __init__(self, locks, locked=True):
+        self.locks = locks      # (lock, method) pairs, in acquisition order
+        self.locked = locked
+
+    def __bool__(self):
+        return self.locked
+
+    __nonzero__ = __bool__
+
+    def release(self):
+        """Releases every lock, in the reverse order of acquisition"""
+        if not self.locked:
+            raise ValueError('Tried to release released locks')
+        self.locked = False
+        for lock, method in reversed(self.locks):
+            lock.release()
+
+    def __enter__(self):
+        if not self.locked:
+            raise ValueError('Unable to acquire locks in context manager')
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.locked:
+            self.release()
+
+
+def _acquire(lock, method, deadline):
+    if deadline is None:
+        return getattr(lock, 'acquire_' + method)()
+    return getattr(lock, 'acquire_' + method)(
+        timeout=max(0.0, deadline - monotonic()))
+
+
+def _try_acquire(lock, method):
+    return getattr(lock, 'try_acquire_' + method)()
+
+
+def acquire_all(requests, timeout=None):
+    """acquire_all(requests[, timeout=None])
+
+    Acquires every lock of *requests*, a sequence of (lock, method) pairs
+    where method is 'read' or 'write', returning an AcquiredLocks object
+    that is true if all of them were acquired. If provided, *timeout* is
+    the number of seconds to wait for all the locks, not for each one.
+    On failure no lock is left held.
+
+    Locks are taken in a canonical order (see lock_order()), but only one
+    of them is ever waited for: the others are tried, and if one is busy,
+    everything is released and, after a randomized backoff, the attempt
+    starts over waiting for the busy lock. So processes acquiring
+    overlapping sets of locks can't deadlock, and they don't sit on locks
+    other processes need while waiting.
+    """
+    locks = _canonical(requests)
+    deadline = None if timeout is None else monotonic() + timeout
+    delay = MIN_BACKOFF
+    first = 0
+    while locks:
+        held = []
+        busy = None
+        try:
+            lock, method = locks[first]
+            try:
+                acquired = _acquire(lock, method, deadline)
+            except OSError as e:
+                if e.errno == _EOWNERDEAD:
+                    held.append(locks[first])
+                raise
+            if not acquired:
+                return AcquiredLocks([], locked=False)
+            held.append(locks[first])
+            for index, (lock, method) in enumerate(locks):
+                if index == first:
+                    continue
+                try:
+                    acquired = _try_acquire(lock, method)
+                except OSError as e:
+                    if e.errno == _EOWNERDEAD:
+                        held.append((lock, method))
+                    raise
+                if not acquired:
+                    busy = index
+                    break
+                held.append((lock, method))
+        except:
+            for lock, method in reversed(held):
+                lock.release()
+            raise
+        if busy is None:
+            return AcquiredLocks(held)
+        for lock, method in reversed(held):
+            lock.release()
+        if deadline is not None and monotonic() >= deadline:
+            return AcquiredLocks([], locked=False)
+        time.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, MAX_BACKOFF)
+        first = busy
+    return AcquiredLocks([])
@@ -2,39 +2,81 @@
 # -*- coding: utf-8 -*-
 
 import os        # For strerror
+import sys       # To figure which system we're running in
 import mmap      # For setting up a shared memory region
 import ctypes    # For doing the actual wrapping of librt & rwlock
-import platform  # To figure which architecture we're running in
-import tempfile  # To open a file to back our mmap
 import errno     # To interpret errors of pthread-method calls
+import struct    # For the header of named locks
+import threading # For the per-thread depth of reentrant locks
+import weakref   # To find the reentrant locks to reset in forked children
 
-from time import sleep  # Used by loop based acquire-lock timeouts
-from ctypes.util import find_library
+import time      # For clocks and sleeping in loop-based timeouts
 
-if platform.system() == 'Darwin':
-    librt = ctypes.CDLL(find_library('c'), use_errno=True)
+from .libraries import Library, load_library
+from .mappings import attach, detach
+
+try:
+    from time import monotonic  # To share a deadline among acquisitions
+except ImportError:
+    from time import time as monotonic
+
+try:
+    from time import monotonic_ns   # For lock statistics
+except ImportError:
+    def monotonic_ns():
+        return int(monotonic() * 1e9)
+
+try:
+    # For updating lock statistics from several processes
+    from . import atomics
+except ImportError:
+    atomics = None
+
+try:
+    # Named shared memory objects (shm_open), Python 3.8+
+    import _posixshmem
+except ImportError:
+    _posixshmem = None
+
+try:
+    # Setting PRWLOCK_NO_SPEEDUPS forces the pure ctypes implementation
+    if os.environ.get('PRWLOCK_NO_SPEEDUPS'):
+        raise ImportError('prwlock speedups disabled by the environment')
+    from ._speedups import RWLockCore, RWLockContext
+except ImportError:
+    RWLockCore = RWLockContext = None
+
+if sys.platform == 'darwin':
+    # Sonames of the library defining the functions we're wrapping, and its
+    # name for find_library
+    LIBRT = (('libc.dylib', '/usr/lib/libc.dylib'), 'c')
     PTHREAD_PROCESS_SHARED = 1
     pthread_rwlock_t = ctypes.c_byte * 200
     pthread_rwlockattr_t = ctypes.c_byte * 24
+    pthread_mutex_t = ctypes.c_byte * 64
+    pthread_mutexattr_t = ctypes.c_byte * 16
 else:
-    # Loads the library in which the functions we're wrapping are defined
-    librt = ctypes.CDLL(find_library('rt'), use_errno=True)
+    LIBRT = (('librt.so.1',), 'rt')
     pthread_rwlockattr_t = ctypes.c_byte * 8
-    if platform.system() == 'Linux':
+    pthread_mutexattr_t = ctypes.c_byte * 8
+    pthread_mutex_t = ctypes.c_byte * 8
+    if sys.platform.startswith('linux'):
         PTHREAD_PROCESS_SHARED = 1
-        if platform.architecture()[0] == '64bit':
+        # The size of pointers tells the ABI, without asking
+        # platform.architecture(), which may run file(1)
+        if ctypes.sizeof(ctypes.c_void_p) == 8:
             pthread_rwlock_t = ctypes.c_byte * 56
-        elif platform.architecture()[0] == '32bit':
-            pthread_rwlock_t = ctypes.c_byte * 32
+            pthread_mutex_t = ctypes.c_byte * 40
         else:
-            pthread_rwlock_t = ctypes.c_byte * 44
-    elif platform.system() == 'FreeBSD':
+            pthread_rwlock_t = ctypes.c_byte * 32
+            pthread_mutex_t = ctypes.c_byte * 24
+    elif sys.platform.startswith('freebsd'):
         PTHREAD_PROCESS_SHARED = 0
         pthread_rwlock_t = ctypes.c_byte * 8
-    elif platform.system() == 'OpenBSD':
+    elif sys.platform.startswith('openbsd'):
         PTHREAD_PROCESS_SHARED = 0
         pthread_rwlock_t = ctypes.c_byte * 8
-    elif platform.system().lower().startswith('cygwin'):
+    elif sys.platform.startswith('cygwin'):
         PTHREAD_PROCESS_SHARED = 0
         pthread_rwlock_t = ctypes.c_byte * 8
     else:
@@ -42,9 +84,19 @@ else:
 
 pthread_rwlockattr_t_p = ctypes.POINTER(pthread_rwlockattr_t)
 pthread_rwlock_t_p = ctypes.POINTER(pthread_rwlock_t)
+pthread_mutexattr_t_p = ctypes.POINTER(pthread_mutexattr_t)
+pthread_mutex_t_p = ctypes.POINTER(pthread_mutex_t)
 timespec_t_p = ctypes.c_void_p
 time_t = ctypes.c_long      # C's time_t type
-SHORT_SLEEP = 0.1           # Short sleep in seconds for loop-based timeout methods
+CLOCK_REALTIME = 0          # Clock of pthread_rwlock_timed*lock deadlines
+CLOCK_MONOTONIC = getattr(time, 'CLOCK_MONOTONIC', 1)
+# Loop-based timeout methods retry this many times right away, then this many
+# times after yielding the CPU, then sleep, doubling the sleep up to a maximum
+SPIN_TRIES = 64
+YIELD_TRIES = 16
+MIN_BACKOFF = 0.00001       # In seconds
+MAX_BACKOFF = 0.001
+CACHE_LINE = 64             # Alignment of the lock slots packed in an arena
 
 
 def default_error_check(result, func, arguments):
@@ -67,14 +119,73 @@ API = [
     ('pthread_rwlockattr_destroy', [pthread_rwlockattr_t_p], default_error_check),
     ('pthread_rwlockattr_init', [pthread_rwlockattr_t_p], default_error_check),
     ('pthread_rwlockattr_setpshared', [pthread_rwlockattr_t_p, ctypes.c_int], default_error_check),
+    ('pthread_rwlock_rdlock', [pthread_rwlock_t_p], default_error_check),
 ]
 
+# The functions below are missing on some systems. Their signatures only
+# apply where they exist, so code using them checks with hasattr(librt, ...)
+
 # Implementation of timed versions of pthread_rwlock_XXlock are optional
 # according to UNIX documentation. Some OSes do not implement it,
-# including Mac OS X. Hence, test if it is supported
-if hasattr(librt, 'pthread_rwlock_timedrdlock'):
-    API.append(('pthread_rwlock_timedrdlock', [pthread_rwlock_t_p, timespec_t_p], None))
-    API.append(('pthread_rwlock_timedwrlock', [pthread_rwlock_t_p, timespec_t_p], None))
+# including Mac OS X.
+API.append(('pthread_rwlock_timedrdlock', [pthread_rwlock_t_p, timespec_t_p], None))
+API.append(('pthread_rwlock_timedwrlock', [pthread_rwlock_t_p, timespec_t_p], None))
+
+# Deadlines measured against a monotonic clock are a newer addition
+# (POSIX 2024, glibc 2.30), which spares timed waits from clock changes
+API.append(('pthread_rwlock_clockrdlock', [pthread_rwlock_t_p, ctypes.c_int, timespec_t_p], None))
+API.append(('pthread_rwlock_clockwrlock', [pthread_rwlock_t_p, ctypes.c_int, timespec_t_p], None))
+
+API.append(('clock_gettime', [ctypes.c_int, timespec_t_p], default_error_check))
+
+# Choosing between reader and writer preference is a glibc extension
+API.append(('pthread_rwlockattr_setkind_np', [pthread_rwlockattr_t_p, ctypes.c_int], default_error_check))
+
+# Robust mutexes, which guard the owner tables of robust locks, are missing
+# on some systems, including Mac OS X. pthread_mutex_lock reports a dead
+# owner through its result, so it's checked by the caller.
+API.extend([
+    ('pthread_mutexattr_init', [pthread_mutexattr_t_p], default_error_check),
+    ('pthread_mutexattr_destroy', [pthread_mutexattr_t_p], default_error_check),
+    ('pthread_mutexattr_setpshared', [pthread_mutexattr_t_p, ctypes.c_int], default_error_check),
+    ('pthread_mutexattr_setrobust', [pthread_mutexattr_t_p, ctypes.c_int], default_error_check),
+    ('pthread_mutex_init', [pthread_mutex_t_p, pthread_mutexattr_t_p], default_error_check),
+    ('pthread_mutex_destroy', [pthread_mutex_t_p], default_error_check),
+    ('pthread_mutex_lock', [pthread_mutex_t_p], None),
+    ('pthread_mutex_unlock', [pthread_mutex_t_p], default_error_check),
+    ('pthread_mutex_consistent', [pthread_mutex_t_p], default_error_check),
+])
+
+# Anonymous memory-backed files, where os.memfd_create is missing
+API.append(('memfd_create', [ctypes.c_char_p, ctypes.c_uint], None))
+
+# Loads the library in which the functions we're wrapping are defined. They
+# get their argument types and error checking from API when first used.
+librt = load_library(LIBRT[0], LIBRT[1], library_class=Library,
+                     signatures=API, use_errno=True)
+
+PTHREAD_MUTEX_ROBUST = 1
+EOWNERDEAD = getattr(errno, 'EOWNERDEAD', 130)
+
+# How a process holds the upgrade lock of an upgradeable lock, besides
+# holding the lock itself in read or write mode
+HOLD_UPGRADEABLE = 1
+HOLD_UPGRADED = 2
+HOLD_WRITE = 3      # Must match _speedups.c
+
+# Scheduling policies of RWLockPosix
+PREFER_READER = 'prefer_reader'
+PREFER_WRITER = 'prefer_writer'
+FAIR = 'fair'
+POLICIES = (PREFER_READER, PREFER_WRITER, FAIR)
+
+# Values of the glibc rwlock kinds for each policy. Note glibc's
+# PTHREAD_RWLOCK_PREFER_WRITER_NP behaves like PREFER_READER, the
+# nonrecursive variant is the one that actually prefers writers.
+PTHREAD_RWLOCK_KINDS = {
+    PREFER_READER: 0,   # PTHREAD_RWLOCK_PREFER_READER_NP
+    PREFER_WRITER: 2,   # PTHREAD_RWLOCK_PREFER_WRITER_NONRECURSIVE_NP
+}
 
 
 def augment_function(library, name, argtypes, error_check=None):
@@ -84,11 +195,6 @@ def augment_function(library, name, argtypes, error_check=None):
         function.errcheck = error_check
 
 
-# At the global level we add argument types and error checking to the functions:
-for function, argtypes, error_check in API:
-    augment_function(librt, function, argtypes, error_check)
-
-
 # timespec struct from <time.h>
 class TimeSpec(ctypes.Structure):
     _fields_ = [
@@ -96,54 +202,1357 @@ class TimeSpec(ctypes.Structure):
         ("tv_nsec", ctypes.c_long) ]
 
 
-# Create timespec from seconds
-def get_timespec(seconds):
-    ts = TimeSpec(librt.time(None))
-    ts.tv_sec += int(seconds)
-    ts.tv_nsec += int((seconds - int(seconds)) * 1e+9)
+# Create a timespec holding the absolute time *seconds* from now on *clock*
+def get_timespec(seconds, clock=CLOCK_REALTIME):
+    ts = TimeSpec()
+    if hasattr(librt, 'clock_gettime'):
+        librt.clock_gettime(clock, ctypes.byref(ts))
+    else:
+        now = time.time()
+        ts.tv_sec = int(now)
+        ts.tv_nsec = int((now - int(now)) * 1e+9)
+    whole = int(seconds)
+    ts.tv_sec += whole
+    ts.tv_nsec += int((seconds - whole) * 1e+9)
+    # Both fields may have overflowed (or gone negative, for negative
+    # timeouts), and tv_nsec must stay within [0, 1e9) or it is rejected
+    carry, ts.tv_nsec = divmod(ts.tv_nsec, 1000000000)
+    ts.tv_sec += carry
     return ts
 
 
-class RWLockPosix(object):
+def poll(trylock, lock_p, seconds):
+    """Calls *trylock* on *lock_p* until it returns 0, for at most *seconds*.
+    Errors other than EBUSY and EAGAIN are raised as OSError. Returns
+    whether the lock was obtained."""
+    deadline = monotonic() + seconds
+    delay = MIN_BACKOFF
+    attempt = 0
+    while True:
+        result = trylock(lock_p)
+        if result == 0:
+            return True
+        elif result not in (errno.EBUSY, errno.EAGAIN):
+            raise OSError(result, '{} failed {}'.format(
+                trylock.__name__, os.strerror(result)))
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            return False
+        attempt += 1
+        if attempt < SPIN_TRIES:
+            continue
+        elif attempt < SPIN_TRIES + YIELD_TRIES:
+            time.sleep(0)
+        else:
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, MAX_BACKOFF)
+
+
+def align(size, alignment=CACHE_LINE):
+    """Rounds *size* up to the next multiple of *alignment*"""
+    return (size + alignment - 1) // alignment * alignment
+
+
+def _memfd_backing_file(size):
+    # An anonymous file living only in memory: no file system is involved,
+    # and there's nothing to unlink
+    if hasattr(os, 'memfd_create'):
+        fd = os.memfd_create('prwlock', MFD_CLOEXEC)
+    else:
+        fd = librt.memfd_create(b'prwlock', MFD_CLOEXEC)
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, 'memfd_create failed {}'.format(
+                os.strerror(error)))
+    return fd
+
+
+def _shm_backing_file(size):
+    # Same as the tempfile backend, but in the tmpfs shared memory objects
+    # live in, so creating the file doesn't reach any disk
+    return _tempfile_backing_file(size, SHM_DIR)
+
+
+def _tempfile_backing_file(size, dir=None):
+    # Create a temporary file with an actual file descriptor, so
+    # that child processes can receive the lock via apply from the
+    # multiprocessing module. tempfile is only imported when used, since
+    # importing it takes a while.
+    import tempfile
+    fd, name = tempfile.mkstemp(dir=dir)
+    try:
+        os.unlink(name)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+# Ways of creating the files that back shared mappings, by name
+BACKENDS = {
+    'memfd': _memfd_backing_file,
+    'shm': _shm_backing_file,
+    'tempfile': _tempfile_backing_file,
+}
+MFD_CLOEXEC = 1
+SHM_DIR = '/dev/shm'
+
+# Backends to try, cheapest first, when none is asked for. The first one
+# that works becomes the default.
+FALLBACK_BACKENDS = []
+if hasattr(os, 'memfd_create') or hasattr(librt, 'memfd_create'):
+    FALLBACK_BACKENDS.append('memfd')
+if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+    FALLBACK_BACKENDS.append('shm')
+FALLBACK_BACKENDS.append('tempfile')
+DEFAULT_BACKEND = None
+
+
+def _default_backing_file(size):
+    global DEFAULT_BACKEND
+    if DEFAULT_BACKEND is not None:
+        return BACKENDS[DEFAULT_BACKEND](size)
+    for backend in FALLBACK_BACKENDS:
+        try:
+            fd = BACKENDS[backend](size)
+        except OSError:
+            # E.g., memfd_create forbidden by a seccomp filter or /dev/shm
+            # full. The last backend gets to raise.
+            if backend == FALLBACK_BACKENDS[-1]:
+                raise
+            continue
+        DEFAULT_BACKEND = backend
+        return fd
+
+
+def create_backing_file(size, backend=None):
+    """Returns the descriptor of a zero-filled, already unlinked file of
+    *size* bytes that can back a shared mapping. *backend* names one of
+    BACKENDS, and defaults to the cheapest one that works on the system."""
+    if backend is None:
+        fd = _default_backing_file(size)
+    else:
+        fd = BACKENDS[backend](size)
+    try:
+        os.ftruncate(fd, size)
+    except:
+        os.close(fd)
+        raise
+    return fd
+
+
+# Number of buckets of the wait time histogram of lock_stats_t. Bucket 0
+# counts waits under 1us, bucket i waits in [2^(i-1), 2^i)us, and the last
+# one also counts everything longer.
+STATS_BUCKETS = 32
+
+
+class lock_stats_t(ctypes.Structure):
+    """Contention statistics of a lock, kept in its shared page. Must be
+    kept in sync with lock_stats_t in _speedups.c."""
+    _fields_ = [
+        ('reads', ctypes.c_uint64),
+        ('writes', ctypes.c_uint64),
+        ('contended', ctypes.c_uint64),
+        ('timeouts', ctypes.c_uint64),
+        ('wait_ns', ctypes.c_uint64),
+        ('wait_max_ns', ctypes.c_uint64),
+        ('hold_ns', ctypes.c_uint64),
+        ('hold_max_ns', ctypes.c_uint64),
+        ('wait_histogram', ctypes.c_uint64 * STATS_BUCKETS),
+    ]
+
+
+def _stats_address(stats, field, index=0):
+    return (ctypes.addressof(stats) + getattr(type(stats), field).offset +
+            index * ctypes.sizeof(ctypes.c_uint64))
+
+
+# Statistics are updated by every process using the lock, so updates are
+# atomic when libatomic is around. Otherwise, they may miss a few events.
+
+def stats_add(stats, field, value=1, index=None):
+    if atomics is not None:
+        atomics.fetch_add(_stats_address(stats, field, index or 0), value)
+    elif index is not None:
+        getattr(stats, field)[index] += value
+    else:
+        setattr(stats, field, getattr(stats, field) + value)
+
+
+def stats_max(stats, field, value):
+    if atomics is None:
+        setattr(stats, field, max(value, getattr(stats, field)))
+        return
+    address = _stats_address(stats, field)
+    current = atomics.load(address)
+    while value > current:
+        if atomics.compare_exchange(address, current, value):
+            break
+        current = atomics.load(address)
+
+
+def stats_acquired(stats, write, contended, wait):
+    """Accounts for an acquisition that waited *wait* nanoseconds"""
+    stats_add(stats, 'writes' if write else 'reads')
+    if contended:
+        stats_add(stats, 'contended')
+    stats_add(stats, 'wait_ns', wait)
+    stats_max(stats, 'wait_max_ns', wait)
+    bucket = min(STATS_BUCKETS - 1, (wait // 1000).bit_length())
+    stats_add(stats, 'wait_histogram', 1, bucket)
+
+
+class lock_spin_t(ctypes.Structure):
+    """Spinning state of an adaptive lock, kept in its shared page so every
+    process learns from the others. Must be kept in sync with lock_spin_t
+    in _speedups.c."""
+    _fields_ = [
+        ('budget_ns', ctypes.c_uint32),
+        ('reserved', ctypes.c_uint32),
+        ('spins', ctypes.c_uint64),
+        ('spin_acquired', ctypes.c_uint64),
+    ]
+
+
+# Adaptive locks spin at most this long, roughly the cost of going to sleep
+# and being woken up, and at least this long, to notice when holds get short
+MIN_SPIN_NS = 1000
+MAX_SPIN_NS = 50000
+# Processes sharing their CPUs with more runnable threads than they have
+# are better off not spinning at all
+SPIN_DISABLED = bool(os.environ.get('PRWLOCK_NO_SPIN'))
+
+
+def spin_learn(spin, sample):
+    """Moves the spin budget of an adaptive lock towards *sample*, a hold or
+    wait time in nanoseconds. Times too long to be worth spinning for pull
+    it towards 0."""
+    if sample > MAX_SPIN_NS:
+        sample = 0
+    budget = spin.budget_ns
+    spin.budget_ns = budget + int((sample - budget) / 8)
+
+
+# Bookkeeping of every reentrant lock of this process. Forked children
+# inherit the thread-local state of the thread that forked, but none of its
+# nesting is theirs.
+_reentrancies = weakref.WeakSet()
+
+
+def _reset_reentrancies():
+    for reentrancy in list(_reentrancies):
+        reentrancy.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_reentrancies)
+
+
+class Reentrancy(object):
+    """Per-thread bookkeeping of a reentrant lock.
+
+    instrument() wraps the lock methods so that only the outermost
+    acquisition and release of each thread reach the lock, while nested
+    ones just count in thread-local storage. Threads holding a write lock
+    may also take read locks, but readers can't take write locks, which
+    pthreads reports as a deadlock, or as a failure of try_acquire_write().
+    """
+
     def __init__(self):
+        self.clear()
+        _reentrancies.add(self)
+
+    def clear(self):
+        """Forgets the nesting of every thread"""
+        self.local = threading.local()
+
+    def instrument(self, methods):
+        """Returns reentrant versions of the lock *methods*, a dictionary
+        with the acquire_*, try_acquire_* and release methods of a lock"""
+        def acquirer(write, inner, trying=False):
+            def acquire(*args, **kwargs):
+                local = self.local
+                depth = getattr(local, 'depth', 0)
+                if depth:
+                    if write and not local.write:
+                        # Like pthread_rwlock_trywrlock(), which fails with
+                        # EBUSY rather than EDEADLK
+                        if trying:
+                            return False
+                        raise OSError(errno.EDEADLK, '{} failed {}'.format(
+                            'reentrant_wrlock', os.strerror(errno.EDEADLK)))
+                    local.depth = depth + 1
+                    return True
+                if not inner(*args, **kwargs):
+                    return False
+                local.depth, local.write = 1, write
+                return True
+            acquire.__doc__ = inner.__doc__
+            return acquire
+
+        release_lock = methods['release']
+
+        def release():
+            local = self.local
+            depth = getattr(local, 'depth', 0)
+            if depth > 1:
+                local.depth = depth - 1
+                return
+            # Locks this thread doesn't know about, e.g. those taken before
+            # pickling, are released as they are
+            release_lock()
+            if depth:
+                local.depth = 0
+        release.__doc__ = release_lock.__doc__
+
+        return {
+            'acquire_read': acquirer(False, methods['acquire_read']),
+            'acquire_write': acquirer(True, methods['acquire_write']),
+            'try_acquire_read': acquirer(False, methods['try_acquire_read'],
+                                         trying=True),
+            'try_acquire_write': acquirer(True, methods['try_acquire_write'],
+                                          trying=True),
+            'release': release,
+        }
+
+
+class CoreBound(object):
+    """Base for locks whose operations can be served by a compiled core.
+
+    When the accelerator provides ``core_class``, the public lock methods
+    are replaced per instance by those of a core object operating on the
+    same memory, which also keeps track of ``nlocks``. Otherwise the Python
+    methods of the subclass are used, and they keep track of ``_nlocks``.
+    Reentrancy and hooks, when set, wrap whichever methods are in use.
+    """
+    _core = None
+    _reentrancy = None
+    _nlocks = 0
+    core_class = None
+
+    # Methods served by the core when the accelerator is available
+    core_methods = ('acquire_read', 'acquire_write', 'try_acquire_read',
+                    'try_acquire_write', 'release')
+
+    _hooks = None
+
+    def _bind_core(self, *args):
+        if self.core_class is None:
+            self._bind_methods()
+            return
+        core = self.core_class(*args)
+        core.nlocks = self._nlocks
+        self._core = core
+        self._bind_methods()
+
+    def _unbind_core(self, detach=False):
+        # With *detach*, the core also lets go of the memory of the lock,
+        # which is about to be unmapped. Unless contexts or bound methods of
+        # the core are still around, in which case the memory stays mapped
+        # until they are gone, and False is returned.
+        core = self._core
+        if core is None:
+            return True
+        self._nlocks = core.nlocks
+        self._core = None
+        self._bind_methods()
+        # Our own reference, and the one of the call
+        if sys.getrefcount(core) > 2:
+            return False
+        if detach and hasattr(core, 'unbind'):
+            core.unbind()
+        return True
+
+    def _bind_methods(self):
+        # Binds the core's methods, if any, then reentrancy and the hooks
+        # around them. With none, the methods of the class are used as they
+        # are.
+        for name in self.core_methods:
+            self.__dict__.pop(name, None)
+        # The context managers cached by reader_lock() and writer_lock()
+        # may be bound to the methods being replaced
+        self.__dict__.pop('_reader_context', None)
+        self.__dict__.pop('_writer_context', None)
+        if self._core is not None:
+            for name in self.core_methods:
+                setattr(self, name, getattr(self._core, name))
+        if self._reentrancy is not None:
+            methods = dict((name, getattr(self, name))
+                           for name in self.core_methods)
+            for name, method in self._reentrancy.instrument(methods).items():
+                setattr(self, name, method)
+        if self._hooks is not None:
+            methods = dict((name, getattr(self, name))
+                           for name in self.core_methods)
+            for name, method in self._hooks.instrument(self, methods).items():
+                setattr(self, name, method)
+
+    def _context(self, write, view):
+        # Returns a compiled context manager for reader_lock() or
+        # writer_lock(), if the methods of the core are used as they are
+        core = self._core
+        if (RWLockContext is None or not isinstance(core, RWLockCore) or
+                self.__dict__.get('release') != core.release):
+            return None
+        return RWLockContext(core, write, view, self)
+
+    def set_hooks(self, hooks):
+        """Reports the events of this lock to *hooks*, a LockHooks, in this
+        process. set_hooks(None) removes them, after which lock operations
+        cost as much as if hooks had never been installed."""
+        self._hooks = hooks
+        self._bind_methods()
+
+    @property
+    def nlocks(self):
+        """Number of times the lock is held by this process"""
+        if self._core is not None:
+            return self._core.nlocks
+        return self._nlocks
+
+    @nlocks.setter
+    def nlocks(self, value):
+        if self._core is not None:
+            self._core.nlocks = value
+        else:
+            self._nlocks = value
+
+
+class _RWLockOps(CoreBound):
+    """Lock operations shared by everything that wraps a single
+    pthread_rwlock_t. Subclasses must provide ``_lock_p`` and call
+    ``_bind_core`` once the lock is mapped. The methods below are the ctypes
+    fallback of RWLockCore.
+    """
+    core_class = RWLockCore
+
+    def _pthread_timedrdlock(self, lock_p, seconds):
+        ts = get_timespec(seconds)
+        result = librt.pthread_rwlock_timedrdlock(lock_p, ctypes.byref(ts))
+        if result == errno.ETIMEDOUT:
+            return False
+        elif result != 0:
+            raise OSError(result, 'pthread_rwlock_timedrdlock failed {}'.format(
+                os.strerror(result)))
+        return True
+
+    def _pthread_timedwrlock(self, lock_p, seconds):
+        ts = get_timespec(seconds)
+        result = librt.pthread_rwlock_timedwrlock(lock_p, ctypes.byref(ts))
+        if result == errno.ETIMEDOUT:
+            return False
+        elif result != 0:
+            raise OSError(result, 'pthread_rwlock_timedwrlock failed {}'.format(
+                os.strerror(result)))
+        return True
+
+    def _clock_timedrdlock(self, lock_p, seconds):
+        ts = get_timespec(seconds, CLOCK_MONOTONIC)
+        result = librt.pthread_rwlock_clockrdlock(lock_p, CLOCK_MONOTONIC,
+                                                  ctypes.byref(ts))
+        if result == errno.ETIMEDOUT:
+            return False
+        elif result != 0:
+            raise OSError(result, 'pthread_rwlock_clockrdlock failed {}'.format(
+                os.strerror(result)))
+        return True
+
+    def _clock_timedwrlock(self, lock_p, seconds):
+        ts = get_timespec(seconds, CLOCK_MONOTONIC)
+        result = librt.pthread_rwlock_clockwrlock(lock_p, CLOCK_MONOTONIC,
+                                                  ctypes.byref(ts))
+        if result == errno.ETIMEDOUT:
+            return False
+        elif result != 0:
+            raise OSError(result, 'pthread_rwlock_clockwrlock failed {}'.format(
+                os.strerror(result)))
+        return True
+
+    def _loop_timedrdlock(self, lock_p, seconds):
+        return poll(librt.pthread_rwlock_tryrdlock, lock_p, seconds)
+
+    def _loop_timedwrlock(self, lock_p, seconds):
+        return poll(librt.pthread_rwlock_trywrlock, lock_p, seconds)
+
+    # Create links to methods that acquire locks considering timeouts
+    if hasattr(librt, 'pthread_rwlock_clockrdlock'):
+        _timed_wrlock = _clock_timedwrlock
+        _timed_rdlock = _clock_timedrdlock
+    elif hasattr(librt, 'pthread_rwlock_timedrdlock'):
+        _timed_wrlock = _pthread_timedwrlock
+        _timed_rdlock = _pthread_timedrdlock
+    else:
+        _timed_wrlock = _loop_timedwrlock
+        _timed_rdlock = _loop_timedrdlock
+
+    # Lock every acquirer has to go through first, when the policy asks for
+    # one. Holding it in write mode while waiting for the actual lock keeps
+    # new readers out, so writers can't be starved.
+    _turnstile_p = None
+
+    def _turnstile_acquire(self, write, timeout):
+        deadline = None if timeout is None else monotonic() + timeout
+        if timeout is None:
+            librt.pthread_rwlock_wrlock(self._turnstile_p)
+        elif not self._timed_wrlock(self._turnstile_p, timeout):
+            return False
+        if not write:
+            # Readers only pass through
+            librt.pthread_rwlock_unlock(self._turnstile_p)
+        try:
+            if deadline is None:
+                if write:
+                    librt.pthread_rwlock_wrlock(self._lock_p)
+                else:
+                    librt.pthread_rwlock_rdlock(self._lock_p)
+                return True
+            timed = self._timed_wrlock if write else self._timed_rdlock
+            return timed(self._lock_p, max(0.0, deadline - monotonic()))
+        finally:
+            if write:
+                librt.pthread_rwlock_unlock(self._turnstile_p)
+
+    def _turnstile_try(self, trylock):
+        if librt.pthread_rwlock_trywrlock(self._turnstile_p) != 0:
+            return False
+        try:
+            return trylock(self._lock_p) == 0
+        finally:
+            librt.pthread_rwlock_unlock(self._turnstile_p)
+
+    def _try_rwlock(self, write):
+        trylock = (librt.pthread_rwlock_trywrlock if write
+                   else librt.pthread_rwlock_tryrdlock)
+        if self._turnstile_p is not None:
+            return self._turnstile_try(trylock)
+        return trylock(self._lock_p) == 0
+
+    def _rwlock_until(self, write, timeout):
+        if self._turnstile_p is not None:
+            return self._turnstile_acquire(write, timeout)
+        elif timeout is None:
+            if write:
+                librt.pthread_rwlock_wrlock(self._lock_p)
+            else:
+                librt.pthread_rwlock_rdlock(self._lock_p)
+            return True
+        elif write:
+            return self._timed_wrlock(self._lock_p, timeout)
+        return self._timed_rdlock(self._lock_p, timeout)
+
+    # Lock that writers and upgradeable readers hold exclusively, for locks
+    # created upgradeable, how this process holds it (HOLD_*) and the value
+    # of nlocks once the acquisition that took it was accounted for
+    _upgrade_p = None
+    _mode = 0
+    _mode_depth = 0
+
+    def _trylock(self, write):
+        if not write or self._upgrade_p is None:
+            return self._try_rwlock(write)
+        if librt.pthread_rwlock_trywrlock(self._upgrade_p) != 0:
+            return False
+        if not self._try_rwlock(True):
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+            return False
+        self._mode = HOLD_WRITE
+        self._mode_depth = self._nlocks + 1
+        return True
+
+    def _lock_until(self, write, timeout):
+        if self._spin is not None:
+            deadline = None if timeout is None else monotonic() + timeout
+            if self._spin_lock(write, timeout):
+                return True
+            if deadline is not None:
+                timeout = max(0.0, deadline - monotonic())
+        if not write or self._upgrade_p is None:
+            return self._rwlock_until(write, timeout)
+        deadline = None if timeout is None else monotonic() + timeout
+        if not self._upgrade_lock(timeout):
+            return False
+        try:
+            acquired = self._rwlock_until(
+                True, None if deadline is None else
+                max(0.0, deadline - monotonic()))
+        except:
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+            raise
+        if not acquired:
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+            return False
+        self._mode = HOLD_WRITE
+        self._mode_depth = self._nlocks + 1
+        return True
+
+    def _upgrade_lock(self, timeout):
+        if timeout is None:
+            librt.pthread_rwlock_wrlock(self._upgrade_p)
+            return True
+        return self._timed_wrlock(self._upgrade_p, timeout)
+
+    # Spinning state of adaptive locks, kept in shared memory, and when this
+    # process took the lock
+    _spin = None
+    _spin_since = 0
+
+    def _spin_lock(self, write, timeout):
+        # Tries the lock, and if it's busy, keeps trying for a while before
+        # blocking, for about as long as its recent holders kept it
+        if self._trylock(write):
+            return True
+        spin = self._spin
+        limit = min(2 * spin.budget_ns + MIN_SPIN_NS, MAX_SPIN_NS)
+        if timeout is not None:
+            limit = min(limit, timeout * 1e9)
+        stats_add(spin, 'spins')
+        start = monotonic_ns()
+        attempt = 0
+        while True:
+            attempt += 1
+            if attempt % SPIN_TRIES == 0:
+                time.sleep(0)
+            acquired = self._trylock(write)
+            elapsed = monotonic_ns() - start
+            if acquired:
+                stats_add(spin, 'spin_acquired')
+                spin_learn(spin, elapsed)
+                return True
+            if elapsed >= limit:
+                return False
+
+    def _acquired(self):
+        # Accounts for a successful acquisition
+        if self._spin is not None and self._nlocks == 0:
+            self._spin_since = monotonic_ns()
+        self._nlocks += 1
+
+    # Contention statistics, kept in shared memory when enabled
+    _stats = None
+
+    def _counted_acquire(self, write, timeout):
+        stats = self._stats
+        if self._trylock(write):
+            wait, contended = 0, False
+        else:
+            start = monotonic_ns()
+            if not self._lock_until(write, timeout):
+                stats_add(stats, 'contended')
+                stats_add(stats, 'timeouts')
+                return False
+            wait, contended = monotonic_ns() - start, True
+        stats_acquired(stats, write, contended, wait)
+        if self._nlocks == 0:
+            self._hold_start = monotonic_ns()
+        self._acquired()
+        return True
+
+    def _counted_try(self, write):
+        if not self._trylock(write):
+            stats_add(self._stats, 'contended')
+            return False
+        stats_acquired(self._stats, write, False, 0)
+        if self._nlocks == 0:
+            self._hold_start = monotonic_ns()
+        self._acquired()
+        return True
+
+    def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        if self._stats is not None:
+            return self._counted_acquire(False, timeout)
+        if not self._lock_until(False, timeout):
+            return False
+        self._acquired()
+        return True
+
+    def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        if self._stats is not None:
+            return self._counted_acquire(True, timeout)
+        if not self._lock_until(True, timeout):
+            return False
+        self._acquired()
+        return True
+
+    def try_acquire_read(self):
+        """Try to obtain a read lock, immediately returning True if
+        the lock is acquired; False otherwise.
+        """
+        if self._stats is not None:
+            return self._counted_try(False)
+        if self._trylock(False):
+            self._acquired()
+            return True
+        else:
+            return False
+
+    def try_acquire_write(self):
+        """Try to obtain a write lock, returning True immediately if
+        the lock can be acquired; False otherwise.
+        """
+        if self._stats is not None:
+            return self._counted_try(True)
+        if self._trylock(True):
+            self._acquired()
+            return True
+        else:
+            return False
+
+    def _unlock(self):
+        librt.pthread_rwlock_unlock(self._lock_p)
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        if self._nlocks == 0:
+            raise ValueError(
+                'Tried to release a released lock'
+            )
+        self._unlock()
+        self._nlocks -= 1
+        if self._mode and self._nlocks < self._mode_depth:
+            # Taken along with the lock just released
+            self._mode = 0
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+        if self._stats is not None and self._nlocks == 0:
+            held = monotonic_ns() - self._hold_start
+            stats_add(self._stats, 'hold_ns', held)
+            stats_max(self._stats, 'hold_max_ns', held)
+        if self._spin is not None and self._nlocks == 0:
+            spin_learn(self._spin, monotonic_ns() - self._spin_since)
+
+    @property
+    def _hold(self):
+        if self._core is not None:
+            return self._core.mode
+        return self._mode
+
+    @_hold.setter
+    def _hold(self, value):
+        if self._core is not None:
+            self._core.mode = value
+        else:
+            self._mode = value
+
+    @property
+    def _hold_depth(self):
+        if self._core is not None:
+            return self._core.mode_depth
+        return self._mode_depth
+
+    @_hold_depth.setter
+    def _hold_depth(self, value):
+        if self._core is not None:
+            self._core.mode_depth = value
+        else:
+            self._mode_depth = value
+
+    def _check_upgradeable(self):
+        if self._upgrade_p is None:
+            raise ValueError('The lock was not created upgradeable')
+
+    def acquire_upgradeable(self, timeout=None):
+        """acquire_upgradeable([timeout=None])
+
+        Request an upgradeable read lock, which coexists with plain read
+        locks but not with writers or other upgradeable locks, and which
+        can be turned into a write lock with upgrade(). Returns True if the
+        lock is acquired; False otherwise. If provided, *timeout* specifies
+        the number of seconds to wait for the lock before cancelling and
+        returning False.
+        """
+        self._check_upgradeable()
+        deadline = None if timeout is None else monotonic() + timeout
+        if not self._upgrade_lock(timeout):
+            return False
+        try:
+            acquired = self.acquire_read(
+                None if deadline is None else
+                max(0.0, deadline - monotonic()))
+        except:
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+            raise
+        if not acquired:
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+            return False
+        self._hold = HOLD_UPGRADEABLE
+        self._hold_depth = self.nlocks
+        return True
+
+    def upgrade(self, timeout=None):
+        """upgrade([timeout=None])
+
+        Turns an upgradeable read lock into a write lock, waiting for other
+        readers to be done. No writer can take the lock in between, so what
+        was read under the upgradeable lock still holds. Returns True if
+        the lock was upgraded; False if *timeout* seconds passed first, in
+        which case the upgradeable lock is still held.
+        """
+        self._check_upgradeable()
+        if self._hold != HOLD_UPGRADEABLE:
+            raise ValueError('Only upgradeable locks can be upgraded')
+        if self.nlocks != self._hold_depth or self.nlocks > 1:
+            # Our own read locks would never be done
+            raise OSError(errno.EDEADLK, 'upgrade failed {}'.format(
+                os.strerror(errno.EDEADLK)))
+        librt.pthread_rwlock_unlock(self._lock_p)
+        try:
+            upgraded = self._rwlock_until(True, timeout)
+        except:
+            librt.pthread_rwlock_rdlock(self._lock_p)
+            raise
+        if not upgraded:
+            # Doesn't wait: writers are kept out by the upgrade lock
+            librt.pthread_rwlock_rdlock(self._lock_p)
+            return False
+        self._hold = HOLD_UPGRADED
+        return True
+
+    def downgrade(self):
+        """Turns a write lock into a read lock without letting any writer
+        in between. An upgraded lock goes back to being upgradeable."""
+        self._check_upgradeable()
+        hold = self._hold
+        if hold not in (HOLD_UPGRADED, HOLD_WRITE):
+            raise ValueError('Only write locks can be downgraded')
+        librt.pthread_rwlock_unlock(self._lock_p)
+        # Doesn't wait either, since we still hold the upgrade lock
+        librt.pthread_rwlock_rdlock(self._lock_p)
+        if hold == HOLD_UPGRADED:
+            self._hold = HOLD_UPGRADEABLE
+        else:
+            self._hold = 0
+            librt.pthread_rwlock_unlock(self._upgrade_p)
+
+
+# Number of processes that can hold a robust lock in read mode at once
+READER_SLOTS = 128
+# Seconds between checks for dead owners while waiting for a robust lock
+OWNER_CHECK_INTERVAL = 0.05
+
+
+class lock_reader_t(ctypes.Structure):
+    _fields_ = [
+        ('pid', ctypes.c_int32),
+        ('count', ctypes.c_uint32),     # Read locks held by the process
+    ]
+
+
+class lock_owners_t(ctypes.Structure):
+    """Processes holding a robust lock, kept in its shared page. A process
+    that died holding the lock is still listed, which is how it's found."""
+    _fields_ = [
+        ('mutex', pthread_mutex_t),     # Robust, guards everything else
+        ('writer', ctypes.c_int32),
+        ('dead_writer', ctypes.c_int32),    # Not reported yet
+        ('readers', lock_reader_t * READER_SLOTS),
+    ]
+
+
+class OwnerDeadError(OSError):
+    """Raised by the acquisition of a robust lock that was reclaimed from a
+    process that died holding it in write mode. Like EOWNERDEAD from a
+    robust mutex, it means the lock *was acquired*, and that the data it
+    protects may be inconsistent. *pid* is the process that died."""
+
+    def __init__(self, pid):
+        OSError.__init__(self, EOWNERDEAD,
+                         'Lock owner {} died holding the lock'.format(pid))
+        self.pid = pid
+
+
+def is_alive(pid):
+    """Returns whether process *pid* is still running. Zombies, which have
+    exited but weren't waited for yet, count as dead."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return False
+        # EPERM: the process belongs to someone else, but it exists
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            stat = f.read()
+    except (IOError, OSError):
+        return True
+    # The command name, in parentheses, may contain anything
+    return stat[stat.rfind(')') + 2:][:1] != 'Z'
+
+
+class RobustCore(_RWLockOps):
+    """Operations of robust RWLockPosix locks.
+
+    Processes take the lock with try-locks only, while holding the robust
+    mutex of the owner table, and record themselves in the table while
+    holding the lock. Since nobody ever sleeps inside the pthread lock and
+    no lock operation can be half-done by a live process, a lock that can't
+    be acquired while every process the table lists is dead can only be
+    held by dead processes. Waiters that find it so reinitialize it, and
+    the next process acquiring it is told with an OwnerDeadError if a
+    writer was among the dead.
+    """
+    core_class = None
+
+    def __init__(self, lock, lockattr, owners, stats=None):
+        self._lock_p = ctypes.byref(lock)
+        self._lockattr_p = ctypes.byref(lockattr)
+        self._owners = owners
+        self._mutex_p = ctypes.byref(owners.mutex)
+        self._stats = stats
+        self._slot = 0      # Where this process last recorded its reads
+
+    def _lock_owners(self):
+        """Locks the owner table, returning whether a process died holding
+        it, in which case the table may list it by mistake"""
+        result = librt.pthread_mutex_lock(self._mutex_p)
+        if result == EOWNERDEAD:
+            librt.pthread_mutex_consistent(self._mutex_p)
+            return True
+        elif result != 0:
+            raise OSError(result, 'pthread_mutex_lock failed {}'.format(
+                os.strerror(result)))
+        return False
+
+    def _reader_slot(self, pid):
+        readers = self._owners.readers
+        if readers[self._slot].pid in (0, pid):
+            return self._slot
+        for index in range(READER_SLOTS):
+            if readers[index].pid == 0:
+                self._slot = index
+                return index
+        return None
+
+    def _reclaim(self):
+        """Forgets dead owners, reinitializing the lock if nobody else holds
+        it. Returns whether it was reinitialized."""
+        owners = self._owners
+        alive = False
+        if owners.writer:
+            if is_alive(owners.writer):
+                alive = True
+            else:
+                owners.dead_writer = owners.writer
+                owners.writer = 0
+        for reader in owners.readers:
+            if reader.pid:
+                if is_alive(reader.pid):
+                    alive = True
+                else:
+                    reader.pid, reader.count = 0, 0
+        if alive:
+            return False
+        librt.pthread_rwlock_init(self._lock_p, self._lockattr_p)
+        return True
+
+    def _attempt(self, write, check_owners):
+        # Tries to take the lock. Dead owners are looked for when asked to,
+        # or when the owner table itself was left behind by a dead process.
+        owners = self._owners
+        pid = os.getpid()
+        died = self._lock_owners()
+        try:
+            for retry in (False, True):
+                slot = None if write else self._reader_slot(pid)
+                if write or slot is not None:
+                    if self._try_rwlock(write):
+                        break
+                if retry or not (check_owners or died) or not self._reclaim():
+                    return False
+            if write:
+                owners.writer = pid
+            else:
+                owners.readers[slot].pid = pid
+                owners.readers[slot].count += 1
+            self._dead_writer = owners.dead_writer
+            owners.dead_writer = 0
+            return True
+        finally:
+            librt.pthread_mutex_unlock(self._mutex_p)
+
+    def _trylock(self, write):
+        return self._attempt(write, False)
+
+    def _lock_until(self, write, timeout):
+        if self._attempt(write, False):
+            return True
+        pid = os.getpid()
+        owners = self._owners
+        if owners.writer == pid or (write and any(
+                reader.pid == pid for reader in owners.readers)):
+            # Waiting for ourselves would never end
+            raise OSError(errno.EDEADLK, 'robust_{}lock failed {}'.format(
+                'wr' if write else 'rd', os.strerror(errno.EDEADLK)))
+        next_check = [monotonic() + OWNER_CHECK_INTERVAL]
+
+        def attempt(lock_p):
+            now = monotonic()
+            check = now >= next_check[0]
+            if check:
+                next_check[0] = now + OWNER_CHECK_INTERVAL
+            return 0 if self._attempt(write, check) else errno.EBUSY
+        attempt.__name__ = 'robust_lock'
+        return poll(attempt, self._lock_p,
+                    float('inf') if timeout is None else timeout)
+
+    def _unlock(self):
+        owners = self._owners
+        pid = os.getpid()
+        self._lock_owners()
+        try:
+            librt.pthread_rwlock_unlock(self._lock_p)
+            if owners.writer == pid:
+                owners.writer = 0
+            else:
+                reader = owners.readers[self._slot]
+                reader.count -= 1
+                if reader.count == 0:
+                    reader.pid = 0
+        finally:
+            librt.pthread_mutex_unlock(self._mutex_p)
+
+    _dead_writer = 0
+
+    def _report(self, acquired):
+        if acquired and self._dead_writer:
+            pid, self._dead_writer = self._dead_writer, 0
+            raise OwnerDeadError(pid)
+        return acquired
+
+    def acquire_read(self, timeout=None):
+        return self._report(_RWLockOps.acquire_read(self, timeout))
+
+    def acquire_write(self, timeout=None):
+        return self._report(_RWLockOps.acquire_write(self, timeout))
+
+    def try_acquire_read(self):
+        return self._report(_RWLockOps.try_acquire_read(self))
+
+    def try_acquire_write(self):
+        return self._report(_RWLockOps.try_acquire_write(self))
+
+
+# Layout of the page backing an RWLockPosix, after the lock and its
+# attributes. Each additional structure starts on its own cache line.
+TURNSTILE_OFFSET = align(ctypes.sizeof(pthread_rwlock_t) +
+                         ctypes.sizeof(pthread_rwlockattr_t))
+HEADER_OFFSET = align(TURNSTILE_OFFSET + ctypes.sizeof(pthread_rwlock_t))
+
+# Header of named locks: a magic word, written once everything else is
+# initialized, the policy the lock was created with, flags and the size of
+# the data region
+HEADER = struct.Struct('=IIII')
+HEADER_MAGIC = 0x6b6c7770   # 'pwlk'
+HEADER_POLICIES = (None, PREFER_READER, PREFER_WRITER, FAIR)
+HEADER_STATS = 1            # Flag of locks keeping statistics
+HEADER_ROBUST = 2           # Flag of robust locks
+HEADER_UPGRADEABLE = 4      # Flag of upgradeable locks
+HEADER_ADAPTIVE = 8         # Flag of adaptive locks
+# The spinning state fits in the rest of the header's cache line, which
+# keeps the data region where locks created before it expect it
+SPIN_OFFSET = HEADER_OFFSET + HEADER.size
+STATS_OFFSET = align(HEADER_OFFSET + HEADER.size)
+assert SPIN_OFFSET + ctypes.sizeof(lock_spin_t) <= STATS_OFFSET
+OWNERS_OFFSET = align(STATS_OFFSET + ctypes.sizeof(lock_stats_t))
+UPGRADE_OFFSET = align(OWNERS_OFFSET + ctypes.sizeof(lock_owners_t))
+DATA_OFFSET = align(UPGRADE_OFFSET + ctypes.sizeof(pthread_rwlock_t))
+NAME_PREFIX = 'prwlock.'    # Of the shared memory objects of named locks
+INIT_TIMEOUT = 5.0          # Seconds to wait for a named lock's creator
+SHM_MODE = 0o600            # Permissions of the objects of named locks
+
+
+def _shm_open(name, flags, mode):
+    if _posixshmem is not None:
+        return _posixshmem.shm_open('/' + name, flags, mode)
+    return os.open(os.path.join(SHM_DIR, name), flags, mode)
+
+
+def _shm_unlink(name):
+    if _posixshmem is not None:
+        _posixshmem.shm_unlink('/' + name)
+    else:
+        os.unlink(os.path.join(SHM_DIR, name))
+
+
+def _shm_name(name):
+    if not name or '/' in name or '\0' in name:
+        raise ValueError('Invalid lock name %r' % (name,))
+    return NAME_PREFIX + name
+
+
+def _wait_initialized(fd, name):
+    """Waits for the creator of the named lock behind *fd* to finish setting
+    it up, returning its policy, flags and data size"""
+    deadline = monotonic() + INIT_TIMEOUT
+    delay = MIN_BACKOFF
+    while True:
+        # Reading (rather than mapping) the header is cheaper, and can't
+        # crash when the creator hasn't sized the file yet
+        if hasattr(os, 'pread'):
+            data = os.pread(fd, HEADER.size, HEADER_OFFSET)
+        else:
+            os.lseek(fd, HEADER_OFFSET, os.SEEK_SET)
+            data = os.read(fd, HEADER.size)
+        if len(data) == HEADER.size:
+            magic, policy, flags, data_size = HEADER.unpack(data)
+            if magic == HEADER_MAGIC:
+                return HEADER_POLICIES[policy], flags, data_size
+        if monotonic() >= deadline:
+            raise OSError(errno.ETIMEDOUT,
+                          'Named lock {!r} was never initialized'.format(name))
+        time.sleep(delay)
+        delay = min(delay * 2, MAX_BACKOFF)
+
+
+def _check_options(policy, robust, upgradeable, data_size=0, adaptive=False):
+    if data_size < 0:
+        raise ValueError('data_size must not be negative')
+    if policy is not None and policy not in POLICIES:
+        raise ValueError('Unknown rwlock policy %r' % (policy,))
+    if robust:
+        if not hasattr(librt, 'pthread_mutex_consistent'):
+            raise NotImplementedError('Robust locks need robust mutexes')
+        if policy is not None:
+            raise ValueError('Robust locks do not support policies')
+        if upgradeable:
+            raise ValueError('Robust locks can not be upgradeable')
+        if adaptive:
+            raise ValueError('Robust locks can not be adaptive')
+
+
+def _init_robust_mutex(mutex):
+    # Like the attributes of arena slots, these are only needed to
+    # initialize the mutex
+    attr = pthread_mutexattr_t()
+    attr_p = ctypes.byref(attr)
+    librt.pthread_mutexattr_init(attr_p)
+    try:
+        librt.pthread_mutexattr_setpshared(attr_p, PTHREAD_PROCESS_SHARED)
+        librt.pthread_mutexattr_setrobust(attr_p, PTHREAD_MUTEX_ROBUST)
+        librt.pthread_mutex_init(ctypes.byref(mutex), attr_p)
+    finally:
+        librt.pthread_mutexattr_destroy(attr_p)
+
+
+class RWLockPosix(_RWLockOps):
+    """A process-shared reader-writer lock built on pthread_rwlock_t.
+
+    *policy* chooses who goes first when readers and writers compete for the
+    lock: PREFER_READER ('prefer_reader') lets readers in as long as the
+    lock is read-locked, which may starve writers; PREFER_WRITER
+    ('prefer_writer') and FAIR ('fair') keep new readers out while a writer
+    waits. The default (None) is whatever the system does, which is
+    PREFER_READER on glibc. PREFER_WRITER is native on glibc. FAIR, and
+    PREFER_WRITER elsewhere, go through a second lock (a turnstile) that
+    writers hold while waiting, so that FAIR queues writers behind a waiting
+    writer too. Acquirers waiting at the turnstile are woken in whatever
+    order the system picks, not necessarily in order of arrival. With any
+    policy other than PREFER_READER, taking a read lock recursively can
+    deadlock if a writer is waiting.
+
+    Locks are anonymous unless created with RWLock.open(), in which case
+    other processes can attach to them by name.
+
+    With *stats* set, every process using the lock keeps contention
+    statistics in the lock's shared page, see stats().
+
+    With *robust* set, the lock survives processes that die holding it:
+    holders are listed in the lock's shared page, and processes waiting for
+    the lock reclaim it once they find that all of its holders are dead. An
+    acquisition of a lock reclaimed from a dead writer raises
+    OwnerDeadError, having acquired the lock. Robust locks are taken by
+    polling, so they don't support policies, and at most READER_SLOTS
+    processes can hold one in read mode at the same time.
+
+    With *upgradeable* set, the lock can also be taken in upgradeable read
+    mode, see acquire_upgradeable(), and write locks can be downgraded.
+    Writers of such locks go through a second lock, which upgradeable
+    readers hold while they read.
+
+    With a positive *data_size*, that many bytes are mapped right after the
+    lock state and shared along with the lock, as the writable memoryview
+    *buffer* (None otherwise). reader_lock() and writer_lock() yield a
+    read-only and a writable view of it, respectively.
+
+    With *reentrant* set, threads holding the lock can acquire it again, in
+    read mode or in the mode they hold it in. Nested acquisitions and
+    releases are counted per thread and never reach the shared lock, so
+    they can't deadlock behind a waiting writer; nlocks only counts the
+    outermost ones. Reentrancy is a property of the lock object in this
+    process, not of the shared lock.
+
+    With *adaptive* set, acquisitions that find the lock busy try it again
+    for a while before blocking, for about as long as the lock has recently
+    been held, as learned by every process using it. Processes started with
+    PRWLOCK_NO_SPIN set in their environment never spin, which is better on
+    hosts with more busy processes than CPUs.
+    """
+    name = None     # Of named locks only
+    robust = False
+    upgradeable = False
+    adaptive = False
+    data_size = 0
+    buffer = None
+    _destroys = False   # Whether going away destroys the shared lock
+
+    def __init__(self, policy=None, stats=False, robust=False,
+                 upgradeable=False, data_size=0, reentrant=False,
+                 adaptive=False):
+        _check_options(policy, robust, upgradeable, data_size, adaptive)
+        self.policy = policy
+        self.keep_stats = bool(stats)
+        self.robust = bool(robust)
+        self.upgradeable = bool(upgradeable)
+        self.adaptive = bool(adaptive)
+        self.data_size = int(data_size)
+        self._set_reentrant(reentrant)
         self.__setup(None)
         # Note we don't have to lock accesses to self.nlocks, since RWLocks are
         # supposed to be used only for coordinating multiple *processes*. In
         # which case each process will have its own private copy of the RWLock.
+        # Threads sharing a lock should go through a HybridRWLock instead.
         self.nlocks = 0
         self.pid = os.getpid()
 
-        # Create links to methods that acquire locks considering timeouts
-        if hasattr(librt, 'pthread_rwlock_timedrdlock'):
-            self._timed_wrlock = self._pthread_timedwrlock
-            self._timed_rdlock = self._pthread_timedrdlock
-        else:
-            self._timed_wrlock = self._loop_timedwrlock
-            self._timed_rdlock = self._loop_timedrdlock
+    @classmethod
+    def open(cls, name, create=True, policy=None, mode=SHM_MODE,
+             stats=False, robust=False, upgradeable=False, data_size=0,
+             reentrant=False, adaptive=False):
+        """open(name[, create=True[, policy=None[, mode=0o600[, stats=False[, robust=False[, upgradeable=False[, data_size=0[, reentrant=False[, adaptive=False]]]]]]]]])
+
+        Returns the lock called *name*, which any process can open, creating
+        it if it doesn't exist yet and *create* is true. Named locks live in
+        shared memory (/dev/shm on Linux) until removed with unlink(), and
+        are pickled by name, so they can be passed to processes that didn't
+        inherit them. *policy*, *stats*, *robust*, *upgradeable*,
+        *data_size* and *adaptive* only apply to a lock being created; when
+        attaching, the lock keeps the settings it was created with.
+        *reentrant* applies to the returned object in any case.
+        """
+        _check_options(policy, robust, upgradeable, data_size, adaptive)
+        self = cls.__new__(cls)
+        self.name = name
+        self.policy = policy
+        self.keep_stats = bool(stats)
+        self.robust = bool(robust)
+        self.upgradeable = bool(upgradeable)
+        self.adaptive = bool(adaptive)
+        self.data_size = int(data_size)
+        self._set_reentrant(reentrant)
+        self.__open(create, mode)
+        self.nlocks = 0
+        self.pid = os.getpid()
+        return self
+
+    def __open(self, create, mode=SHM_MODE):
+        shm_name = _shm_name(self.name)
+        fd, created = None, False
+        try:
+            if create:
+                # Exactly one process wins the race to create the object,
+                # and it is the one initializing the lock
+                try:
+                    fd = _shm_open(shm_name, os.O_RDWR | os.O_CREAT |
+                                   os.O_EXCL, mode)
+                    created = True
+                except OSError as e:
+                    if e.errno != errno.EEXIST:
+                        raise
+            if fd is None:
+                fd = _shm_open(shm_name, os.O_RDWR, 0)
+            if created:
+                os.ftruncate(fd, self._length())
+            else:
+                self.policy, flags, self.data_size = _wait_initialized(
+                    fd, self.name)
+                self.keep_stats = bool(flags & HEADER_STATS)
+                self.robust = bool(flags & HEADER_ROBUST)
+                self.upgradeable = bool(flags & HEADER_UPGRADEABLE)
+                self.adaptive = bool(flags & HEADER_ADAPTIVE)
+        except:
+            if fd is not None:
+                os.close(fd)
+            if created:
+                _shm_unlink(shm_name)
+            raise
+        try:
+            self.__setup(fd, initialize=created)
+        except:
+            if created:
+                _shm_unlink(shm_name)
+            raise
+        if created:
+            # Everything else must be in place before the magic word is
+            # visible to processes attaching to the lock
+            struct.pack_into('=III', self._buf, HEADER_OFFSET + 4,
+                             HEADER_POLICIES.index(self.policy),
+                             (HEADER_STATS if self.keep_stats else 0) |
+                             (HEADER_ROBUST if self.robust else 0) |
+                             (HEADER_UPGRADEABLE if self.upgradeable else 0) |
+                             (HEADER_ADAPTIVE if self.adaptive else 0),
+                             self.data_size)
+            struct.pack_into('=I', self._buf, HEADER_OFFSET, HEADER_MAGIC)
+
+    @staticmethod
+    def unlink(name):
+        """Removes the named lock *name*. Processes that have it open may
+        keep using it, but opening *name* again creates a new lock."""
+        _shm_unlink(_shm_name(name))
+
+    def _set_reentrant(self, reentrant):
+        # Must be called before the core is bound, which wraps its methods
+        self._reentrancy = Reentrancy() if reentrant else None
 
-    def __setup(self, _fd=None):
+    @property
+    def reentrant(self):
+        return self._reentrancy is not None
+
+    def _length(self):
+        # Of the mapping backing the lock: a single page, unless the data
+        # region doesn't fit in it
+        return align(DATA_OFFSET + self.data_size, mmap.PAGESIZE)
+
+    def _uses_turnstile(self):
+        if self.policy == FAIR:
+            return True
+        return (self.policy == PREFER_WRITER and
+                not hasattr(librt, 'pthread_rwlockattr_setkind_np'))
+
+    def __setup(self, _fd=None, initialize=None):
+        # The lock is initialized when we create its backing file, or when
+        # we're told to (the creator of a named lock)
+        if initialize is None:
+            initialize = _fd is None
         try:
             # Define these guards so we know which attribution has failed
-            buf, lock, lockattr, fd = None, None, None, None
+            mapping, lock, lockattr, fd = None, None, None, None
+            turnstile, stats, owners, upgrade = None, None, None, None
 
             if _fd:
                 # We're being called from __setstate__, all we have to do is
                 # load the file descriptor of the backing file
                 fd = _fd
             else:
-                # Create a temporary file with an actual file descriptor, so
-                # that child processes can receive the lock via apply from the
-                # multiprocessing module
-                fd, name = tempfile.mkstemp()
-                os.write(fd, b'\0' * mmap.PAGESIZE)
-                os.unlink(name)
+                fd = create_backing_file(self._length())
 
             # mmap allocates page sized chunks, and the data structures we
             # use are smaller than a page. Therefore, we request a whole
-            # page
-            buf = mmap.mmap(fd, mmap.PAGESIZE, mmap.MAP_SHARED)
-            if _fd:
-                buf.seek(0)
+            # page (more if the data region needs them). Copies of the lock
+            # in this process share the mapping of the original.
+            mapping = attach(fd, self._length(), created=initialize)
+            buf = mapping.buf
 
             # Use the memory we just obtained from mmap and obtain pointers
             # to that data
@@ -152,186 +1561,266 @@ class RWLockPosix(object):
             lock_p = ctypes.byref(tmplock)
             tmplockattr = pthread_rwlockattr_t.from_buffer(buf, offset)
             lockattr_p = ctypes.byref(tmplockattr)
+            if self._uses_turnstile():
+                tmpturnstile = pthread_rwlock_t.from_buffer(buf,
+                                                            TURNSTILE_OFFSET)
+            stats = lock_stats_t.from_buffer(buf, STATS_OFFSET)
+            spin = lock_spin_t.from_buffer(buf, SPIN_OFFSET)
+            if self.robust:
+                tmpowners = lock_owners_t.from_buffer(buf, OWNERS_OFFSET)
+            if self.upgradeable:
+                tmpupgrade = pthread_rwlock_t.from_buffer(buf, UPGRADE_OFFSET)
 
-            if _fd is None:
+            if initialize:
                 # Initialize the rwlock attributes and make it process shared
                 librt.pthread_rwlockattr_init(lockattr_p)
                 lockattr = tmplockattr
                 librt.pthread_rwlockattr_setpshared(lockattr_p,
                                                     PTHREAD_PROCESS_SHARED)
+                if (self.policy in PTHREAD_RWLOCK_KINDS and
+                        hasattr(librt, 'pthread_rwlockattr_setkind_np')):
+                    librt.pthread_rwlockattr_setkind_np(
+                        lockattr_p, PTHREAD_RWLOCK_KINDS[self.policy])
 
                 # Initialize the rwlock
                 librt.pthread_rwlock_init(lock_p, lockattr_p)
                 lock = tmplock
+                if self._uses_turnstile():
+                    librt.pthread_rwlock_init(ctypes.byref(tmpturnstile),
+                                              lockattr_p)
+                    turnstile = tmpturnstile
+                if self.robust:
+                    _init_robust_mutex(tmpowners.mutex)
+                    owners = tmpowners
+                if self.upgradeable:
+                    librt.pthread_rwlock_init(ctypes.byref(tmpupgrade),
+                                              lockattr_p)
+                    upgrade = tmpupgrade
             else:
                 # The data is already initialized in the mmap. We only have to
                 # point to it
                 lockattr = tmplockattr
                 lock = tmplock
+                if self._uses_turnstile():
+                    turnstile = tmpturnstile
+                if self.robust:
+                    owners = tmpowners
+                if self.upgradeable:
+                    upgrade = tmpupgrade
 
             # Finally initialize this instance's members
-            self._fd = fd
+            self._mapping = mapping
+            self._fd = mapping.fd
             self._buf = buf
             self._lock = lock
             self._lock_p = lock_p
             self._lockattr = lockattr
             self._lockattr_p = lockattr_p
+            if turnstile is not None:
+                self._turnstile = turnstile
+                self._turnstile_p = ctypes.byref(turnstile)
+            self._stats_data = stats
+            self._spin_data = spin
+            if self.adaptive and not SPIN_DISABLED:
+                self._spin = spin
+            if self.data_size:
+                self.buffer = memoryview(buf)[DATA_OFFSET:
+                                              DATA_OFFSET + self.data_size]
+                # Yielded by reader_lock(), where writing would be a bug
+                self._readonly_buffer = getattr(
+                    self.buffer, 'toreadonly', lambda: self.buffer)()
+            if self.keep_stats:
+                self._stats = stats
+            if owners is not None:
+                self._owners = owners
+                # Robust locks are served by the Python core in any case
+                self.core_class = RobustCore
+                self._bind_core(lock, lockattr, owners, self._stats)
+            else:
+                if upgrade is not None:
+                    self._upgrade = upgrade
+                    self._upgrade_p = ctypes.byref(upgrade)
+                self._bind_core(lock, turnstile, self._stats, upgrade,
+                                self._spin)
         except:
-            if lock:
+            if turnstile is not None and initialize:
+                try:
+                    librt.pthread_rwlock_destroy(ctypes.byref(turnstile))
+                except:
+                    pass
+                turnstile = None
+            stats = spin = self._spin = self._spin_data = None
+            if owners is not None and initialize:
+                try:
+                    librt.pthread_mutex_destroy(ctypes.byref(owners.mutex))
+                except:
+                    pass
+            owners = tmpowners = None
+            if upgrade is not None and initialize:
+                try:
+                    librt.pthread_rwlock_destroy(ctypes.byref(upgrade))
+                except:
+                    pass
+            upgrade = tmpupgrade = None
+            if lock and initialize:
                 try:
                     librt.pthread_rwlock_destroy(lock_p)
                     lock_p, lock = None, None
                 except:
                     # We really need this reference gone to free the buffer
                     lock_p, lock = None, None
-            if lockattr:
+            if lockattr and initialize:
                 try:
                     librt.pthread_rwlockattr_destroy(lockattr_p)
                     lockattr_p, lockattr = None, None
                 except:
                     # We really need this reference gone to free the buffer
                     lockattr_p, lockattr = None, None
-            if buf:
-                try:
-                    buf.close()
-                except:
-                    pass
-            if fd:
+            lock_p = lock = lockattr_p = lockattr = None
+            tmplock = tmplockattr = tmpturnstile = buf = None
+            self._mapping = self._buf = None
+            if mapping:
+                detach(mapping)
+            elif fd and not _fd:
                 try:
                     os.close(fd)
                 except:
                     pass
             raise
 
-    def _pthread_timedrdlock(self, seconds):
-        ts = get_timespec(seconds)
-        if librt.pthread_rwlock_timedrdlock(self._lock_p, ctypes.byref(ts)) == errno.ETIMEDOUT:
-            return False
-        return True
-
-    def _pthread_timedwrlock(self, seconds):
-        ts = get_timespec(seconds)
-        if librt.pthread_rwlock_timedwrlock(self._lock_p, ctypes.byref(ts)) == errno.ETIMEDOUT:
-            return False
-        return True
-
-    def _loop_timedrdlock(self, seconds):
-        while seconds > 0.0:
-            if librt.pthread_rwlock_tryrdlock(self._lock_p) == 0:
-                return True
-            sleep(min(SHORT_SLEEP, seconds))
-            seconds -= SHORT_SLEEP
-        return False
-
-    def _loop_timedwrlock(self, seconds):
-        while seconds > 0.0:
-            if librt.pthread_rwlock_trywrlock(self._lock_p) == 0:
-                return True
-            sleep(min(SHORT_SLEEP, seconds))
-            seconds -= SHORT_SLEEP
-        return False
-
-    def acquire_read(self, timeout=None):
-        """acquire_read([timeout=None])
-
-        Request a read lock, returning True if the lock is acquired;
-        False otherwise. If provided, *timeout* specifies the number of
-        seconds to wait for the lock before cancelling and returning False.
-        """
-        if timeout is None:
-            librt.pthread_rwlock_rdlock(self._lock_p)
-        elif not self._timed_rdlock(timeout):
-            return False
-        self.nlocks += 1
-        return True
-
-    def acquire_write(self, timeout=None):
-        """acquire_write([timeout=None])
-
-        Request a write lock, returning True if the lock is acquired;
-        False otherwise. If provided, *timeout* specifies the number of
-        seconds to wait for the lock before cancelling and returning False.
-        """
-        if timeout is None:
-            librt.pthread_rwlock_wrlock(self._lock_p)
-        elif not self._timed_wrlock(timeout):
-            return False
-        self.nlocks += 1
-        return True
-
-    def try_acquire_read(self):
-        """Try to obtain a read lock, immediately returning True if
-        the lock is acquired; False otherwise.
-        """
-        if librt.pthread_rwlock_tryrdlock(self._lock_p) == 0:
-            self.nlocks += 1
-            return True
-        else:
-            return False
-
-    def try_acquire_write(self):
-        """Try to obtain a write lock, returning True immediately if
-        the lock can be acquired; False otherwise.
-        """
-        if librt.pthread_rwlock_trywrlock(self._lock_p) == 0:
-            self.nlocks += 1
-            return True
-        else:
-            return False
-
-    def release(self):
-        """Release a previously acquired read/write lock.
-        """
-        if self.nlocks == 0:
-            raise ValueError(
-                'Tried to release a released lock'
-            )
-        librt.pthread_rwlock_unlock(self._lock_p)
-        self.nlocks -= 1
-
     def __getstate__(self):
         return {
                 '_fd': self._fd,
                 'pid': self.pid,
                 'nlocks': self.nlocks,
+                'policy': self.policy,
+                'name': self.name,
+                'stats': self.keep_stats,
+                'robust': self.robust,
+                'upgradeable': self.upgradeable,
+                'adaptive': self.adaptive,
+                'hold': self._hold,
+                'hold_depth': self._hold_depth,
+                'data_size': self.data_size,
+                'reentrant': self.reentrant,
                 }
 
     def __setstate__(self, state):
-        self.__setup(state['_fd'])
+        self.policy = state.get('policy')
+        self.keep_stats = state.get('stats', False)
+        self.robust = state.get('robust', False)
+        self.upgradeable = state.get('upgradeable', False)
+        self.adaptive = state.get('adaptive', False)
+        self.data_size = state.get('data_size', 0)
+        self._set_reentrant(state.get('reentrant', False))
+        self.name = state.get('name')
+        if self.name is not None:
+            # Works in processes that didn't inherit the descriptor, too
+            self.__open(create=False)
+        else:
+            self.__setup(state['_fd'])
         self.pid = os.getpid()
         if self.pid == state['pid']:
             self.nlocks = state['nlocks']
+            self._hold = state.get('hold', 0)
+            self._hold_depth = state.get('hold_depth', 0)
         else:
             self.nlocks = 0
 
+    # Named locks outlive the processes using them, so they're never
+    # destroyed; they're just dropped from this process. Anonymous ones are
+    # destroyed by the last copy of the process that created them.
+
     def _del_lockattr(self):
-        librt.pthread_rwlockattr_destroy(self._lockattr_p)
+        if self._destroys:
+            librt.pthread_rwlockattr_destroy(self._lockattr_p)
         self._lockattr, self._lockattr_p = None, None
 
     def _del_lock(self):
+        if self._reentrancy is not None:
+            # Release the shared lock as many times as it was acquired
+            self._reentrancy.clear()
         for i in range(self.nlocks):
             self.release()
 
-        librt.pthread_rwlock_destroy(self._lock_p)
+        if not self._unbind_core(detach=True):
+            # Leave the locks to whoever still uses them
+            self._destroys = False
+        if self._destroys:
+            librt.pthread_rwlock_destroy(self._lock_p)
         self._lock, self._lock_p = None, None
 
+    def _del_turnstile(self):
+        if self._destroys:
+            librt.pthread_rwlock_destroy(self._turnstile_p)
+        self._turnstile, self._turnstile_p = None, None
+
+    def _del_upgrade(self):
+        if self._destroys:
+            librt.pthread_rwlock_destroy(self._upgrade_p)
+        self._upgrade, self._upgrade_p = None, None
+
+    def _del_owners(self):
+        if self._destroys:
+            librt.pthread_mutex_destroy(ctypes.byref(self._owners.mutex))
+        self._owners = None
+
     def _del_buf(self):
-        self._buf.close()
+        # Views of the mapping must be gone before it can be closed
+        self._stats = self._stats_data = None
+        self._spin = self._spin_data = None
+        if self.buffer is not None:
+            self._readonly_buffer.release()
+            self.buffer.release()
+            self.buffer = self._readonly_buffer = None
         self._buf = None
+        detach(self._mapping)
+        self._mapping = None
+
+    def stats(self):
+        """Returns the contention statistics of the lock, gathered by all
+        processes using it since its creation or the last reset_stats().
+
+        reads and writes count acquisitions, contended those that found the
+        lock busy (including timeouts and failed tries) and timeouts those
+        that gave up waiting. Times are in nanoseconds: wait times are
+        spent acquiring the lock, while hold times run from a process
+        taking the lock until it no longer holds it at all. wait_histogram
+        counts acquisitions by wait time: the first bucket under 1us, each
+        following one up to twice as long as the previous one.
+
+        Adaptive locks count their spins whether or not statistics are
+        enabled: spins counts acquisitions that spun, spin_acquired those
+        that got the lock while spinning, and spin_budget_ns is how long
+        acquisitions currently expect the lock to be held.
+        """
+        data = self._stats_data
+        result = dict((name, getattr(data, name))
+                      for name, ctype in lock_stats_t._fields_)
+        result['wait_histogram'] = list(data.wait_histogram)
+        result['enabled'] = self.keep_stats
+        spin = self._spin_data
+        result['spins'] = spin.spins
+        result['spin_acquired'] = spin.spin_acquired
+        result['spin_budget_ns'] = spin.budget_ns
+        return result
+
+    def reset_stats(self):
+        """Clears the statistics of the lock, for every process"""
+        ctypes.memset(ctypes.addressof(self._stats_data), 0,
+                      ctypes.sizeof(lock_stats_t))
+        self._spin_data.spins = self._spin_data.spin_acquired = 0
 
     def __del__(self):
-        for name in '_lockattr _lock _buf'.split():
+        mapping = getattr(self, '_mapping', None)
+        if mapping is None:
+            return
+        self._destroys = self.name is None and mapping.destroys()
+        for name in '_lockattr _lock _turnstile _upgrade _owners _buf'.split():
             attr = getattr(self, name, None)
             if attr is not None:
                 func = getattr(self, '_del{}'.format(name))
                 func()
-        try:
-            if hasattr(self, '_fd'):
-                os.close(self._fd)
-        except OSError:
-            # Nothing we can do. We opened the file descriptor, we have to
-            # close it. If we can't, all bets are off.
-            pass
 
 
 # A call to pthread_rwlock_destroy on Mac OS X raises an exception
@@ -350,3 +1839,176 @@ class RWLockOSX(RWLockPosix):
         # Under Mac OS X, it must check whether the lock's is initialized
         if self._lock[0] != 0:
             RWLockPosix._del_lock(self)
+
+    def _del_turnstile(self):
+        if self._turnstile[0] != 0:
+            RWLockPosix._del_turnstile(self)
+
+    def _del_upgrade(self):
+        if self._upgrade[0] != 0:
+            RWLockPosix._del_upgrade(self)
+
+
+class RWLockArena(object):
+    """A fixed number of process-shared rwlocks packed in a single mapping.
+
+    Every RWLockPosix costs one file descriptor and one page of memory. An
+    arena instead backs *capacity* locks with a single file, laying them out
+    in cache-line aligned slots so that neighbouring locks don't share a
+    line. Locks are obtained by indexing the arena, which is cheap since no
+    system call is involved.
+    """
+    slot_size = align(ctypes.sizeof(pthread_rwlock_t))
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError('An arena must hold at least one lock')
+        self.__setup(capacity)
+        self.pid = os.getpid()
+
+    def __setup(self, capacity, _fd=None):
+        try:
+            # Define these guards so we know which attribution has failed
+            mapping, fd = None, None
+
+            size = align(capacity * self.slot_size, mmap.PAGESIZE)
+            fd = _fd if _fd else create_backing_file(size)
+            # Only the process that initialized the slots destroys them
+            mapping = attach(fd, size, created=_fd is None)
+            buf = mapping.buf
+
+            if _fd is None:
+                # The attributes are only needed while initializing the
+                # slots, so there's no need to keep them in shared memory
+                lockattr = pthread_rwlockattr_t()
+                lockattr_p = ctypes.byref(lockattr)
+                librt.pthread_rwlockattr_init(lockattr_p)
+                try:
+                    librt.pthread_rwlockattr_setpshared(lockattr_p,
+                                                        PTHREAD_PROCESS_SHARED)
+                    for index in range(capacity):
+                        lock = pthread_rwlock_t.from_buffer(
+                            buf, index * self.slot_size)
+                        librt.pthread_rwlock_init(ctypes.byref(lock),
+                                                  lockattr_p)
+                        del lock
+                finally:
+                    librt.pthread_rwlockattr_destroy(lockattr_p)
+
+            self._mapping = mapping
+            self._fd = mapping.fd
+            self._buf = buf
+            self.capacity = capacity
+            # Handles by index, created on first use
+            self._handles = {}
+        except:
+            buf = None
+            if mapping:
+                detach(mapping)
+            elif fd and not _fd:
+                try:
+                    os.close(fd)
+                except:
+                    pass
+            raise
+
+    def __len__(self):
+        return self.capacity
+
+    def __getitem__(self, index):
+        """Returns the handle to the lock stored in slot *index*, the same
+        one every time"""
+        if index < 0:
+            index += self.capacity
+        if not 0 <= index < self.capacity:
+            raise IndexError('arena index out of range')
+        try:
+            return self._handles[index]
+        except KeyError:
+            return self._handles.setdefault(index, RWLockHandle(self, index))
+
+    def _slot(self, index):
+        return pthread_rwlock_t.from_buffer(self._buf, index * self.slot_size)
+
+    def __getstate__(self):
+        return {
+                '_fd': self._fd,
+                'pid': self.pid,
+                'capacity': self.capacity,
+                }
+
+    def __setstate__(self, state):
+        self.__setup(state['capacity'], state['_fd'])
+        self.pid = os.getpid()
+
+    def _destroy_slot(self, lock):
+        librt.pthread_rwlock_destroy(ctypes.byref(lock))
+
+    def _del_buf(self):
+        # Handles release the locks they hold as they go
+        self._handles.clear()
+        if self._mapping.destroys():
+            for index in range(self.capacity):
+                lock = self._slot(index)
+                try:
+                    self._destroy_slot(lock)
+                except OSError:
+                    # The slot is probably still locked by someone. Nothing
+                    # we can do about it at this point
+                    pass
+                del lock
+        self._buf = None
+        detach(self._mapping)
+        self._mapping = None
+
+    def __del__(self):
+        if getattr(self, '_buf', None) is not None:
+            self._del_buf()
+
+
+class RWLockArenaOSX(RWLockArena):
+
+    def _destroy_slot(self, lock):
+        # See the comment on RWLockOSX about the signature of the lock
+        if lock[0] != 0:
+            RWLockArena._destroy_slot(self, lock)
+
+
+class RWLockHandle(_RWLockOps):
+    """A lock living in a slot of an RWLockArena.
+
+    Handles have the same interface as RWLockPosix and pickle as a reference
+    to their arena plus the slot index.
+    """
+
+    def __init__(self, arena, index):
+        self.arena = arena
+        self.index = index
+        self._lock = arena._slot(index)
+        self._lock_p = ctypes.byref(self._lock)
+        self._bind_core(self._lock)
+        self.nlocks = 0
+        self.pid = os.getpid()
+
+    def __getstate__(self):
+        return {
+                'arena': self.arena,
+                'index': self.index,
+                'pid': self.pid,
+                'nlocks': self.nlocks,
+                }
+
+    def __setstate__(self, state):
+        self.__init__(state['arena'], state['index'])
+        if self.pid == state['pid']:
+            self.nlocks = state['nlocks']
+
+    def __del__(self):
+        # Locks held by a handle that goes away are released, just like
+        # RWLockPosix does. The slot itself belongs to the arena.
+        lock = getattr(self, '_lock', None)
+        if lock is not None:
+            for i in range(self.nlocks):
+                self.release()
+            self._unbind_core(detach=True)
+            self._lock, self._lock_p = None, None
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os        # For closing the backing file
+import mmap      # For setting up a shared memory region
+import time      # For yielding while a writer updates the data
+import ctypes    # For the writer lock and the sequence counter
+import struct    # For reading records laid out with struct
+
+from .prwlock import (librt, poll, align, create_backing_file,
+                      pthread_rwlock_t, pthread_rwlockattr_t,
+                      PTHREAD_PROCESS_SHARED, SPIN_TRIES, CACHE_LINE)
+from .mappings import attach, detach
+
+try:
+    from . import atomics
+except ImportError:
+    atomics = None
+
+try:
+    if os.environ.get('PRWLOCK_NO_SPEEDUPS'):
+        raise ImportError('prwlock speedups disabled by the environment')
+    from ._speedups import seq_read, seq_write_begin, seq_write_end
+except ImportError:
+    seq_read = seq_write_begin = seq_write_end = None
+
+# Layout of the mapping: the lock writers exclude each other with, then the
+# sequence counter and the data, each on cache lines of their own so that
+# readers don't share lines with the writer lock
+SEQ_OFFSET = align(ctypes.sizeof(pthread_rwlock_t))
+DATA_OFFSET = SEQ_OFFSET + CACHE_LINE
+
+
+class SeqLock(object):
+    """A process-shared sequence lock guarding *size* bytes of data.
+
+    Writers exclude each other with a pthread lock and make a sequence
+    counter odd while they update the data. Readers never write to shared
+    memory: they copy the data out and start over if the counter was odd or
+    moved meanwhile, so they never slow writers or each other down. That
+    suits small records that are read far more often than written, e.g.
+    configuration epochs or counters; readers may retry indefinitely under
+    a steady stream of writes.
+
+    The data is available as the writable memoryview *buffer*, which must
+    only be written between write_begin() and write_end() (or within
+    writer()), and is best read with read(), read_bytes() or between
+    read_begin() and read_retry().
+
+    Without the compiled accelerator, the counter is accessed through
+    libatomic when available, which is enough for x86, but weakly ordered
+    CPUs need the fences of the accelerator.
+    """
+
+    def __init__(self, size=mmap.PAGESIZE - DATA_OFFSET):
+        if size < 1:
+            raise ValueError('A seqlock must guard at least one byte')
+        self.__setup(size)
+        self.pid = os.getpid()
+
+    def __setup(self, size, _fd=None):
+        try:
+            # Define these guards so we know which attribution has failed
+            mapping, fd = None, None
+
+            length = align(DATA_OFFSET + size, mmap.PAGESIZE)
+            fd = _fd if _fd else create_backing_file(length)
+            # Only the process that initialized the writer lock destroys it
+            mapping = attach(fd, length, created=_fd is None)
+            buf = mapping.buf
+            lock = pthread_rwlock_t.from_buffer(buf)
+
+            if _fd is None:
+                lockattr = pthread_rwlockattr_t()
+                lockattr_p = ctypes.byref(lockattr)
+                librt.pthread_rwlockattr_init(lockattr_p)
+                try:
+                    librt.pthread_rwlockattr_setpshared(lockattr_p,
+                                                        PTHREAD_PROCESS_SHARED)
+                    librt.pthread_rwlock_init(ctypes.byref(lock), lockattr_p)
+                finally:
+                    librt.pthread_rwlockattr_destroy(lockattr_p)
+
+            self._mapping = mapping
+            self._fd = mapping.fd
+            self._buf = buf
+            self._lock = lock
+            self._lock_p = ctypes.byref(lock)
+            self._seq = ctypes.c_uint64.from_buffer(buf, SEQ_OFFSET)
+            self._seq_addr = ctypes.addressof(self._seq)
+            self.size = size
+            self.buffer = memoryview(buf)[DATA_OFFSET:DATA_OFFSET + size]
+        except:
+            buf = lock = None
+            if mapping:
+                detach(mapping)
+            elif fd and not _fd:
+                try:
+                    os.close(fd)
+                except:
+                    pass
+            raise
+
+    def _load_seq(self):
+        if atomics is not None:
+            return atomics.load(self._seq_addr)
+        return self._seq.value
+
+    def _bump_seq(self, begin):
+        if seq_write_begin is not None:
+            bump = seq_write_begin if begin else seq_write_end
+            return bump(self._buf, SEQ_OFFSET)
+        value = self._load_seq() + 1
+        if atomics is not None:
+            atomics.store(self._seq_addr, value)
+        else:
+            self._seq.value = value
+        return value
+
+    @property
+    def sequence(self):
+        """The sequence counter, which is odd while a writer is active"""
+        return self._load_seq()
+
+    def write_begin(self, timeout=None):
+        """write_begin([timeout=None])
+
+        Waits for other writers to be done and starts an update of the
+        data, returning True; or False if *timeout* seconds passed first.
+        """
+        if timeout is None:
+            librt.pthread_rwlock_wrlock(self._lock_p)
+        elif not poll(librt.pthread_rwlock_trywrlock, self._lock_p, timeout):
+            return False
+        self._bump_seq(True)
+        return True
+
+    def write_end(self):
+        """Ends the update started by write_begin(), publishing it"""
+        if not self._load_seq() & 1:
+            raise ValueError('write_end() called without write_begin()')
+        self._bump_seq(False)
+        librt.pthread_rwlock_unlock(self._lock_p)
+
+    def writer(self, timeout=None):
+        """Context manager that updates the data, yielding self.buffer"""
+        return SeqLockWriter(self, timeout)
+
+    def write(self, data, offset=0):
+        """Replaces the bytes of *data* at *offset* in a single update"""
+        end = offset + len(data)
+        if offset < 0 or end > self.size:
+            raise ValueError('Write out of the bounds of the seqlock')
+        with self.writer() as view:
+            view[offset:end] = data
+
+    def read_begin(self):
+        """Starts an optimistic read, returning the sequence number to give
+        read_retry() once done. Waits for an active writer first."""
+        attempt = 0
+        while True:
+            seq = self._load_seq()
+            if not seq & 1:
+                return seq
+            attempt += 1
+            if attempt >= SPIN_TRIES:
+                time.sleep(0)
+
+    def read_retry(self, seq):
+        """Returns whether the data read since read_begin() returned *seq*
+        may be inconsistent, in which case the read must start over"""
+        return self._load_seq() != seq
+
+    def read_bytes(self, size=None, offset=0):
+        """Returns a consistent copy of *size* bytes (all by default) of
+        the data, starting at *offset*"""
+        if size is None:
+            size = self.size - offset
+        if offset < 0 or size < 0 or offset + size > self.size:
+            raise ValueError('Read out of the bounds of the seqlock')
+        if seq_read is not None:
+            return seq_read(self._buf, SEQ_OFFSET, DATA_OFFSET + offset, size)
+        start = DATA_OFFSET + offset
+        while True:
+            seq = self.read_begin()
+            data = self._buf[start:start + size]
+            if not self.read_retry(seq):
+                return data
+
+    def read(self, layout, offset=0):
+        """Returns a consistent copy of the fixed-size record at *offset*.
+        *layout* is either a ctypes type, e.g. a Structure subclass, of
+        which a new instance is returned, or a struct.Struct (or struct
+        format), in which case the unpacked tuple is returned."""
+        if isinstance(layout, (str, bytes)):
+            layout = struct.Struct(layout)
+        if isinstance(layout, struct.Struct):
+            return layout.unpack(self.read_bytes(layout.size, offset))
+        return layout.from_buffer_copy(
+            self.read_bytes(ctypes.sizeof(layout), offset))
+
+    def __getstate__(self):
+        return {
+                '_fd': self._fd,
+                'pid': self.pid,
+                'size': self.size,
+                }
+
+    def __setstate__(self, state):
+        self.__setup(state['size'], state['_fd'])
+        self.pid = os.getpid()
+
+    def _del_buf(self):
+        if self._mapping.destroys():
+            try:
+                librt.pthread_rwlock_destroy(self._lock_p)
+            except OSError:
+                pass
+        # Views of the mapping must be gone before it can be closed
+        self.buffer.release()
+        self.buffer = self._lock = self._lock_p = self._seq = None
+        self._buf = None
+        detach(self._mapping)
+        self._mapping = None
+
+    def __del__(self):
+        if getattr(self, '_buf', None) is not None:
+            self._del_buf()
+
+
+class SeqLockWriter(object):
+    def __init__(self, lock, timeout=None):
+        self.lock = lock
+        self.timeout = timeout
+
+    def __enter__(self):
+        if not self.lock.write_begin(timeout=self.timeout):
+            # Same as GenericLockContextManager
+            raise ValueError('Unable to acquire lock in context manager')
+        return self.lock.buffer
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.write_end()
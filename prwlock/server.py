@@ -0,0 +1,666 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""A lock server, for processes that share no memory with each other.
+
+The server owns a table of process-shared locks, known by name, and takes
+them on behalf of its clients, which reach it over a Unix or TCP socket:
+
+    python -m prwlock.server --unix /run/prwlock.sock
+
+RemoteRWLock has the interface of RWLock, each of its operations being a
+round trip to the server:
+
+    rwlock = RemoteRWLock('config', '/run/prwlock.sock')
+    with rwlock.reader_lock():
+        ...
+
+Every connection is served by a thread of its own, which is the one taking
+and releasing the locks the connection holds, so they behave as if a
+process of their own held them. The server releases the locks of clients
+that go away.
+
+The protocol is a stream of fixed-size binary requests, each answered by a
+fixed-size reply in order, so clients can send several requests before
+reading any reply (see REQUEST and REPLY). Clients keep a pool of
+connections to each server, releases are sent along with the next request
+(or as soon as nothing else on the connection holds a lock), and
+acquire_all() sends all of its requests at once.
+"""
+
+import os        # For strerror
+import sys       # For the command line
+import errno     # To report failures the way local locks do
+import socket    # For talking to the server
+import struct    # For the protocol
+import threading # For the connection pool
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+from .multilock import AcquiredLocks, METHODS
+
+# Requests are an operation, a lock identifier (the length of the name that
+# follows, when opening a lock) and a timeout in seconds, negative for none
+# and zero for a try. Replies are a status and a lock identifier (when
+# opening a lock) or an errno.
+REQUEST = struct.Struct('!BId')
+REPLY = struct.Struct('!Bi')
+
+OP_OPEN = 1
+OP_READ = 2
+OP_WRITE = 3
+OP_RELEASE = 4
+
+DENIED = 0       # The lock wasn't acquired
+GRANTED = 1      # The request succeeded
+FAILED = 2       # The request failed with the errno of the reply
+
+MAX_NAME = 1024  # Bytes of lock names
+RECV_SIZE = 65536
+
+# Acquisitions of robust locks reclaimed from a dead writer fail with this,
+# with the lock held
+_EOWNERDEAD = getattr(errno, 'EOWNERDEAD', 130)
+
+
+def _is_unix(address):
+    # Unix sockets are addressed by path, TCP ones by (host, port)
+    return isinstance(address, (str, bytes))
+
+
+class _UnixServer(socketserver.ThreadingMixIn,
+                  socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        if not _is_unix(self.server.server_address):
+            self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        held = []    # Locks held by the connection, in acquisition order
+        try:
+            self.server.lock_server._serve(self.request, held)
+        finally:
+            for lock in reversed(held):
+                try:
+                    lock.release()
+                except (OSError, ValueError):
+                    pass
+
+
+class LockServer(object):
+    """Serves locks to RemoteRWLocks at *address*, the path of a Unix
+    socket or a (host, port) pair for TCP.
+
+    *locks* maps names to the locks to serve under them, which lets local
+    processes share those locks (e.g. named or arena ones) with remote
+    clients. Locks requested under other names are created on the fly as
+    new RWLocks, unless *create* is false.
+    """
+
+    def __init__(self, address, locks=None, create=True):
+        self._locks = []         # By identifier
+        self._ids = {}           # Identifiers by name
+        self._table_lock = threading.Lock()
+        self.create = create
+        for name, lock in (locks or {}).items():
+            self._add(name, lock)
+        server_class = _UnixServer if _is_unix(address) else _TCPServer
+        self._server = server_class(address, _Handler)
+        self._server.lock_server = self
+        self._thread = None
+
+    @property
+    def address(self):
+        """The address the server listens on, e.g. to find the port it
+        was given when created with port 0"""
+        return self._server.server_address
+
+    def _add(self, name, lock):
+        self._ids[name] = len(self._locks)
+        self._locks.append(lock)
+
+    def _open(self, name):
+        # Returns the identifier of the lock called *name*
+        with self._table_lock:
+            if name not in self._ids:
+                if not self.create:
+                    raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
+                from . import RWLock
+                self._add(name, RWLock())
+            return self._ids[name]
+
+    def _serve(self, sock, held):
+        # Answers the requests of a connection until it's closed. Requests
+        # that arrive together are answered together.
+        pending = bytearray()
+        while True:
+            data = sock.recv(RECV_SIZE)
+            if not data:
+                return
+            pending += data
+            replies = []
+            offset = 0
+            while len(pending) - offset >= REQUEST.size:
+                op, arg, timeout = REQUEST.unpack_from(pending, offset)
+                if op == OP_OPEN:
+                    end = offset + REQUEST.size + arg
+                    if arg > MAX_NAME:
+                        # The stream can't be parsed past this request
+                        sock.sendall(b''.join(replies) +
+                                     REPLY.pack(FAILED, errno.ENAMETOOLONG))
+                        return
+                    if len(pending) < end:
+                        break
+                    name = bytes(pending[end - arg:end]).decode('utf-8')
+                    try:
+                        replies.append(REPLY.pack(GRANTED, self._open(name)))
+                    except OSError as e:
+                        replies.append(REPLY.pack(FAILED, e.errno))
+                    offset = end
+                    continue
+                offset += REQUEST.size
+                if timeout != 0 and replies:
+                    # Don't sit on the answers of earlier requests while
+                    # waiting for a lock
+                    sock.sendall(b''.join(replies))
+                    replies = []
+                replies.append(REPLY.pack(*self._handle(op, arg, timeout,
+                                                        held)))
+            del pending[:offset]
+            if replies:
+                sock.sendall(b''.join(replies))
+
+    def _handle(self, op, arg, timeout, held):
+        # Carries out a request other than opening a lock, returning the
+        # status and value of its reply
+        if not 0 <= arg < len(self._locks):
+            return FAILED, errno.EINVAL
+        lock = self._locks[arg]
+        if op == OP_RELEASE:
+            for index in range(len(held) - 1, -1, -1):
+                if held[index] is lock:
+                    del held[index]
+                    lock.release()
+                    return GRANTED, 0
+            return FAILED, errno.EPERM
+        if op not in (OP_READ, OP_WRITE):
+            return FAILED, errno.EINVAL
+        method = METHODS[op - OP_READ]
+        try:
+            if timeout == 0:
+                acquired = getattr(lock, 'try_acquire_' + method)()
+            elif timeout < 0:
+                acquired = getattr(lock, 'acquire_' + method)()
+            else:
+                acquired = getattr(lock, 'acquire_' + method)(
+                    timeout=timeout)
+        except OSError as e:
+            if e.errno == _EOWNERDEAD:
+                held.append(lock)
+            return FAILED, e.errno
+        if not acquired:
+            return DENIED, 0
+        held.append(lock)
+        return GRANTED, 0
+
+    def serve_forever(self, poll_interval=0.5):
+        """Serves clients until shutdown() is called"""
+        self._server.serve_forever(poll_interval)
+
+    def start(self):
+        """Serves clients from a background thread, until close()"""
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def shutdown(self):
+        """Stops serve_forever(), from another thread"""
+        self._server.shutdown()
+
+    def close(self):
+        """Stops serving, and removes the socket of Unix servers.
+        Connections being served are left alone."""
+        if self._thread is not None:
+            self.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+        if _is_unix(self.address):
+            try:
+                os.unlink(self.address)
+            except OSError:
+                pass
+
+
+class ConnectionLost(OSError):
+    """Raised when the connection to the lock server is lost, which
+    releases every lock held through it"""
+
+
+class Connection(object):
+    """A connection to a lock server. Requests may be queued to be sent
+    along with the next one, their replies being checked then."""
+
+    def __init__(self, address):
+        if _is_unix(address):
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                self.sock.connect(address)
+            except:
+                self.sock.close()
+                raise
+        else:
+            self.sock = socket.create_connection(address)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.queued = []     # Requests not sent yet
+        self.unread = 0      # Replies not read yet, of queued requests
+        self.holders = 0     # RemoteRWLocks holding locks through us
+
+    def request(self, requests):
+        """Sends the queued requests and then *requests*, a list of
+        packed requests, returning the (status, value) of their replies.
+        Failures of queued requests are raised once all replies are in."""
+        data = b''.join(self.queued + requests)
+        self.queued = []
+        try:
+            self.sock.sendall(data)
+            replies = self._recv(self.unread + len(requests))
+        except socket.error as e:
+            self.close()
+            raise ConnectionLost(getattr(e, 'errno', None) or errno.EPIPE,
+                                 'Connection to the lock server lost')
+        earlier = replies[:self.unread]
+        self.unread = 0
+        for status, value in earlier:
+            if status == FAILED:
+                raise OSError(value, os.strerror(value))
+        return replies[len(earlier):]
+
+    def queue(self, request):
+        """Queues the packed *request*, whose reply isn't waited for"""
+        self.queued.append(request)
+        self.unread += 1
+
+    def flush(self):
+        """Sends the queued requests, whose replies are read along with
+        those of the next request"""
+        if self.queued:
+            data = b''.join(self.queued)
+            self.queued = []
+            try:
+                self.sock.sendall(data)
+            except socket.error:
+                self.close()
+
+    def _recv(self, count):
+        size = count * REPLY.size
+        data = bytearray()
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise socket.error(errno.ECONNRESET,
+                                   'Lock server closed the connection')
+            data += chunk
+        return [REPLY.unpack_from(data, offset)
+                for offset in range(0, size, REPLY.size)]
+
+    def close(self):
+        self.sock.close()
+        self.sock = None
+
+
+class RemoteLockClient(object):
+    """The connections of this process to the lock server at *address*.
+
+    Holding a lock pins a connection, since the server releases locks with
+    the connection that took them; connections go back to the pool when
+    their locks are released. At most *pool_size* idle connections are
+    kept open.
+    """
+
+    def __init__(self, address, pool_size=4):
+        self.address = address
+        self.pool_size = pool_size
+        self._idle = []
+        self._ids = {}           # Lock identifiers by name
+        self._mutex = threading.Lock()
+
+    def checkout(self):
+        """Returns an idle connection, or a new one"""
+        with self._mutex:
+            if self._idle:
+                return self._idle.pop()
+        return Connection(self.address)
+
+    def checkin(self, connection):
+        """Returns *connection*, with no lock held through it, to the pool
+        after sending its queued requests"""
+        connection.flush()
+        if connection.sock is None:
+            return
+        with self._mutex:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def lock_id(self, name, connection=None):
+        """Returns the identifier the server gave the lock *name*"""
+        try:
+            return self._ids[name]
+        except KeyError:
+            pass
+        encoded = name.encode('utf-8')
+        request = REQUEST.pack(OP_OPEN, len(encoded), 0) + encoded
+        if connection is not None:
+            [(status, value)] = connection.request([request])
+        else:
+            connection = self.checkout()
+            try:
+                [(status, value)] = connection.request([request])
+            finally:
+                self.checkin(connection)
+        if status != GRANTED:
+            raise OSError(value, '{}: {}'.format(os.strerror(value), name))
+        self._ids[name] = value
+        return value
+
+    def lock(self, name):
+        """Returns the RemoteRWLock *name* of the server"""
+        return RemoteRWLock(name, self.address, client=self)
+
+    def acquire_all(self, requests, timeout=None):
+        """acquire_all(requests[, timeout=None])
+
+        Same as prwlock.acquire_all() for RemoteRWLocks of this server, but
+        every attempt is a single round trip: all locks are requested at
+        once, sorted by name, waiting only for the one found busy by the
+        previous attempt (if any) and trying the others. Locks already held
+        through another connection can't be part of *requests*.
+        """
+        by_name = {}
+        for lock, method in requests:
+            if method not in METHODS:
+                raise ValueError('acquire_all called with invalid method %s'
+                                 % method)
+            if lock.name in by_name and by_name[lock.name][1] == 'write':
+                continue
+            by_name[lock.name] = (by_name.get(lock.name, (lock,))[0], method)
+        locks = [by_name[name] for name in sorted(by_name)]
+        connections = set(lock._connection for lock, method in locks
+                          if lock._connection is not None)
+        if len(connections) > 1:
+            raise ValueError('Locks held through different connections')
+        connection = connections.pop() if connections else self.checkout()
+        deadline = None if timeout is None else monotonic() + timeout
+        wait = None          # Index of the lock to wait for
+        # Keeps the connection out of the pool while locks come and go
+        connection.holders += 1
+        try:
+            while True:
+                packed = []
+                for index, (lock, method) in enumerate(locks):
+                    lock_timeout = 0
+                    if index == wait:
+                        lock_timeout = -1 if deadline is None else max(
+                            deadline - monotonic(), 1e-9)
+                    packed.append(REQUEST.pack(
+                        OP_READ + METHODS.index(method),
+                        self.lock_id(lock.name, connection), lock_timeout))
+                replies = connection.request(packed)
+                held = [lock for (lock, method), (status, value)
+                        in zip(locks, replies)
+                        if lock._granted(connection, status, value)]
+                busy = [index for index, (status, value) in enumerate(replies)
+                        if status != GRANTED]
+                if not busy:
+                    return AcquiredLocks(locks)
+                # Released along with the next attempt
+                for lock in reversed(held):
+                    lock._release(flush=False)
+                status, value = replies[busy[0]]
+                if status == FAILED:
+                    raise OSError(value, os.strerror(value))
+                if wait == busy[0] or (deadline is not None and
+                                       monotonic() >= deadline):
+                    return AcquiredLocks([], locked=False)
+                wait = busy[0]
+        finally:
+            connection.holders -= 1
+            if not connection.holders and connection.sock is not None:
+                self.checkin(connection)
+            else:
+                connection.flush()
+
+    def close(self):
+        """Closes the idle connections"""
+        with self._mutex:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+_clients = {}    # By address, for this process only
+_clients_lock = threading.Lock()
+
+
+def client(address):
+    """Returns the RemoteLockClient of this process for *address*"""
+    key = os.getpid(), address
+    with _clients_lock:
+        if key not in _clients:
+            # Connections inherited from a parent belong to the parent
+            for other in [k for k in _clients if k[0] != key[0]]:
+                del _clients[other]
+            _clients[key] = RemoteLockClient(address)
+        return _clients[key]
+
+
+class RemoteRWLock(object):
+    """The lock *name* of the LockServer at *address*, with the interface
+    of RWLock.
+
+    Like RWLock, an object is meant for one thread at a time; threads of a
+    process can share one through a HybridRWLock. Locks held through
+    objects of the same process, which share their connection, exclude
+    each other like those of separate processes, except that taking a
+    lock in write mode while the connection holds it fails with EDEADLK.
+    RemoteRWLocks pickle as their name and address.
+    """
+
+    def __init__(self, name, address, client=None):
+        self.name = name
+        self.address = address
+        self._client = client
+        self._connection = None
+        self.nlocks = 0
+        self.pid = os.getpid()
+
+    @property
+    def client(self):
+        if self._client is None or self.pid != os.getpid():
+            self._client = client(self.address)
+        return self._client
+
+    def _check_fork(self):
+        # Locks held by a parent aren't held by its forked children
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._client = None
+            self._connection = None
+            self.nlocks = 0
+
+    def _check_connection(self):
+        # The server released whatever we held through a lost connection
+        if self._connection is not None and self._connection.sock is None:
+            self._connection = None
+            self.nlocks = 0
+            raise ConnectionLost(errno.ECONNRESET,
+                                 'Connection to the lock server lost')
+
+    def _granted(self, connection, status, value):
+        # Records the outcome of a request for the lock made through
+        # *connection*, returning whether the lock is held
+        if status == GRANTED or (status == FAILED and value == _EOWNERDEAD):
+            if self._connection is None:
+                self._connection = connection
+                connection.holders += 1
+            self.nlocks += 1
+            return True
+        return False
+
+    def _acquire(self, method, timeout, wait=True):
+        self._check_fork()
+        self._check_connection()
+        client = self.client
+        connection = self._connection or client.checkout()
+        if not wait:
+            timeout = 0
+        elif timeout is None:
+            timeout = -1
+        else:
+            # Zero would make it a try
+            timeout = max(timeout, 1e-9)
+        try:
+            lock_id = client.lock_id(self.name, connection)
+            [(status, value)] = connection.request([REQUEST.pack(
+                OP_READ + METHODS.index(method), lock_id, timeout)])
+            self._granted(connection, status, value)
+        finally:
+            if not connection.holders and connection.sock is not None:
+                client.checkin(connection)
+        if status == FAILED:
+            raise OSError(value, 'remote_{} failed {}'.format(
+                method, os.strerror(value)))
+        return status == GRANTED
+
+    def acquire_read(self, timeout=None):
+        """acquire_read([timeout=None])
+
+        Request a read lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        return self._acquire('read', timeout)
+
+    def acquire_write(self, timeout=None):
+        """acquire_write([timeout=None])
+
+        Request a write lock, returning True if the lock is acquired;
+        False otherwise. If provided, *timeout* specifies the number of
+        seconds to wait for the lock before cancelling and returning False.
+        """
+        return self._acquire('write', timeout)
+
+    def try_acquire_read(self):
+        """Try to obtain a read lock, immediately returning True if
+        the lock is acquired; False otherwise.
+        """
+        return self._acquire('read', None, wait=False)
+
+    def try_acquire_write(self):
+        """Try to obtain a write lock, returning True immediately if
+        the lock can be acquired; False otherwise.
+        """
+        return self._acquire('write', None, wait=False)
+
+    def release(self):
+        """Release a previously acquired read/write lock.
+        """
+        self._release()
+
+    def _release(self, flush=True):
+        # Unless *flush* is set, the request may wait for the next one
+        # sent through the connection
+        self._check_fork()
+        self._check_connection()
+        if self.nlocks == 0:
+            raise ValueError(
+                'Tried to release a released lock'
+            )
+        connection = self._connection
+        connection.queue(REQUEST.pack(
+            OP_RELEASE, self.client.lock_id(self.name), 0))
+        self.nlocks -= 1
+        if self.nlocks:
+            # Still held, so the release can wait for the next request
+            return
+        self._connection = None
+        connection.holders -= 1
+        if not connection.holders:
+            self.client.checkin(connection)
+        elif flush:
+            connection.flush()
+
+    def __getstate__(self):
+        return {'name': self.name, 'address': self.address}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['address'])
+
+    def __del__(self):
+        # Like RWLock, locks held by an object that goes away are released
+        connection = getattr(self, '_connection', None)
+        if (connection is not None and connection.sock is not None and
+                self.pid == os.getpid()):
+            try:
+                for i in range(self.nlocks):
+                    self.release()
+            except (OSError, ValueError):
+                pass
+
+
+# Imported once the package is, since it imports this module lazily
+from . import reader_lock, writer_lock, reads, writes
+RemoteRWLock.reader_lock = reader_lock
+RemoteRWLock.writer_lock = writer_lock
+RemoteRWLock.reads = reads
+RemoteRWLock.writes = writes
+
+
+def main(argv=None):
+    """Runs a lock server from the command line"""
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog='python -m prwlock.server',
+        description='Serves process-shared locks over a socket.')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--unix', metavar='PATH',
+                       help='listen on the Unix socket PATH')
+    group.add_argument('--tcp', metavar='HOST:PORT',
+                       help='listen on TCP port PORT of HOST')
+    args = parser.parse_args(argv)
+    if args.unix:
+        address = args.unix
+    else:
+        host, _, port = args.tcp.rpartition(':')
+        address = (host.strip('[]'), int(port))
+    server = LockServer(address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
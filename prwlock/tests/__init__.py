@@ -0,0 +1,11 @@
+import pkgutil
+import unittest
+
+
+def suite():
+    """Every test module but those of the Windows lock, which the POSIX
+    systems prwlock runs on can't import"""
+    names = ['prwlock.tests.' + name
+             for _, name, _ in pkgutil.iter_modules(__path__)
+             if name.startswith('test_') and name != 'test_wrwlock']
+    return unittest.TestLoader().loadTestsFromNames(sorted(names))
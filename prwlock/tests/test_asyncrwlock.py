@@ -0,0 +1,118 @@
+from __future__ import print_function
+
+import time
+import pickle
+import asyncio
+import unittest
+
+import prwlock
+import multiprocessing as mp
+
+
+@unittest.skipUnless(hasattr(prwlock, 'AsyncRWLock'), 'asyncio support needed')
+class AsyncRWLockTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.AsyncRWLock()
+
+    def hold(self, method, seconds):
+        """Holds the lock in another process for *seconds*"""
+        locked = mp.Event()
+        p = mp.Process(target=hold_lock,
+                       args=(self.rwlock.lock, method, seconds, locked))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.addCleanup(p.join)
+        return p
+
+    async def ticker(self, ticks):
+        while True:
+            await asyncio.sleep(.01)
+            ticks.append(time.time())
+
+    async def test_uncontended(self):
+        self.assertTrue(await self.rwlock.acquire_read())
+        self.assertTrue(await self.rwlock.acquire_read(timeout=1))
+        self.assertEqual(self.rwlock.nlocks, 2)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertTrue(await self.rwlock.acquire_write())
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    async def test_context_managers(self):
+        async with self.rwlock.reader_lock(timeout=1):
+            self.assertEqual(self.rwlock.nlocks, 1)
+        async with self.rwlock.writer_lock():
+            self.assertEqual(self.rwlock.nlocks, 1)
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    async def test_contended_wait_keeps_loop_running(self):
+        self.hold('write', .5)
+        ticks = []
+        ticker = asyncio.ensure_future(self.ticker(ticks))
+        start = time.time()
+        self.assertTrue(await self.rwlock.acquire_read())
+        ticker.cancel()
+        self.rwlock.release()
+        self.assertGreater(time.time() - start, .3)
+        # The loop kept running other coroutines during the wait
+        self.assertGreater(len(ticks), 10)
+
+    async def test_timeout(self):
+        self.hold('write', 1)
+        start = time.time()
+        self.assertFalse(await self.rwlock.acquire_write(timeout=.2))
+        self.assertFalse(await self.rwlock.acquire_read(timeout=0))
+        self.assertLess(time.time() - start, .8)
+        self.assertEqual(self.rwlock.nlocks, 0)
+        with self.assertRaises(ValueError):
+            async with self.rwlock.reader_lock(timeout=.1):
+                pass
+
+    async def test_cancellation(self):
+        p = self.hold('write', .5)
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.rwlock.acquire_write(), .1)
+        await asyncio.get_running_loop().run_in_executor(None, p.join)
+        # The cancelled wait didn't leave the lock held
+        self.assertEqual(self.rwlock.nlocks, 0)
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+
+    async def test_coroutines_exclude_each_other(self):
+        events = []
+
+        async def writer():
+            async with self.rwlock.writer_lock():
+                events.append('write')
+                await asyncio.sleep(.2)
+                events.append('written')
+
+        async def reader():
+            await asyncio.sleep(.05)
+            async with self.rwlock.reader_lock(timeout=2):
+                events.append('read')
+
+        await asyncio.gather(writer(), reader())
+        self.assertEqual(events, ['write', 'written', 'read'])
+
+    async def test_single_acquisition(self):
+        # Waiting takes the lock once, from the loop's thread
+        self.rwlock = prwlock.AsyncRWLock(prwlock.RWLock(stats=True))
+        self.hold('write', .3)
+        self.assertTrue(await self.rwlock.acquire_read(timeout=5))
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.lock.stats()['reads'], 1)
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertIsInstance(t, prwlock.AsyncRWLock)
+        self.assertEqual(t.lock._fd, self.rwlock.lock._fd)
+
+
+def hold_lock(rwlock, method, seconds, locked):
+    getattr(rwlock, 'acquire_' + method)()
+    locked.set()
+    time.sleep(seconds)
+    rwlock.release()
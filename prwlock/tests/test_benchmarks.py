@@ -0,0 +1,48 @@
+from __future__ import print_function
+
+import json
+import unittest
+
+import prwlock
+from prwlock import benchmarks
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def run_benchmarks(self, *args):
+        options = benchmarks.parse_args(['--iterations', '10',
+                                         '--duration', '.05',
+                                         '--processes', '1'] + list(args))
+        return json.loads(json.dumps(benchmarks.run(options)))
+
+    def test_all_benchmarks(self):
+        results = self.run_benchmarks('--ratios', '100,0')
+        self.assertEqual(set(results['benchmarks']),
+                         set(benchmarks.BENCHMARKS))
+        contended = results['benchmarks']['contended']
+        self.assertEqual([r['read_ratio'] for r in contended], [100, 0])
+        self.assertEqual(contended[0]['writes'], 0)
+        self.assertEqual(contended[1]['reads'], 0)
+
+    def test_lock_kinds(self):
+        for lock in benchmarks.LOCKS:
+            results = self.run_benchmarks('--lock', lock,
+                                          '--only', 'uncontended')
+            self.assertEqual(results['lock'], lock)
+            self.assertIn('uncontended', results['benchmarks'])
+
+    def test_speedups(self):
+        results = self.run_benchmarks('--only', 'speedups')
+        speedups = results['benchmarks']['speedups']
+        rwlock = prwlock.RWLock()
+        if rwlock._core is None:
+            self.assertIsNone(speedups['compiled'])
+            return
+        for mode in ('read', 'write'):
+            self.assertGreater(speedups[mode]['speedup'], 0)
+            self.assertIn('median_ns', speedups[mode]['fallback'])
+
+    def test_percentiles(self):
+        p = benchmarks.percentiles(range(1000), points=(50, 99))
+        self.assertEqual(p['p50'], 500)
+        self.assertEqual(p['p99'], 990)
+        self.assertIsNone(benchmarks.percentiles([], points=(50,))['p50'])
@@ -0,0 +1,236 @@
+from __future__ import print_function
+
+import time
+import ctypes
+import pickle
+import platform
+import unittest
+
+import prwlock
+import multiprocessing as mp
+
+if platform.system() == 'Linux':
+    from prwlock import brlock
+else:
+    brlock = None
+
+
+@unittest.skipUnless(hasattr(prwlock, 'BigReaderLock'),
+                     'big-reader backend needed')
+class BigReaderLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rwlock = prwlock.BigReaderLock(slots=4)
+
+    def acquire_lock(self, function, rwlock, queue, expected_result=True):
+        p = mp.Process(target=function, args=(rwlock, queue,))
+        p.start()
+        if expected_result:
+            self.assertTrue(queue.get())
+        else:
+            self.assertFalse(queue.get())
+        p.join()
+
+    def test_slots(self):
+        self.assertEqual(self.rwlock.slots, 4)
+        self.assertGreaterEqual(prwlock.BigReaderLock().slots, 1)
+        with self.assertRaises(ValueError):
+            prwlock.BigReaderLock(slots=0)
+        addresses = self.rwlock._slot_addrs
+        for a, b in zip(addresses, addresses[1:]):
+            self.assertEqual(b - a, prwlock._prwlock.CACHE_LINE)
+
+    def test_double_release(self):
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_simple_deadlock(self):
+        self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_read()
+        self.rwlock.release()
+        self.rwlock.acquire_read()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        self.assertFalse(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+
+    def test_deserialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertEqual(t._fd, self.rwlock._fd)
+        self.assertEqual(t.slots, 4)
+
+    def test_state(self):
+        self.assertEqual(self.rwlock.state(), {
+            'writer': False, 'waiters': 0, 'readers': [0] * 4,
+        })
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read()
+        self.assertEqual(sum(self.rwlock.state()['readers']), 2)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.rwlock.acquire_write()
+        self.assertTrue(self.rwlock.state()['writer'])
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.state(), {
+            'writer': False, 'waiters': 0, 'readers': [0] * 4,
+        })
+
+    def test_release_from_another_slot(self):
+        # Readers may have moved to another CPU by the time they release
+        self.rwlock.acquire_read()
+        readers = self.rwlock.state()['readers']
+        index = readers.index(1)
+        other = (index + 1) % 4
+        self.rwlock._unbind_core()
+        self.rwlock._reads = [0] * 4
+        self.rwlock._reads[index] = 1
+        self.rwlock._current_slot = lambda: other
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.state()['readers'], [0] * 4)
+
+    def test_readers_share(self):
+        self.rwlock.acquire_read()
+        q = mp.Queue()
+        self.acquire_lock(try_acquire_read, self.rwlock, q, True)
+        self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        self.rwlock.release()
+
+    def test_timeout(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        self.acquire_lock(acquire_read_timeout, self.rwlock, q, False)
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, False)
+        self.rwlock.release()
+        self.acquire_lock(acquire_read_timeout, self.rwlock, q, True)
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, True)
+        # Waiters that timed out must have unregistered themselves
+        self.assertEqual(self.rwlock.state()['waiters'], 0)
+
+    def test_writer_drain_timeout(self):
+        # A writer giving up on readers lets new readers in again
+        self.rwlock.acquire_read()
+        q = mp.Queue()
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, False)
+        self.assertFalse(self.rwlock.state()['writer'])
+        self.acquire_lock(try_acquire_read, self.rwlock, q, True)
+        self.rwlock.release()
+
+    def test_try_acquire(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+        self.rwlock.release()
+        self.acquire_lock(try_acquire_write, self.rwlock, q, True)
+        self.acquire_lock(try_acquire_read, self.rwlock, q, True)
+
+    def test_wakeup(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=acquire_read_blocking, args=(self.rwlock, q))
+        p.start()
+        while not self.rwlock.state()['waiters']:
+            time.sleep(.01)
+        self.rwlock.release()
+        self.assertTrue(q.get(timeout=5))
+        p.join()
+
+    def test_writer_waits_for_readers(self):
+        self.rwlock.acquire_read()
+        q = mp.Queue()
+        p = mp.Process(target=acquire_write_blocking, args=(self.rwlock, q))
+        p.start()
+        while not self.rwlock.state()['writer']:
+            time.sleep(.01)
+        # New readers stay out while the writer waits
+        self.assertFalse(self.rwlock.try_acquire_read())
+        self.rwlock.release()
+        self.assertTrue(q.get(timeout=5))
+        p.join()
+
+    def test_context_managers(self):
+        with self.rwlock.reader_lock():
+            pass
+        with self.rwlock.writer_lock(timeout=1):
+            pass
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_mutual_exclusion(self):
+        counter = mp.Value(ctypes.c_long, 0, lock=False)
+        children = 4
+        fallback = self.rwlock._core is None
+        processes = [mp.Process(target=increment,
+                                args=(self.rwlock, counter, 500, fallback))
+                     for i in range(children)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertTrue(all([p.exitcode == 0 for p in processes]))
+        self.assertEqual(counter.value, children * 500)
+        self.assertEqual(self.rwlock.state(), {
+            'writer': False, 'waiters': 0, 'readers': [0] * 4,
+        })
+
+
+@unittest.skipUnless(brlock is not None and brlock.atomics is not None,
+                     'libatomic needed for the Python fallback')
+class BigReaderLockFallbackTestCase(BigReaderLockTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.BigReaderLock(slots=4)
+        self.rwlock._unbind_core()
+
+    def test_fallback(self):
+        self.assertIsNone(self.rwlock._core)
+
+
+def increment(rwlock, counter, times, fallback):
+    if fallback:
+        rwlock._unbind_core()
+    for i in range(times):
+        rwlock.acquire_write()
+        value = counter.value
+        counter.value = value + 1
+        rwlock.release()
+        rwlock.acquire_read()
+        rwlock.release()
+
+
+def acquire_write_blocking(rwlock, queue):
+    queue.put(rwlock.acquire_write())
+    rwlock.release()
+
+
+def acquire_read_blocking(rwlock, queue):
+    queue.put(rwlock.acquire_read())
+    rwlock.release()
+
+
+def acquire_read_timeout(rwlock, queue):
+    ret = rwlock.acquire_read(.3)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def acquire_write_timeout(rwlock, queue):
+    ret = rwlock.acquire_write(.3)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def try_acquire_write(rwlock, queue):
+    ret = rwlock.try_acquire_write()
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def try_acquire_read(rwlock, queue):
+    ret = rwlock.try_acquire_read()
+    queue.put(ret)
+    if ret:
+        rwlock.release()
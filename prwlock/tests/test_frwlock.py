@@ -0,0 +1,176 @@
+from __future__ import print_function
+
+import time
+import ctypes
+import pickle
+import platform
+import unittest
+
+import prwlock
+import multiprocessing as mp
+
+if platform.system() == 'Linux':
+    from prwlock import frwlock
+else:
+    frwlock = None
+
+
+@unittest.skipUnless(hasattr(prwlock, 'RWLockFutex'), 'futex backend needed')
+class RWLockFutexTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLockFutex()
+
+    def acquire_lock(self, function, rwlock, queue, expected_result=True):
+        p = mp.Process(target=function, args=(rwlock, queue,))
+        p.start()
+        if expected_result:
+            self.assertTrue(queue.get())
+        else:
+            self.assertFalse(queue.get())
+        p.join()
+
+    def test_double_release(self):
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_simple_deadlock(self):
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+            self.rwlock.acquire_write()
+
+    def test_deserialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertEqual(t._fd, self.rwlock._fd)
+
+    def test_state(self):
+        self.assertEqual(self.rwlock.state(), {
+            'readers': 0, 'writer': False,
+            'read_waiters': 0, 'write_waiters': 0,
+        })
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read()
+        self.assertEqual(self.rwlock.state()['readers'], 2)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.rwlock.acquire_write()
+        self.assertTrue(self.rwlock.state()['writer'])
+        self.rwlock.release()
+        self.assertEqual(self.rwlock._lock.state, 0)
+
+    def test_read_release(self):
+        self.rwlock.acquire_read()
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_write_release(self):
+        self.rwlock.acquire_write()
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_timeout(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        self.acquire_lock(acquire_read_timeout, self.rwlock, q, False)
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, False)
+        self.rwlock.release()
+        self.acquire_lock(acquire_read_timeout, self.rwlock, q, True)
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, True)
+        # Waiters that timed out must have unregistered themselves
+        self.assertEqual(self.rwlock._lock.state, 0)
+
+    def test_try_acquire(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+        self.rwlock.release()
+        self.acquire_lock(try_acquire_write, self.rwlock, q, True)
+        self.acquire_lock(try_acquire_read, self.rwlock, q, True)
+
+    def test_wakeup(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=acquire_write_blocking, args=(self.rwlock, q))
+        p.start()
+        while not self.rwlock.state()['write_waiters']:
+            time.sleep(.01)
+        self.rwlock.release()
+        self.assertTrue(q.get(timeout=5))
+        p.join()
+
+    def test_context_managers(self):
+        with self.rwlock.reader_lock(timeout=1):
+            pass
+        with self.rwlock.writer_lock(timeout=1):
+            pass
+
+    def test_mutual_exclusion(self):
+        counter = mp.Value(ctypes.c_long, 0, lock=False)
+        children = 4
+        fallback = self.rwlock._core is None
+        processes = [mp.Process(target=increment,
+                                args=(self.rwlock, counter, 500, fallback))
+                     for i in range(children)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        self.assertTrue(all([p.exitcode == 0 for p in processes]))
+        self.assertEqual(counter.value, children * 500)
+        self.assertEqual(self.rwlock._lock.state, 0)
+
+
+@unittest.skipUnless(frwlock is not None and frwlock.atomics is not None,
+                     'libatomic needed for the Python fallback')
+class RWLockFutexFallbackTestCase(RWLockFutexTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLockFutex()
+        self.rwlock._unbind_core()
+
+    def test_fallback(self):
+        self.assertIsNone(self.rwlock._core)
+
+
+def increment(rwlock, counter, times, fallback):
+    if fallback:
+        rwlock._unbind_core()
+    for i in range(times):
+        rwlock.acquire_write()
+        value = counter.value
+        counter.value = value + 1
+        rwlock.release()
+        rwlock.acquire_read()
+        rwlock.release()
+
+
+def acquire_write_blocking(rwlock, queue):
+    queue.put(rwlock.acquire_write())
+    rwlock.release()
+
+
+def acquire_read_timeout(rwlock, queue):
+    ret = rwlock.acquire_read(.3)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def acquire_write_timeout(rwlock, queue):
+    ret = rwlock.acquire_write(.3)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def try_acquire_write(rwlock, queue):
+    ret = rwlock.try_acquire_write()
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def try_acquire_read(rwlock, queue):
+    ret = rwlock.try_acquire_read()
+    queue.put(ret)
+    if ret:
+        rwlock.release()
@@ -0,0 +1,118 @@
+from __future__ import print_function
+
+import time
+import unittest
+
+import prwlock
+import multiprocessing as mp
+
+
+class LockHooksTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock()
+        self.events = []
+        self.hooks = self.recorder()
+
+    def recorder(self, sample=1):
+        events = self.events
+        return prwlock.LockHooks(
+            on_wait_start=lambda lock, mode: events.append(('wait', mode)),
+            on_acquired=lambda lock, mode, wait: events.append(
+                ('acquired', mode, wait)),
+            on_release=lambda lock, hold: events.append(('release', hold)),
+            sample=sample,
+        )
+
+    def test_invalid_sample(self):
+        with self.assertRaises(ValueError):
+            prwlock.LockHooks(sample=0)
+
+    def test_lock_events(self):
+        self.rwlock.set_hooks(self.hooks)
+        self.assertTrue(self.rwlock.acquire_read())
+        time.sleep(.05)
+        self.rwlock.release()
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+        self.assertEqual([e[:2] for e in self.events if e[0] != 'release'], [
+            ('wait', 'read'), ('acquired', 'read'),
+            ('wait', 'write'), ('acquired', 'write'),
+        ])
+        self.assertEqual(self.events[2][0], 'release')
+        self.assertGreaterEqual(self.events[2][1], .04)
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_wait_duration(self):
+        self.rwlock.set_hooks(self.hooks)
+        locked = mp.Event()
+        p = mp.Process(target=hold_write, args=(self.rwlock, .3, locked))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.assertTrue(self.rwlock.acquire_read())
+        self.rwlock.release()
+        p.join()
+        self.assertEqual(self.events[1][:2], ('acquired', 'read'))
+        self.assertGreater(self.events[1][2], .1)
+
+    def test_release_of_earlier_acquisition(self):
+        self.rwlock.acquire_write()
+        self.rwlock.set_hooks(self.hooks)
+        self.rwlock.release()
+        self.assertEqual(self.events, [])
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_failed_try_is_not_reported(self):
+        events = []
+        instrumented = self.hooks.instrument(self.rwlock, {
+            'acquire_read': lambda timeout=None: False,
+            'acquire_write': lambda timeout=None: False,
+            'try_acquire_read': lambda: False,
+            'try_acquire_write': lambda: False,
+            'release': lambda: events.append('release'),
+        })
+        self.assertFalse(instrumented['try_acquire_read']())
+        self.assertFalse(instrumented['acquire_write'](timeout=0))
+        instrumented['release']()
+        self.assertEqual(events, ['release'])
+        self.assertEqual([e[0] for e in self.events], ['wait', 'wait'])
+
+    def test_sampling(self):
+        self.rwlock.set_hooks(self.recorder(sample=4))
+        for i in range(8):
+            self.rwlock.acquire_read()
+            self.rwlock.acquire_read()
+            self.rwlock.release()
+            self.rwlock.release()
+        self.assertEqual([e[0] for e in self.events],
+                         ['wait', 'acquired', 'release'] * 4)
+
+    def test_clearing_hooks(self):
+        methods = dict((name, getattr(self.rwlock, name))
+                       for name in self.rwlock.core_methods)
+        self.rwlock.set_hooks(self.hooks)
+        self.rwlock.set_hooks(None)
+        for name, method in methods.items():
+            self.assertEqual(getattr(self.rwlock, name), method)
+        self.rwlock.acquire_read()
+        self.rwlock.release()
+        self.assertEqual(self.events, [])
+
+    def test_context_manager(self):
+        with self.rwlock.writer_lock(hooks=self.hooks):
+            self.assertEqual(self.rwlock.nlocks, 1)
+        with self.rwlock.reader_lock(timeout=1, hooks=self.hooks):
+            pass
+        self.assertEqual([e[:2] for e in self.events if e[0] != 'release'], [
+            ('wait', 'write'), ('acquired', 'write'),
+            ('wait', 'read'), ('acquired', 'read'),
+        ])
+        self.assertEqual(len(self.events), 6)
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+
+def hold_write(rwlock, seconds, locked):
+    rwlock.acquire_write()
+    locked.set()
+    time.sleep(seconds)
+    rwlock.release()
+
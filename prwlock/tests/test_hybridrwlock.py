@@ -0,0 +1,142 @@
+from __future__ import print_function
+
+import time
+import pickle
+import threading
+import unittest
+
+import prwlock
+import multiprocessing as mp
+
+
+class HybridRWLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rwlock = prwlock.HybridRWLock()
+
+    def in_thread(self, function, *args):
+        results = []
+        t = threading.Thread(target=lambda: results.append(function(*args)))
+        t.start()
+        return t, results
+
+    def test_double_release(self):
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_simple_deadlock(self):
+        self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_read()
+        self.rwlock.release()
+        self.rwlock.acquire_read()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        self.rwlock.release()
+
+    def test_read_write_release(self):
+        self.assertTrue(self.rwlock.acquire_read())
+        self.assertTrue(self.rwlock.acquire_read(timeout=1))
+        self.assertEqual(self.rwlock.nlocks, 2)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertTrue(self.rwlock.acquire_write(timeout=1))
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+        self.assertEqual(self.rwlock.lock.nlocks, 0)
+
+    def test_readers_share_process_hold(self):
+        barrier = threading.Barrier(4)
+        seen = []
+
+        def reader():
+            with self.rwlock.reader_lock():
+                barrier.wait()
+                seen.append((self.rwlock.nlocks, self.rwlock.lock.nlocks))
+                barrier.wait()
+
+        threads = [threading.Thread(target=reader) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(seen, [(4, 1)] * 4)
+        self.assertEqual(self.rwlock.lock.nlocks, 0)
+
+    def test_threads_exclude_writers(self):
+        self.rwlock.acquire_read()
+        t, results = self.in_thread(self.rwlock.acquire_write, .1)
+        t.join()
+        self.assertEqual(results, [False])
+        t, results = self.in_thread(self.rwlock.try_acquire_write)
+        t.join()
+        self.assertEqual(results, [False])
+        self.rwlock.release()
+
+        self.rwlock.acquire_write()
+        t, results = self.in_thread(self.rwlock.acquire_read, .1)
+        t.join()
+        self.assertEqual(results, [False])
+        self.rwlock.release()
+
+    def test_waiting_writer_blocks_new_readers(self):
+        self.rwlock.acquire_read()
+        writer, written = self.in_thread(self.rwlock.acquire_write, 5)
+        while not self.rwlock._write_waiters:
+            time.sleep(.01)
+        t, results = self.in_thread(self.rwlock.acquire_read, .1)
+        t.join()
+        self.assertEqual(results, [False])
+        # Recursive reads don't wait, or they would deadlock
+        self.assertTrue(self.rwlock.acquire_read(timeout=.1))
+        self.rwlock.release()
+        self.rwlock.release()
+        writer.join()
+        self.assertEqual(written, [True])
+
+    def test_mutual_exclusion(self):
+        counter = [0]
+
+        def increment():
+            for i in range(200):
+                with self.rwlock.writer_lock():
+                    value = counter[0]
+                    time.sleep(0)
+                    counter[0] = value + 1
+                with self.rwlock.reader_lock():
+                    pass
+
+        threads = [threading.Thread(target=increment) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(counter[0], 800)
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_other_processes(self):
+        self.rwlock.acquire_read()
+        q = mp.Queue()
+        p = mp.Process(target=acquire_write_timeout, args=(self.rwlock, q))
+        p.start()
+        self.assertFalse(q.get())
+        p.join()
+        self.rwlock.release()
+        p = mp.Process(target=acquire_write_timeout, args=(self.rwlock, q))
+        p.start()
+        self.assertTrue(q.get())
+        p.join()
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertIsInstance(t, prwlock.HybridRWLock)
+        self.assertEqual(t.nlocks, 0)
+
+
+def acquire_write_timeout(rwlock, queue):
+    ret = rwlock.acquire_write(.3)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
@@ -0,0 +1,88 @@
+from __future__ import print_function
+
+import pickle
+import unittest
+
+import prwlock
+from prwlock.locktable import stable_hash
+import multiprocessing as mp
+
+
+class LockTableTestCase(unittest.TestCase):
+    def setUp(self):
+        self.table = prwlock.LockTable(stripes=16)
+
+    def colliding_keys(self):
+        first = 'key-0'
+        for i in range(1, 1000):
+            key = 'key-%d' % i
+            if self.table.stripe(key) == self.table.stripe(first):
+                return first, key
+
+    def distinct_keys(self):
+        first = 'key-0'
+        for i in range(1, 1000):
+            key = 'key-%d' % i
+            if self.table.stripe(key) != self.table.stripe(first):
+                return first, key
+
+    def test_stable_hash(self):
+        self.assertEqual(stable_hash('user:1'), stable_hash(u'user:1'))
+        self.assertEqual(stable_hash(b'user:1'), stable_hash('user:1'))
+        self.assertEqual(stable_hash((1, 'a')), stable_hash((1, 'a')))
+
+    def test_same_key_same_lock(self):
+        self.assertIs(self.table.lock_for(42), self.table.lock_for(42))
+
+    def test_independent_keys(self):
+        a, b = self.distinct_keys()
+        with self.table.writer_lock(a):
+            with self.table.writer_lock(b, timeout=.1):
+                pass
+
+    def test_many_with_collisions(self):
+        a, b = self.colliding_keys()
+        self.assertTrue(self.table.acquire_many([a, b, 'c'], 'write'))
+        self.table.release_many([a, b, 'c'])
+        for lock in self.table._locks:
+            self.assertEqual(lock.nlocks, 0)
+
+    def test_many_failure_releases(self):
+        a, b = self.distinct_keys()
+        q = mp.Queue()
+        self.table.acquire_many([b], 'write')
+        p = mp.Process(target=acquire_many, args=(self.table, [a, b], q))
+        p.start()
+        self.assertFalse(q.get())
+        p.join()
+        # a must have been released by the failed acquisition
+        p = mp.Process(target=acquire_many, args=(self.table, [a], q))
+        p.start()
+        self.assertTrue(q.get())
+        p.join()
+        self.table.release_many([b])
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            self.table.acquire_many(['a'], 'exclusive')
+
+    def test_context_managers(self):
+        with self.table.reader_locks(['a', 'b', 'c']):
+            with self.table.reader_locks(['c', 'd'], timeout=.1):
+                pass
+        with self.table.writer_locks(['a', 'b']):
+            pass
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.table))
+        self.assertEqual(t.stripes, self.table.stripes)
+        self.assertEqual(t.stripe('a'), self.table.stripe('a'))
+        with self.table.writer_lock('a'):
+            self.assertFalse(t.lock_for('a').try_acquire_read())
+
+
+def acquire_many(table, keys, queue):
+    ret = table.acquire_many(keys, 'write', timeout=.2)
+    queue.put(ret)
+    if ret:
+        table.release_many(keys)
@@ -0,0 +1,110 @@
+from __future__ import print_function
+
+import time
+import pickle
+import unittest
+
+import prwlock
+import multiprocessing as mp
+from prwlock.multilock import lock_order
+
+
+class AcquireAllTestCase(unittest.TestCase):
+    def setUp(self):
+        self.a = prwlock.RWLock()
+        self.b = prwlock.RWLock()
+
+    def test_acquire_release(self):
+        held = prwlock.acquire_all([(self.a, 'read'), (self.b, 'write')])
+        self.assertTrue(held)
+        self.assertEqual((self.a.nlocks, self.b.nlocks), (1, 1))
+        self.assertFalse(self.b.try_acquire_read())
+        held.release()
+        self.assertFalse(held)
+        self.assertEqual((self.a.nlocks, self.b.nlocks), (0, 0))
+        with self.assertRaises(ValueError):
+            held.release()
+
+    def test_context_manager(self):
+        with prwlock.acquire_all([(self.a, 'write'), (self.b, 'write')],
+                                 timeout=1):
+            self.assertEqual((self.a.nlocks, self.b.nlocks), (1, 1))
+        self.assertEqual((self.a.nlocks, self.b.nlocks), (0, 0))
+
+    def test_nothing_to_acquire(self):
+        with prwlock.acquire_all([]) as held:
+            self.assertTrue(held)
+
+    def test_invalid_method(self):
+        with self.assertRaises(ValueError):
+            prwlock.acquire_all([(self.a, 'read'), (self.b, 'upgrade')])
+        self.assertEqual(self.a.nlocks, 0)
+
+    def test_duplicates(self):
+        held = prwlock.acquire_all([(self.a, 'read'), (self.a, 'write'),
+                                    (self.a, 'read')])
+        self.assertEqual(held.locks, [(self.a, 'write')])
+        self.assertEqual(self.a.nlocks, 1)
+        held.release()
+
+    def test_order(self):
+        copy = pickle.loads(pickle.dumps(self.a))
+        self.assertEqual(lock_order(copy), lock_order(self.a))
+        self.assertNotEqual(lock_order(self.a), lock_order(self.b))
+        arena = prwlock.RWLockArena(3)
+        keys = [lock_order(arena[i]) for i in range(3)]
+        self.assertEqual(keys, sorted(keys))
+        hybrid = prwlock.HybridRWLock(self.a)
+        self.assertEqual(lock_order(hybrid), lock_order(self.a))
+
+    def test_shared_timeout(self):
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(self.b, locked, done))
+        p.start()
+        try:
+            self.assertTrue(locked.wait(5))
+            start = time.time()
+            held = prwlock.acquire_all([(self.a, 'write'), (self.b, 'read')],
+                                       timeout=.3)
+            self.assertFalse(held)
+            self.assertLess(time.time() - start, 2)
+            # Nothing is left held
+            self.assertEqual(self.a.nlocks, 0)
+            self.assertTrue(self.a.try_acquire_write())
+            self.a.release()
+            with self.assertRaises(ValueError):
+                with prwlock.acquire_all([(self.b, 'write')], timeout=.1):
+                    pass
+        finally:
+            done.set()
+            p.join()
+
+    def test_no_deadlock(self):
+        q = mp.Queue()
+        workers = [
+            mp.Process(target=acquire_repeatedly,
+                       args=([(self.a, 'write'), (self.b, 'write')], q)),
+            mp.Process(target=acquire_repeatedly,
+                       args=([(self.b, 'write'), (self.a, 'read')], q)),
+        ]
+        for p in workers:
+            p.start()
+        self.assertEqual([q.get(timeout=30) for p in workers], [True] * 2)
+        for p in workers:
+            p.join()
+
+
+def hold_write(rwlock, locked, done):
+    rwlock.acquire_write()
+    locked.set()
+    done.wait(5)
+    rwlock.release()
+
+
+def acquire_repeatedly(requests, queue):
+    ok = True
+    for i in range(200):
+        with prwlock.acquire_all(requests, timeout=10) as held:
+            ok = ok and all(lock.nlocks == 1 for lock, method in held.locks)
+            time.sleep(0)
+    queue.put(ok)
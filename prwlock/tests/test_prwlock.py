@@ -1,10 +1,16 @@
 from __future__ import print_function
 
+import gc
 import os
+import sys
 import mmap
+import ctypes
 import time
 import pickle
+import signal
 import unittest
+import subprocess
+import threading
 
 import prwlock
 from multiprocessing import Pool
@@ -21,6 +27,15 @@ class BaseTestCase(unittest.TestCase):
     def tearDown(self):
         prwlock.set_pthread_process_shared(OLD_PTHREAD_PROCESS_SHARED)
 
+    def acquire_lock(self, function, rwlock, queue, expected_result=True):
+        p = mp.Process(target=function, args=(rwlock, queue,))
+        p.start()
+        if expected_result:
+            self.assertTrue(queue.get())
+        else:
+            self.assertFalse(queue.get())
+        p.join()
+
 
 class RWLockTestCase(BaseTestCase):
 
@@ -89,15 +104,6 @@ class RWLockTestCase(BaseTestCase):
         with self.assertRaises(OSError):
             prwlock.RWLock()
 
-    def acquire_lock(self, function, rwlock, queue, expected_result=True):
-        p = mp.Process(target=function, args=(rwlock, queue,))
-        p.start()
-        if expected_result:
-            self.assertTrue(queue.get())
-        else:
-            self.assertFalse(queue.get())
-        p.join()
-
     def test_timeout(self):
         # Lock write first
         self.rwlock.acquire_write()
@@ -113,6 +119,70 @@ class RWLockTestCase(BaseTestCase):
         # test acquire write timeout
         self.acquire_lock(acquire_write_timeout, self.rwlock, q, True)
 
+    def test_backing_files(self):
+        backing = prwlock._prwlock
+        for backend in backing.FALLBACK_BACKENDS:
+            fd = backing.create_backing_file(mmap.PAGESIZE, backend)
+            try:
+                self.assertEqual(os.fstat(fd).st_size, mmap.PAGESIZE)
+                self.assertEqual(os.fstat(fd).st_nlink, 0)
+            finally:
+                os.close(fd)
+        with self.assertRaises(KeyError):
+            backing.create_backing_file(mmap.PAGESIZE, 'floppy')
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'procfs needed')
+    def test_default_backend(self):
+        path = os.readlink('/proc/self/fd/%d' % self.rwlock._fd)
+        if prwlock._prwlock.DEFAULT_BACKEND == 'memfd':
+            self.assertTrue(path.startswith('/memfd:'), path)
+        self.assertIn(prwlock._prwlock.DEFAULT_BACKEND,
+                      prwlock._prwlock.FALLBACK_BACKENDS)
+
+    def test_timespec(self):
+        for seconds in (0, .25, .999999999, 1.5, 30, -.5):
+            before = time.time()
+            ts = prwlock._prwlock.get_timespec(seconds)
+            self.assertTrue(0 <= ts.tv_nsec < 1000000000)
+            self.assertAlmostEqual(ts.tv_sec + ts.tv_nsec / 1e9,
+                                   before + seconds, delta=.1)
+
+    def test_subsecond_timeout(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=timed_read_duration, args=(self.rwlock, q, .2))
+        p.start()
+        acquired, elapsed = q.get()
+        p.join()
+        self.rwlock.release()
+        self.assertFalse(acquired)
+        self.assertTrue(.15 < elapsed < .7, elapsed)
+
+    def test_polling_handoff(self):
+        # The polling fallback must notice the lock is free soon after it
+        # is released, not on its next fixed-length nap
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=poll_read_handoff, args=(self.rwlock, q))
+        p.start()
+        time.sleep(.3)
+        self.rwlock.release()
+        released = time.time()
+        acquired, when = q.get()
+        p.join()
+        self.assertTrue(acquired)
+        self.assertLess(when - released, .05)
+
+    def test_polling_timeout(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=poll_read_handoff, args=(self.rwlock, q, .1))
+        p.start()
+        acquired, when = q.get()
+        p.join()
+        self.rwlock.release()
+        self.assertFalse(acquired)
+
     def test_try_acquire(self):
         # Lock write first
         self.rwlock.acquire_write()
@@ -136,6 +206,1041 @@ class RWLockTestCase(BaseTestCase):
                     accessed_protected_area = True
         self.assertFalse(accessed_protected_area)
 
+    def test_cached_context_managers(self):
+        reader = self.rwlock.reader_lock()
+        self.assertIs(self.rwlock.reader_lock(), reader)
+        self.assertIs(self.rwlock.writer_lock(), self.rwlock.writer_lock())
+        with reader:
+            with reader:
+                self.assertEqual(self.rwlock.nlocks, 2)
+        with self.assertRaises(RuntimeError):
+            with self.rwlock.writer_lock():
+                q = mp.Queue()
+                self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+                raise RuntimeError()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_cached_context_managers_follow_hooks(self):
+        events = []
+        reader = self.rwlock.reader_lock()
+        self.rwlock.set_hooks(prwlock.LockHooks(
+            on_acquired=lambda lock, mode, wait: events.append(mode)))
+        self.assertIsNot(self.rwlock.reader_lock(), reader)
+        with self.rwlock.reader_lock():
+            pass
+        with self.rwlock.writer_lock():
+            pass
+        self.rwlock.set_hooks(None)
+        with self.rwlock.reader_lock():
+            pass
+        self.assertEqual(events, ['read', 'write'])
+
+    def test_cached_context_managers_outliving_the_lock(self):
+        rwlock = prwlock.RWLock()
+        fd = rwlock._fd
+        reader = rwlock.reader_lock()
+        del rwlock
+        # The cached manager keeps the lock alive
+        os.fstat(fd)
+        with reader:
+            pass
+        del reader
+        gc.collect()
+        with self.assertRaises(OSError):
+            os.fstat(fd)
+
+    def test_temporary_locks(self):
+        with prwlock.RWLock().writer_lock():
+            pass
+        with prwlock.RWLock().reader_lock():
+            pass
+        arena = prwlock.RWLockArena(64)
+        with arena[42].reader_lock():
+            self.assertEqual(arena[42].nlocks, 1)
+        arena[7].acquire_write()
+        self.assertEqual(arena[7].nlocks, 1)
+        arena[7].release()
+
+    def test_decorators(self):
+        @self.rwlock.reads
+        def read(value):
+            """Reads"""
+            return value, self.rwlock.nlocks
+
+        @self.rwlock.writes(timeout=.1)
+        def write():
+            q = mp.Queue()
+            self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+
+        self.assertEqual(read(5), (5, 1))
+        self.assertEqual(read.__doc__, 'Reads')
+        self.assertIs(read.lock, self.rwlock)
+        write()
+        self.assertEqual(self.rwlock.nlocks, 0)
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(self.rwlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        try:
+            with self.assertRaises(ValueError):
+                write()
+        finally:
+            done.set()
+            p.join()
+
+
+class RWLockArenaTestCase(BaseTestCase):
+
+    def setUp(self):
+        self.arena = prwlock.RWLockArena(128)
+
+    def test_capacity(self):
+        self.assertEqual(len(self.arena), 128)
+        self.arena[127]
+        self.arena[-1]
+        with self.assertRaises(IndexError):
+            self.arena[128]
+        with self.assertRaises(ValueError):
+            prwlock.RWLockArena(0)
+
+    def test_single_descriptor(self):
+        fds = set(self.arena[i].arena._fd for i in range(len(self.arena)))
+        self.assertEqual(len(fds), 1)
+
+    def test_slot_alignment(self):
+        self.assertEqual(self.arena.slot_size % 64, 0)
+        addresses = [mmap_address(self.arena[i]) for i in range(4)]
+        for a, b in zip(addresses, addresses[1:]):
+            self.assertEqual(b - a, self.arena.slot_size)
+
+    def test_independent_slots(self):
+        first, second = self.arena[0], self.arena[1]
+        first.acquire_write()
+        self.assertTrue(second.try_acquire_write())
+        second.release()
+        first.release()
+
+    def test_handles_are_cached(self):
+        self.assertIs(self.arena[3], self.arena[3])
+        self.assertIs(self.arena[-1], self.arena[127])
+        self.arena[3].acquire_write()
+        self.assertEqual(self.arena[3].nlocks, 1)
+        self.arena[3].release()
+
+    def test_double_release(self):
+        with self.assertRaises(ValueError):
+            self.arena[0].release()
+
+    def test_serialization(self):
+        handle = self.arena[5]
+        t = pickle.loads(pickle.dumps(handle))
+        self.assertEqual(t.index, 5)
+        self.assertEqual(t.arena._fd, self.arena._fd)
+        handle.acquire_write()
+        self.assertFalse(t.try_acquire_read())
+        handle.release()
+        self.assertTrue(t.try_acquire_read())
+        t.release()
+
+    def test_context_managers(self):
+        handle = self.arena[7]
+        with handle.reader_lock(timeout=1):
+            pass
+        with handle.writer_lock(timeout=1):
+            pass
+
+    def test_try_acquire(self):
+        handle = self.arena[9]
+        handle.acquire_write()
+        q = mp.Queue()
+        self.acquire_lock(try_acquire_write, handle, q, False)
+        self.acquire_lock(try_acquire_read, handle, q, False)
+        handle.release()
+        self.acquire_lock(try_acquire_write, handle, q, True)
+        self.acquire_lock(try_acquire_read, handle, q, True)
+
+    def test_child_interaction(self):
+        children = 4
+        handles = [self.arena[i] for i in range(children)]
+        pool = Pool(processes=children)
+        ret = [pool.apply_async(f, args=[handle]) for handle in handles]
+        time.sleep(.1)
+        for handle in handles:
+            handle.acquire_write()
+        time.sleep(.5)
+        for handle in handles:
+            handle.release()
+        pool.close()
+        pool.join()
+        self.assertTrue(all([r.successful() for r in ret]))
+
+
+class RWLockPolicyTestCase(BaseTestCase):
+    def test_invalid_policy(self):
+        with self.assertRaises(ValueError):
+            prwlock.RWLock(policy='lifo')
+
+    def test_policies(self):
+        for policy in (prwlock.PREFER_READER, prwlock.PREFER_WRITER,
+                       prwlock.FAIR):
+            rwlock = prwlock.RWLock(policy=policy)
+            self.assertTrue(rwlock.acquire_read(timeout=1))
+            self.assertFalse(rwlock.try_acquire_write())
+            rwlock.release()
+            self.assertTrue(rwlock.acquire_write(timeout=1))
+            q = mp.Queue()
+            self.acquire_lock(acquire_read_timeout, rwlock, q, False)
+            rwlock.release()
+            self.acquire_lock(acquire_read_timeout, rwlock, q, True)
+            self.assertEqual(rwlock.nlocks, 0)
+
+    def test_serialization(self):
+        rwlock = prwlock.RWLock(policy=prwlock.FAIR)
+        t = pickle.loads(pickle.dumps(rwlock))
+        self.assertEqual(t.policy, prwlock.FAIR)
+        self.assertIsNotNone(t._turnstile_p)
+
+    def check_waiting_writer(self, rwlock, readers_pass):
+        rwlock.acquire_read()
+        q = mp.Queue()
+        writer = mp.Process(target=acquire_write_blocking, args=(rwlock, q))
+        writer.start()
+        # Give the writer time to queue up behind our read lock
+        time.sleep(.3)
+        self.acquire_lock(try_acquire_read, rwlock, q, readers_pass)
+        rwlock.release()
+        self.assertTrue(q.get(timeout=5))
+        writer.join()
+
+    def test_prefer_reader(self):
+        self.check_waiting_writer(
+            prwlock.RWLock(policy=prwlock.PREFER_READER), True)
+
+    def test_prefer_writer(self):
+        self.check_waiting_writer(
+            prwlock.RWLock(policy=prwlock.PREFER_WRITER), False)
+
+    def test_fair(self):
+        self.check_waiting_writer(prwlock.RWLock(policy=prwlock.FAIR), False)
+
+    def test_fair_fallback(self):
+        rwlock = prwlock.RWLock(policy=prwlock.FAIR)
+        rwlock._unbind_core()
+        self.check_waiting_writer(rwlock, False)
+
+
+class RWLockStatsTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(stats=True)
+
+    def test_disabled(self):
+        rwlock = prwlock.RWLock()
+        rwlock.acquire_read()
+        rwlock.release()
+        stats = rwlock.stats()
+        self.assertFalse(stats['enabled'])
+        self.assertEqual(stats['reads'], 0)
+
+    def test_counts(self):
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read(timeout=1)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.assertFalse(self.rwlock.try_acquire_read())
+        self.rwlock.release()
+        stats = self.rwlock.stats()
+        self.assertTrue(stats['enabled'])
+        self.assertEqual(stats['reads'], 2)
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['contended'], 1)
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertEqual(sum(stats['wait_histogram']), 3)
+        self.assertGreater(stats['hold_ns'], 0)
+        self.assertGreaterEqual(stats['hold_ns'], stats['hold_max_ns'])
+
+    def test_contention(self):
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(self.rwlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.assertFalse(self.rwlock.acquire_read(timeout=.05))
+        # Lets the child go once we wait again, so that this wait contends
+        threading.Timer(.1, done.set).start()
+        self.assertTrue(self.rwlock.acquire_read(timeout=5))
+        self.rwlock.release()
+        p.join()
+        stats = self.rwlock.stats()
+        # The child's acquisition is accounted for, too
+        self.assertEqual(stats['writes'], 1)
+        self.assertEqual(stats['reads'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertEqual(stats['contended'], 2)
+        self.assertGreater(stats['hold_max_ns'], 0)
+        self.assertEqual(stats['wait_ns'], stats['wait_max_ns'])
+
+    def test_reset(self):
+        self.rwlock.acquire_write()
+        self.rwlock.release()
+        self.rwlock.reset_stats()
+        stats = self.rwlock.stats()
+        self.assertEqual(stats['writes'], 0)
+        self.assertEqual(stats['wait_histogram'],
+                         [0] * prwlock._prwlock.STATS_BUCKETS)
+
+    def test_fallback(self):
+        self.rwlock._unbind_core()
+        self.test_counts()
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertTrue(t.stats()['enabled'])
+
+    def test_named(self):
+        name = 'test-stats-%d' % os.getpid()
+        rwlock = prwlock.RWLock.open(name, stats=True)
+        try:
+            other = prwlock.RWLock.open(name)
+            other.acquire_read()
+            other.release()
+            self.assertEqual(rwlock.stats()['reads'], 1)
+        finally:
+            prwlock.RWLock.unlink(name)
+
+
+class RWLockNamedTestCase(BaseTestCase):
+    def setUp(self):
+        self.name = 'test-%d-%d' % (os.getpid(), id(self))
+        self.rwlock = prwlock.RWLock.open(self.name)
+
+    def tearDown(self):
+        super(RWLockNamedTestCase, self).tearDown()
+        try:
+            prwlock.RWLock.unlink(self.name)
+        except OSError:
+            pass
+
+    def test_attach(self):
+        other = prwlock.RWLock.open(self.name, create=False)
+        # Both share the mapping of the lock
+        self.assertIs(other._buf, self.rwlock._buf)
+        self.rwlock.acquire_write()
+        self.assertFalse(other.try_acquire_read())
+        self.rwlock.release()
+        self.assertTrue(other.try_acquire_read())
+        self.assertFalse(self.rwlock.try_acquire_write())
+        other.release()
+
+    def test_missing(self):
+        prwlock.RWLock.unlink(self.name)
+        with self.assertRaises(OSError):
+            prwlock.RWLock.open(self.name, create=False)
+
+    def test_invalid_name(self):
+        for name in ('', 'a/b'):
+            with self.assertRaises(ValueError):
+                prwlock.RWLock.open(name)
+
+    def test_policy_is_shared(self):
+        name = self.name + '-fair'
+        fair = prwlock.RWLock.open(name, policy=prwlock.FAIR)
+        try:
+            other = prwlock.RWLock.open(name)
+            self.assertEqual(other.policy, prwlock.FAIR)
+            self.assertIsNotNone(other._turnstile_p)
+            self.assertIs(other._buf, fair._buf)
+        finally:
+            prwlock.RWLock.unlink(name)
+
+    def test_uninitialized(self):
+        # A creator that died before finishing setting the lock up
+        name = self.name + '-dead'
+        fd = prwlock._prwlock._shm_open(prwlock._prwlock._shm_name(name),
+                                        os.O_RDWR | os.O_CREAT, 0o600)
+        os.close(fd)
+        old_timeout = prwlock._prwlock.INIT_TIMEOUT
+        prwlock._prwlock.INIT_TIMEOUT = .1
+        try:
+            with self.assertRaises(OSError):
+                prwlock.RWLock.open(name)
+        finally:
+            prwlock._prwlock.INIT_TIMEOUT = old_timeout
+            prwlock.RWLock.unlink(name)
+
+    def test_concurrent_creation(self):
+        name = self.name + '-race'
+        children = 4
+        pool = Pool(processes=children)
+        try:
+            ret = pool.map(open_and_lock, [name] * children)
+        finally:
+            pool.close()
+            pool.join()
+            prwlock.RWLock.unlink(name)
+        self.assertEqual(ret, [True] * children)
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertEqual(t.name, self.name)
+        self.assertIs(t._buf, self.rwlock._buf)
+
+    def test_spawned_child(self):
+        self.rwlock.acquire_read()
+        ctx = mp.get_context('spawn')
+        q = ctx.Queue()
+        p = ctx.Process(target=acquire_write_timeout, args=(self.rwlock, q))
+        p.start()
+        self.assertFalse(q.get(timeout=30))
+        p.join()
+        self.rwlock.release()
+
+
+class RWLockUpgradeableTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(upgradeable=True)
+
+    def test_excludes_writers_and_upgraders(self):
+        q = mp.Queue()
+        self.assertTrue(self.rwlock.acquire_upgradeable())
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.acquire_lock(try_acquire_read, self.rwlock, q)
+        self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        self.acquire_lock(acquire_upgradeable_timeout, self.rwlock, q, False)
+        self.rwlock.release()
+        self.acquire_lock(acquire_upgradeable_timeout, self.rwlock, q)
+        self.acquire_lock(try_acquire_write, self.rwlock, q)
+
+    def test_upgrade_waits_for_readers(self):
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_read, args=(self.rwlock, done, locked))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.rwlock.acquire_upgradeable()
+        self.assertFalse(self.rwlock.upgrade(timeout=.1))
+        # Still upgradeable after timing out
+        self.assertFalse(self.rwlock.try_acquire_write())
+        threading.Timer(.1, done.set).start()
+        self.assertTrue(self.rwlock.upgrade(timeout=5))
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        p.join()
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+
+    def test_no_writer_in_between(self):
+        q = mp.Queue()
+        self.rwlock.acquire_upgradeable()
+        p = mp.Process(target=acquire_write_reporting_time,
+                       args=(self.rwlock, q))
+        p.start()
+        time.sleep(.2)
+        self.rwlock.upgrade()
+        self.rwlock.downgrade()
+        released = time.time()
+        self.rwlock.release()
+        self.assertGreaterEqual(q.get(), released)
+        p.join()
+
+    def test_downgrade(self):
+        q = mp.Queue()
+        self.rwlock.acquire_write()
+        self.rwlock.downgrade()
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.acquire_lock(try_acquire_read, self.rwlock, q)
+        self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        # A downgraded writer is a plain reader
+        self.acquire_lock(acquire_upgradeable_timeout, self.rwlock, q)
+        self.rwlock.release()
+        self.acquire_lock(try_acquire_write, self.rwlock, q)
+
+    def test_invalid_use(self):
+        with self.assertRaises(ValueError):
+            self.rwlock.upgrade()
+        with self.assertRaises(ValueError):
+            self.rwlock.downgrade()
+        self.rwlock.acquire_upgradeable()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_upgradeable()
+        self.rwlock.acquire_read()
+        with self.assertRaises(OSError):
+            self.rwlock.upgrade()
+        self.rwlock.release()
+        self.rwlock.release()
+        with self.assertRaises(ValueError):
+            prwlock.RWLock().acquire_upgradeable()
+
+    def test_context_managers(self):
+        q = mp.Queue()
+        with self.rwlock.upgradeable_lock(timeout=1):
+            with self.rwlock.upgraded_lock():
+                self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+            self.acquire_lock(try_acquire_read, self.rwlock, q)
+            self.acquire_lock(try_acquire_write, self.rwlock, q, False)
+        self.assertEqual(self.rwlock.nlocks, 0)
+        self.acquire_lock(try_acquire_write, self.rwlock, q)
+
+    def test_fallback(self):
+        self.rwlock._unbind_core()
+        self.test_downgrade()
+        self.test_context_managers()
+
+    def test_named(self):
+        name = 'test-upgradeable-%d' % os.getpid()
+        rwlock = prwlock.RWLock.open(name, upgradeable=True)
+        try:
+            other = prwlock.RWLock.open(name)
+            self.assertTrue(other.upgradeable)
+            rwlock.acquire_upgradeable()
+            self.assertFalse(other.try_acquire_write())
+            rwlock.release()
+        finally:
+            prwlock.RWLock.unlink(name)
+
+
+@unittest.skipUnless(hasattr(prwlock._prwlock.librt,
+                             'pthread_mutex_consistent'),
+                     'robust mutexes needed')
+class RWLockRobustTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(robust=True)
+
+    def die_holding(self, method):
+        locked = mp.Event()
+        p = mp.Process(target=die_holding, args=(self.rwlock, method, locked))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        return p
+
+    def test_owners(self):
+        owners = self.rwlock._owners
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read()
+        readers = [(r.pid, r.count) for r in owners.readers if r.pid]
+        self.assertEqual(readers, [(os.getpid(), 2)])
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.assertEqual(owners.writer, os.getpid())
+        self.rwlock.release()
+        self.assertEqual(owners.writer, 0)
+        self.assertFalse(any(r.pid for r in owners.readers))
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_invalid_options(self):
+        with self.assertRaises(ValueError):
+            prwlock.RWLock(policy=prwlock.FAIR, robust=True)
+
+    def test_deadlock(self):
+        self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_read(timeout=.1)
+        self.rwlock.release()
+
+    def test_live_owners_are_kept(self):
+        q = mp.Queue()
+        self.rwlock.acquire_read()
+        self.acquire_lock(acquire_write_timeout, self.rwlock, q, False)
+        self.rwlock.release()
+        self.rwlock.acquire_write()
+        self.acquire_lock(acquire_read_timeout, self.rwlock, q, False)
+        self.rwlock.release()
+
+    def test_dead_writer(self):
+        p = self.die_holding('write')
+        start = time.time()
+        with self.assertRaises(prwlock.OwnerDeadError) as cm:
+            self.rwlock.acquire_read(timeout=5)
+        self.assertLess(time.time() - start, 2)
+        self.assertEqual(cm.exception.pid, p.pid)
+        # The lock was acquired anyway
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        self.assertTrue(self.rwlock.acquire_write(timeout=0))
+        self.rwlock.release()
+        p.join()
+
+    def test_dead_writer_blocking(self):
+        p = self.die_holding('write')
+        p.join()
+        with self.assertRaises(prwlock.OwnerDeadError):
+            self.rwlock.acquire_write()
+        self.rwlock.release()
+
+    def test_dead_writer_context_manager(self):
+        p = self.die_holding('write')
+        with self.assertRaises(prwlock.OwnerDeadError):
+            with self.rwlock.writer_lock(timeout=5):
+                pass
+        # Released by the context manager
+        self.assertEqual(self.rwlock.nlocks, 0)
+        with self.rwlock.writer_lock(timeout=0):
+            pass
+        p.join()
+
+    def test_dead_readers(self):
+        dead = self.die_holding('read')
+        done = mp.Event()
+        live = mp.Process(target=hold_read, args=(self.rwlock, done))
+        live.start()
+        # Only once every reader is gone is the lock reclaimed, silently
+        while not any(r.pid == live.pid for r in self.rwlock._owners.readers):
+            time.sleep(.01)
+        self.assertFalse(self.rwlock.acquire_write(timeout=.3))
+        done.set()
+        self.assertTrue(self.rwlock.acquire_write(timeout=5))
+        self.rwlock.release()
+        live.join()
+        dead.join()
+
+    def test_try_acquire_does_not_reclaim(self):
+        p = self.die_holding('write')
+        p.join()
+        self.assertFalse(self.rwlock.try_acquire_read())
+        with self.assertRaises(prwlock.OwnerDeadError):
+            self.rwlock.acquire_read(timeout=1)
+        self.rwlock.release()
+
+    def test_stats(self):
+        rwlock = prwlock.RWLock(stats=True, robust=True)
+        rwlock.acquire_write()
+        rwlock.release()
+        self.assertEqual(rwlock.stats()['writes'], 1)
+
+    def test_named(self):
+        name = 'test-robust-%d' % os.getpid()
+        rwlock = prwlock.RWLock.open(name, robust=True)
+        try:
+            other = prwlock.RWLock.open(name)
+            self.assertTrue(other.robust)
+            rwlock.acquire_write()
+            self.assertEqual(other._owners.writer, os.getpid())
+            rwlock.release()
+        finally:
+            prwlock.RWLock.unlink(name)
+
+    def test_serialization(self):
+        q = mp.Queue()
+        self.rwlock.acquire_write()
+        self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+        self.rwlock.release()
+        p = self.die_holding('write')
+        p.join()
+        # The child reclaims the lock
+        p = mp.Process(target=acquire_reporting_owner_death,
+                       args=(self.rwlock, q))
+        p.start()
+        self.assertEqual(q.get(), 'owner died')
+        p.join()
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+
+
+class RWLockDataTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(data_size=16)
+
+    def test_no_data(self):
+        rwlock = prwlock.RWLock()
+        self.assertIsNone(rwlock.buffer)
+        with rwlock.reader_lock() as view:
+            self.assertIsNone(view)
+        with self.assertRaises(ValueError):
+            prwlock.RWLock(data_size=-1)
+
+    def test_views(self):
+        self.assertEqual(len(self.rwlock.buffer), 16)
+        with self.rwlock.writer_lock() as view:
+            self.assertFalse(view.readonly)
+            view[:5] = b'hello'
+        with self.rwlock.reader_lock() as view:
+            self.assertTrue(view.readonly)
+            self.assertEqual(bytes(view[:5]), b'hello')
+            with self.assertRaises(TypeError):
+                view[0:1] = b'x'
+
+    def test_large_data(self):
+        rwlock = prwlock.RWLock(data_size=2 * mmap.PAGESIZE)
+        rwlock.buffer[-1:] = b'z'
+        self.assertEqual(bytes(rwlock.buffer[-1:]), b'z')
+        self.assertGreater(len(rwlock._buf), 2 * mmap.PAGESIZE)
+
+    def test_serialization(self):
+        self.rwlock.buffer[:6] = b'shared'
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertEqual(t.data_size, 16)
+        self.assertEqual(bytes(t.buffer[:6]), b'shared')
+
+    def test_child_writes(self):
+        p = mp.Process(target=write_data, args=(self.rwlock, b'child'))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        with self.rwlock.reader_lock() as view:
+            self.assertEqual(bytes(view[:5]), b'child')
+
+    def test_named(self):
+        name = 'test-%d-%d' % (os.getpid(), id(self))
+        rwlock = prwlock.RWLock.open(name, data_size=8)
+        try:
+            other = prwlock.RWLock.open(name, data_size=100)
+            self.assertEqual(other.data_size, 8)
+            rwlock.buffer[:] = b'12345678'
+            self.assertEqual(bytes(other.buffer), b'12345678')
+        finally:
+            prwlock.RWLock.unlink(name)
+
+
+class RWLockAdaptiveTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(adaptive=True)
+
+    def test_options(self):
+        self.assertTrue(self.rwlock.adaptive)
+        self.assertFalse(prwlock.RWLock().adaptive)
+        with self.assertRaises(ValueError):
+            prwlock.RWLock(robust=True, adaptive=True)
+
+    def test_learns_short_holds(self):
+        for i in range(50):
+            self.rwlock.acquire_write()
+            self.rwlock.release()
+        budget = self.rwlock.stats()['spin_budget_ns']
+        self.assertGreater(budget, 0)
+        self.assertLessEqual(budget, prwlock._prwlock.MAX_SPIN_NS)
+
+    def test_long_holds_shrink_budget(self):
+        self.rwlock._spin_data.budget_ns = 20000
+        self.rwlock.acquire_read()
+        time.sleep(.01)
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.stats()['spin_budget_ns'], 17500)
+
+    def test_spins_before_blocking(self):
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(self.rwlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.assertFalse(self.rwlock.acquire_read(timeout=.05))
+        threading.Timer(.1, done.set).start()
+        self.assertTrue(self.rwlock.acquire_read(timeout=5))
+        self.rwlock.release()
+        p.join()
+        stats = self.rwlock.stats()
+        self.assertEqual(stats['spins'], 2)
+        self.assertEqual(stats['spin_acquired'], 0)
+        self.rwlock.reset_stats()
+        self.assertEqual(self.rwlock.stats()['spins'], 0)
+
+    def test_disabled(self):
+        saved = prwlock._prwlock.SPIN_DISABLED
+
+        def restore():
+            prwlock._prwlock.SPIN_DISABLED = saved
+        self.addCleanup(restore)
+        prwlock._prwlock.SPIN_DISABLED = True
+        rwlock = prwlock.RWLock(adaptive=True)
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(rwlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.assertFalse(rwlock.acquire_read(timeout=.01))
+        done.set()
+        p.join()
+        self.assertEqual(rwlock.stats()['spins'], 0)
+        self.assertEqual(rwlock.stats()['spin_budget_ns'], 0)
+
+    def test_fallback(self):
+        self.rwlock._unbind_core()
+        self.test_learns_short_holds()
+        self.test_long_holds_shrink_budget()
+
+    def test_shared_budget(self):
+        self.rwlock._spin_data.budget_ns = 1234
+        q = mp.Queue()
+        p = mp.Process(target=report_spin_budget, args=(self.rwlock, q))
+        p.start()
+        self.assertEqual(q.get(timeout=5), (True, 1234))
+        p.join()
+
+    def test_fallback_deadline(self):
+        self.rwlock._unbind_core()
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_write, args=(self.rwlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.rwlock._spin_data.budget_ns = prwlock._prwlock.MAX_SPIN_NS
+        start = time.time()
+        self.assertFalse(self.rwlock.acquire_read(timeout=.2))
+        self.assertLess(time.time() - start, .35)
+        done.set()
+        p.join()
+
+    def test_named(self):
+        name = 'test-%d-%d' % (os.getpid(), id(self))
+        rwlock = prwlock.RWLock.open(name, adaptive=True)
+        try:
+            other = prwlock.RWLock.open(name)
+            self.assertTrue(other.adaptive)
+            other.acquire_read()
+            other.release()
+            self.assertGreater(rwlock.stats()['spin_budget_ns'], 0)
+        finally:
+            prwlock.RWLock.unlink(name)
+
+
+class RWLockReentrantTestCase(BaseTestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock(policy=prwlock.PREFER_WRITER,
+                                     reentrant=True)
+
+    def test_nested_write(self):
+        q = mp.Queue()
+        self.assertTrue(self.rwlock.acquire_write())
+        self.assertTrue(self.rwlock.acquire_write(timeout=1))
+        self.assertTrue(self.rwlock.try_acquire_read())
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.acquire_lock(try_acquire_read, self.rwlock, q, False)
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+        self.acquire_lock(try_acquire_write, self.rwlock, q)
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_write_inside_read(self):
+        self.rwlock.acquire_read()
+        with self.assertRaises(OSError):
+            self.rwlock.acquire_write()
+        self.assertFalse(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_nested_read_with_waiting_writer(self):
+        q = mp.Queue()
+        self.rwlock.acquire_read()
+        p = mp.Process(target=acquire_write_blocking, args=(self.rwlock, q))
+        p.start()
+        time.sleep(.2)
+        # A second rdlock would wait for the writer, which waits for us
+        self.assertTrue(self.rwlock.acquire_read(timeout=.2))
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertTrue(q.get(timeout=5))
+        p.join()
+
+    def test_threads(self):
+        self.rwlock.acquire_write()
+        self.rwlock.acquire_write()
+        results = []
+        t = threading.Thread(target=lambda: results.append(
+            self.rwlock.try_acquire_write()))
+        t.start()
+        t.join()
+        self.assertEqual(results, [False])
+        self.rwlock.release()
+        self.rwlock.release()
+        with self.rwlock.reader_lock():
+            t = threading.Thread(target=lambda: results.append(
+                self.rwlock.try_acquire_read()))
+            t.start()
+            t.join()
+            self.assertEqual(self.rwlock.nlocks, 2)
+            self.rwlock.release()
+        self.assertEqual(results, [False, True])
+
+    def test_context_managers(self):
+        with self.rwlock.writer_lock():
+            with self.rwlock.writer_lock():
+                with self.rwlock.reader_lock():
+                    self.assertEqual(self.rwlock.nlocks, 1)
+            self.assertEqual(self.rwlock.nlocks, 1)
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_serialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertTrue(t.reentrant)
+        self.assertFalse(prwlock.RWLock().reentrant)
+
+    def test_destruction_releases(self):
+        q = mp.Queue()
+        rwlock = prwlock.RWLock(reentrant=True)
+        other = pickle.loads(pickle.dumps(rwlock))
+        rwlock.acquire_write()
+        rwlock.acquire_write()
+        rwlock._del_lock()
+        self.acquire_lock(try_acquire_write, other, q)
+
+    @unittest.skipUnless(hasattr(prwlock._prwlock.librt,
+                                 'pthread_mutex_consistent'),
+                         'robust mutexes needed')
+    def test_robust(self):
+        rwlock = prwlock.RWLock(robust=True, reentrant=True)
+        rwlock.acquire_write()
+        rwlock.acquire_read()
+        self.assertEqual(rwlock.nlocks, 1)
+        rwlock.release()
+        rwlock.release()
+        self.assertEqual(rwlock.nlocks, 0)
+
+
+class RWLockAttachTestCase(BaseTestCase):
+
+    def test_repeated_unpickling(self):
+        s = pickle.dumps(self.rwlock)
+        copies = [pickle.loads(s) for i in range(3)]
+        for copy in copies:
+            self.assertIs(copy._buf, self.rwlock._buf)
+            self.assertEqual(copy._fd, self.rwlock._fd)
+        self.assertEqual(self.rwlock._mapping.refs, 4)
+        del copy, copies
+        self.assertEqual(self.rwlock._mapping.refs, 1)
+        # Copies going away leave the descriptor and the lock alone
+        os.fstat(self.rwlock._fd)
+        self.assertTrue(self.rwlock.acquire_write(timeout=1))
+        self.rwlock.release()
+
+    def test_copy_outlives_original(self):
+        copy = pickle.loads(pickle.dumps(self.rwlock))
+        del self.rwlock
+        os.fstat(copy._fd)
+        self.assertTrue(copy.acquire_write(timeout=1))
+        copy.release()
+
+    def test_only_creator_destroys(self):
+        self.assertTrue(self.rwlock._mapping.destroys())
+        copy = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertFalse(self.rwlock._mapping.destroys())
+        del copy
+        self.assertTrue(self.rwlock._mapping.destroys())
+        q = mp.Queue()
+        p = mp.Process(target=report_destroys, args=(self.rwlock, q))
+        p.start()
+        self.assertFalse(q.get(timeout=5))
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+
+    def test_named(self):
+        name = 'prwlock-test-{}-attach'.format(os.getpid())
+        rwlock = prwlock.RWLock.open(name)
+        try:
+            other = prwlock.RWLock.open(name, create=False)
+            self.assertIs(other._buf, rwlock._buf)
+            self.assertEqual(rwlock._mapping.refs, 2)
+            del other
+            rwlock.acquire_write()
+            rwlock.release()
+        finally:
+            prwlock.RWLock.unlink(name)
+
+    def test_arena_copies(self):
+        arena = prwlock.RWLockArena(4)
+        handle = arena[1]
+        copies = [pickle.loads(pickle.dumps(handle)) for i in range(3)]
+        self.assertIs(copies[0].arena._buf, arena._buf)
+        del copies
+        os.fstat(arena._fd)
+        handle.acquire_write()
+        handle.release()
+
+    def test_pool_initializer(self):
+        pool = Pool(processes=2, initializer=prwlock.install_locks,
+                    initargs=({'lock': self.rwlock},))
+        try:
+            self.rwlock.acquire_write()
+            self.assertEqual(pool.map(try_installed_read, range(4)),
+                             [False] * 4)
+            self.rwlock.release()
+            self.assertEqual(pool.map(try_installed_read, range(4)),
+                             [True] * 4)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_pool_chained_initializer(self):
+        pool = Pool(processes=1, initializer=prwlock.install_locks,
+                    initargs=({}, install_extra, (self.rwlock,)))
+        try:
+            self.assertEqual(pool.map(try_installed_read, range(2)),
+                             [True] * 2)
+        finally:
+            pool.close()
+            pool.join()
+
+    def test_not_installed(self):
+        with self.assertRaises(KeyError):
+            prwlock.installed_lock('prwlock-test-missing')
+
+
+# Fails if importing prwlock, or using a lock, starts a process or imports
+# asyncio
+CHEAP_IMPORT = """
+import sys, subprocess
+def fail(*args, **kwargs):
+    raise AssertionError('subprocess started')
+subprocess.Popen.__init__ = fail
+import prwlock
+rwlock = prwlock.RWLock()
+rwlock.acquire_read()
+assert 'asyncio' not in sys.modules
+assert prwlock.AsyncRWLock is not None or sys.version_info < (3, 7)
+"""
+
+
+class ImportTestCase(unittest.TestCase):
+    def test_cheap_import(self):
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+            os.path.abspath(prwlock.__file__)))
+        subprocess.check_call([sys.executable, '-c', CHEAP_IMPORT], env=env)
+
+    def test_lazy_binding(self):
+        librt = prwlock._prwlock.librt
+        self.assertIsNotNone(librt.pthread_rwlock_unlock.errcheck)
+        self.assertEqual(librt.pthread_rwlock_trywrlock.argtypes,
+                         [prwlock._prwlock.pthread_rwlock_t_p])
+        self.assertFalse(hasattr(librt, 'no_such_function'))
+
+
+def report_destroys(rwlock, queue):
+    queue.put(rwlock._mapping.destroys())
+
+
+def try_installed_read(task):
+    rwlock = prwlock.installed_lock('lock')
+    if rwlock.try_acquire_read():
+        rwlock.release()
+        return True
+    return False
+
+
+def install_extra(rwlock):
+    prwlock.install_locks({'lock': rwlock})
+
+
+def write_data(rwlock, data):
+    with rwlock.writer_lock() as view:
+        view[:len(data)] = data
+
+
+def report_spin_budget(rwlock, queue):
+    queue.put((rwlock.adaptive, rwlock.stats()['spin_budget_ns']))
+
+
+def open_and_lock(name):
+    rwlock = prwlock.RWLock.open(name)
+    ret = rwlock.acquire_write(timeout=5)
+    rwlock.release()
+    return ret
+
+
+def mmap_address(handle):
+    return ctypes.addressof(handle._lock)
+
 
 def f(rwlock):
     for i in range(2):
@@ -145,6 +1250,34 @@ def f(rwlock):
         time.sleep(.1)
 
 
+def timed_read_duration(rwlock, queue, timeout):
+    start = time.time()
+    ret = rwlock.acquire_read(timeout)
+    queue.put((ret, time.time() - start))
+    if ret:
+        rwlock.release()
+
+
+def poll_read_handoff(rwlock, queue, timeout=5):
+    ret = rwlock._loop_timedrdlock(rwlock._lock_p, timeout)
+    queue.put((ret, time.time()))
+    if ret:
+        librt = prwlock._prwlock.librt
+        librt.pthread_rwlock_unlock(rwlock._lock_p)
+
+
+def hold_write(rwlock, locked, done):
+    rwlock.acquire_write()
+    locked.set()
+    done.wait(5)
+    rwlock.release()
+
+
+def acquire_write_blocking(rwlock, queue):
+    queue.put(rwlock.acquire_write())
+    rwlock.release()
+
+
 def acquire_read_timeout(rwlock, queue):
     ret = rwlock.acquire_read(.3)
     queue.put(ret)
@@ -171,3 +1304,40 @@ def try_acquire_read(rwlock, queue):
     queue.put(ret)
     if ret:
         rwlock.release()
+
+
+def die_holding(rwlock, method, locked):
+    getattr(rwlock, 'acquire_' + method)()
+    locked.set()
+    os.kill(os.getpid(), signal.SIGKILL)
+
+
+def hold_read(rwlock, done, locked=None):
+    rwlock.acquire_read()
+    if locked is not None:
+        locked.set()
+    done.wait(5)
+    rwlock.release()
+
+
+def acquire_upgradeable_timeout(rwlock, queue):
+    ret = rwlock.acquire_upgradeable(timeout=.1)
+    queue.put(ret)
+    if ret:
+        rwlock.release()
+
+
+def acquire_write_reporting_time(rwlock, queue):
+    rwlock.acquire_write()
+    queue.put(time.time())
+    rwlock.release()
+
+
+def acquire_reporting_owner_death(rwlock, queue):
+    try:
+        rwlock.acquire_write(timeout=5)
+    except prwlock.OwnerDeadError:
+        queue.put('owner died')
+    else:
+        queue.put('acquired')
+    rwlock.release()
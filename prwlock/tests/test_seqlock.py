@@ -0,0 +1,159 @@
+from __future__ import print_function
+
+import time
+import ctypes
+import pickle
+import struct
+import unittest
+
+import prwlock
+import multiprocessing as mp
+from prwlock import seqlock
+
+PAIR = struct.Struct('=QQ')
+
+
+class Record(ctypes.Structure):
+    _fields_ = [
+        ('epoch', ctypes.c_uint64),
+        ('value', ctypes.c_double),
+    ]
+
+
+class SeqLockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.seqlock = prwlock.SeqLock(ctypes.sizeof(Record))
+
+    def test_invalid_size(self):
+        with self.assertRaises(ValueError):
+            prwlock.SeqLock(0)
+
+    def test_write_read(self):
+        self.assertEqual(self.seqlock.read_bytes(), b'\0' * 16)
+        self.seqlock.write(b'abc', offset=2)
+        self.assertEqual(self.seqlock.read_bytes(3, offset=2), b'abc')
+        self.assertEqual(bytes(self.seqlock.buffer[:5]), b'\0\0abc')
+
+    def test_read_layouts(self):
+        self.seqlock.write(bytes(Record(3, 1.5)))
+        record = self.seqlock.read(Record)
+        self.assertEqual((record.epoch, record.value), (3, 1.5))
+        self.assertEqual(self.seqlock.read('=Qd'), (3, 1.5))
+        self.assertEqual(self.seqlock.read(struct.Struct('=d'), offset=8),
+                         (1.5,))
+
+    def test_bounds(self):
+        with self.assertRaises(ValueError):
+            self.seqlock.read_bytes(17)
+        with self.assertRaises(ValueError):
+            self.seqlock.read_bytes(8, offset=9)
+        with self.assertRaises(ValueError):
+            self.seqlock.read_bytes(offset=-1)
+        with self.assertRaises(ValueError):
+            self.seqlock.write(b'x' * 10, offset=8)
+        with self.assertRaises(ValueError):
+            self.seqlock.read(ctypes.c_char * 17)
+
+    def test_sequence(self):
+        self.assertEqual(self.seqlock.sequence, 0)
+        self.assertTrue(self.seqlock.write_begin())
+        self.assertEqual(self.seqlock.sequence, 1)
+        self.seqlock.write_end()
+        self.assertEqual(self.seqlock.sequence, 2)
+        with self.assertRaises(ValueError):
+            self.seqlock.write_end()
+
+    def test_read_retry(self):
+        seq = self.seqlock.read_begin()
+        self.assertFalse(self.seqlock.read_retry(seq))
+        self.seqlock.write(b'x')
+        self.assertTrue(self.seqlock.read_retry(seq))
+        self.assertFalse(self.seqlock.read_retry(self.seqlock.read_begin()))
+
+    def test_writer_context_manager(self):
+        with self.seqlock.writer() as view:
+            self.assertEqual(self.seqlock.sequence % 2, 1)
+            view[:8] = PAIR.pack(7, 7)[:8]
+        self.assertEqual(self.seqlock.sequence, 2)
+        self.assertEqual(self.seqlock.read('=Q'), (7,))
+
+    def test_writer_timeout(self):
+        locked, done = mp.Event(), mp.Event()
+        p = mp.Process(target=hold_writer, args=(self.seqlock, locked, done))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        self.assertFalse(self.seqlock.write_begin(timeout=.1))
+        with self.assertRaises(ValueError):
+            with self.seqlock.writer(timeout=.1):
+                pass
+        done.set()
+        p.join()
+        self.assertTrue(self.seqlock.write_begin(timeout=1))
+        self.seqlock.write_end()
+
+    def test_consistent_reads(self):
+        seqlock = prwlock.SeqLock(PAIR.size)
+        stop = mp.Event()
+        p = mp.Process(target=write_pairs, args=(seqlock, stop))
+        p.start()
+        try:
+            seen = set()
+            deadline = time.time() + 5
+            while len(seen) < 50 and time.time() < deadline:
+                first, second = seqlock.read(PAIR)
+                self.assertEqual(first, second)
+                seen.add(first)
+        finally:
+            stop.set()
+            p.join()
+        self.assertGreater(len(seen), 1)
+
+    def test_serialization(self):
+        self.seqlock.write(b'shared')
+        copy = pickle.loads(pickle.dumps(self.seqlock))
+        self.assertIsInstance(copy, prwlock.SeqLock)
+        self.assertEqual(copy.size, self.seqlock.size)
+        self.assertEqual(copy.read_bytes(6), b'shared')
+        copy.write(b'copied')
+        self.assertEqual(self.seqlock.read_bytes(6), b'copied')
+
+    def test_child_writes(self):
+        p = mp.Process(target=write_pairs_once, args=(self.seqlock, 42))
+        p.start()
+        p.join()
+        self.assertEqual(p.exitcode, 0)
+        self.assertEqual(self.seqlock.read(PAIR), (42, 42))
+        self.assertEqual(self.seqlock.sequence, 2)
+
+
+class SeqLockFallbackTestCase(SeqLockTestCase):
+    """Runs the tests without the compiled accelerator"""
+    def setUp(self):
+        saved = (seqlock.seq_read, seqlock.seq_write_begin,
+                 seqlock.seq_write_end)
+
+        def restore():
+            (seqlock.seq_read, seqlock.seq_write_begin,
+             seqlock.seq_write_end) = saved
+        self.addCleanup(restore)
+        seqlock.seq_read = seqlock.seq_write_begin = None
+        seqlock.seq_write_end = None
+        super(SeqLockFallbackTestCase, self).setUp()
+
+
+def hold_writer(seqlock, locked, done):
+    seqlock.write_begin()
+    locked.set()
+    done.wait(5)
+    seqlock.write_end()
+
+
+def write_pairs(seqlock, stop):
+    i = 0
+    while not stop.is_set():
+        i += 1
+        seqlock.write(PAIR.pack(i, i))
+
+
+def write_pairs_once(seqlock, value):
+    seqlock.write(PAIR.pack(value, value))
@@ -0,0 +1,215 @@
+from __future__ import print_function
+
+import os
+import time
+import errno
+import socket
+import shutil
+import tempfile
+import unittest
+
+import prwlock
+from prwlock import server
+import multiprocessing as mp
+
+
+class LockServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.address = os.path.join(self.dir, 'prwlock.sock')
+        self.local = prwlock.RWLock()
+        self.server = prwlock.LockServer(self.address,
+                                         locks={'local': self.local})
+        self.server.start()
+        self.rwlock = prwlock.RemoteRWLock('test', self.address)
+        self.other = prwlock.RemoteRWLock('test', self.address)
+
+    def tearDown(self):
+        del self.rwlock, self.other
+        server.client(self.address).close()
+        self.server.close()
+        shutil.rmtree(self.dir)
+
+    def test_read_write_release(self):
+        self.assertTrue(self.rwlock.acquire_write())
+        self.assertFalse(self.other.try_acquire_read())
+        self.assertFalse(self.other.try_acquire_write())
+        self.rwlock.release()
+        self.assertTrue(self.other.try_acquire_read())
+        self.assertTrue(self.rwlock.acquire_read())
+        self.assertFalse(self.rwlock.try_acquire_write())
+        self.rwlock.release()
+        self.other.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_double_release(self):
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_deadlock(self):
+        self.rwlock.acquire_write()
+        with self.assertRaises(OSError) as cm:
+            self.rwlock.acquire_write()
+        self.assertEqual(cm.exception.errno, errno.EDEADLK)
+        self.rwlock.release()
+
+    def test_timeout(self):
+        self.rwlock.acquire_write()
+        start = time.time()
+        self.assertFalse(self.other.acquire_read(timeout=.1))
+        self.assertGreaterEqual(time.time() - start, .09)
+        self.rwlock.release()
+        self.assertTrue(self.other.acquire_read(timeout=1))
+        self.other.release()
+
+    def test_context_managers(self):
+        with self.rwlock.writer_lock():
+            self.assertFalse(self.other.try_acquire_read())
+        with self.rwlock.reader_lock():
+            self.assertTrue(self.other.try_acquire_read())
+            self.other.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_connection_pool(self):
+        client = server.client(self.address)
+        self.rwlock.acquire_read()
+        connection = self.rwlock._connection
+        self.rwlock.release()
+        self.assertEqual(client._idle, [connection])
+        self.rwlock.acquire_write()
+        self.assertIs(self.rwlock._connection, connection)
+        self.rwlock.release()
+
+    def test_batched_release(self):
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read()
+        self.rwlock.release()
+        # Still held, so the release waits for the next request
+        connection = self.rwlock._connection
+        self.assertEqual(len(connection.queued), 1)
+        self.rwlock.release()
+        self.assertEqual(connection.queued, [])
+        self.assertTrue(self.other.try_acquire_write())
+        self.other.release()
+
+    def test_pipelining(self):
+        # Several requests in a single write get all their replies
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.address)
+        try:
+            name = b'pipelined'
+            sock.sendall(server.REQUEST.pack(server.OP_OPEN, len(name), 0) +
+                         name)
+            data = sock.recv(server.REPLY.size)
+            status, lock_id = server.REPLY.unpack(data)
+            self.assertEqual(status, server.GRANTED)
+            sock.sendall(
+                server.REQUEST.pack(server.OP_READ, lock_id, 0) +
+                server.REQUEST.pack(server.OP_WRITE, lock_id, 0) +
+                server.REQUEST.pack(server.OP_RELEASE, lock_id, 0) +
+                server.REQUEST.pack(server.OP_RELEASE, lock_id, 0))
+            data = b''
+            while len(data) < 4 * server.REPLY.size:
+                data += sock.recv(4 * server.REPLY.size - len(data))
+            replies = [server.REPLY.unpack_from(data, offset)[0]
+                       for offset in range(0, len(data), server.REPLY.size)]
+            self.assertEqual(replies, [server.GRANTED, server.DENIED,
+                                       server.GRANTED, server.FAILED])
+        finally:
+            sock.close()
+
+    def test_acquire_all(self):
+        client = server.client(self.address)
+        first = client.lock('first')
+        second = client.lock('second')
+        acquired = client.acquire_all([(second, 'read'), (first, 'write')])
+        self.assertTrue(acquired)
+        self.assertIs(first._connection, second._connection)
+        self.assertFalse(client.lock('first').try_acquire_read())
+        self.assertTrue(client.lock('second').try_acquire_read())
+        acquired.release()
+        self.assertTrue(client.lock('first').try_acquire_write())
+
+    def test_acquire_all_timeout(self):
+        client = server.client(self.address)
+        self.other.acquire_write()
+        first = client.lock('first')
+        start = time.time()
+        acquired = client.acquire_all([(first, 'write'),
+                                       (self.rwlock, 'read')], timeout=.1)
+        self.assertFalse(acquired)
+        self.assertLess(time.time() - start, 1)
+        self.assertEqual(first.nlocks, 0)
+        self.assertTrue(client.lock('first').try_acquire_write())
+        self.other.release()
+
+    def test_server_locks(self):
+        remote = prwlock.RemoteRWLock('local', self.address)
+        self.local.acquire_write()
+        self.assertFalse(remote.try_acquire_read())
+        self.local.release()
+        self.assertTrue(remote.try_acquire_write())
+        self.assertFalse(self.local.try_acquire_read())
+        remote.release()
+
+    def test_no_create(self):
+        address = os.path.join(self.dir, 'fixed.sock')
+        fixed = prwlock.LockServer(address, locks={'local': self.local},
+                                   create=False)
+        fixed.start()
+        try:
+            with self.assertRaises(OSError) as cm:
+                prwlock.RemoteRWLock('missing', address).acquire_read()
+            self.assertEqual(cm.exception.errno, errno.ENOENT)
+        finally:
+            server.client(address).close()
+            fixed.close()
+
+    def test_child_process(self):
+        self.rwlock.acquire_write()
+        q = mp.Queue()
+        p = mp.Process(target=try_acquire_read, args=(self.rwlock, q))
+        p.start()
+        self.assertFalse(q.get(timeout=5))
+        p.join()
+        self.rwlock.release()
+
+    def test_dead_client(self):
+        locked = mp.Event()
+        p = mp.Process(target=die_holding, args=(self.rwlock, locked))
+        p.start()
+        self.assertTrue(locked.wait(5))
+        p.join()
+        # The server released the lock along with the connection
+        self.assertTrue(self.other.acquire_write(timeout=5))
+        self.other.release()
+
+    def test_tcp(self):
+        tcp = prwlock.LockServer(('127.0.0.1', 0))
+        tcp.start()
+        try:
+            rwlock = prwlock.RemoteRWLock('tcp', tcp.address)
+            other = prwlock.RemoteRWLock('tcp', tcp.address)
+            rwlock.acquire_write()
+            self.assertFalse(other.try_acquire_read())
+            rwlock.release()
+            self.assertTrue(other.try_acquire_read())
+            other.release()
+        finally:
+            server.client(tcp.address).close()
+            tcp.close()
+
+
+def try_acquire_read(rwlock, queue):
+    queue.put(rwlock.try_acquire_read())
+
+
+def die_holding(rwlock, locked):
+    rwlock.acquire_write()
+    locked.set()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    unittest.main()
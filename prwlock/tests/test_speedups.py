@@ -0,0 +1,85 @@
+from __future__ import print_function
+
+import pickle
+import unittest
+
+import prwlock
+from prwlock import prwlock as _prwlock
+
+
+@unittest.skipIf(_prwlock.RWLockCore is None, 'accelerator not built')
+class RWLockCoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.rwlock = prwlock.RWLock()
+
+    def test_bound(self):
+        self.assertIsNotNone(self.rwlock._core)
+        self.assertIs(self.rwlock._core.owner, self.rwlock._lock)
+
+    def test_nlocks(self):
+        self.rwlock.acquire_read()
+        self.rwlock.acquire_read()
+        self.assertEqual(self.rwlock.nlocks, 2)
+        self.rwlock.release()
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+        with self.assertRaises(ValueError):
+            self.rwlock.release()
+
+    def test_deadlock_error(self):
+        self.rwlock.acquire_write()
+        with self.assertRaises(OSError) as context:
+            self.rwlock.acquire_write()
+        self.assertIn('pthread_rwlock_wrlock failed', str(context.exception))
+        self.rwlock.release()
+
+    def test_buffer_too_small(self):
+        with self.assertRaises(ValueError):
+            _prwlock.RWLockCore(bytearray(1))
+
+    def test_shared_layout(self):
+        # Both paths operate on the same memory, so they must see each other
+        core = self.rwlock._core
+        self.rwlock._unbind_core()
+        self.assertIsNone(self.rwlock._core)
+        self.assertTrue(self.rwlock.try_acquire_write())
+        self.assertFalse(core.try_acquire_read())
+        self.rwlock.release()
+        self.assertTrue(core.try_acquire_read())
+        self.assertFalse(self.rwlock.try_acquire_write())
+        core.release()
+
+    def test_unbind_keeps_count(self):
+        self.rwlock.acquire_read()
+        self.rwlock._unbind_core()
+        self.assertEqual(self.rwlock.nlocks, 1)
+        self.rwlock.release()
+        self.assertEqual(self.rwlock.nlocks, 0)
+
+    def test_deserialization(self):
+        t = pickle.loads(pickle.dumps(self.rwlock))
+        self.assertIsNotNone(t._core)
+
+    def test_compiled_context_managers(self):
+        reader = self.rwlock.reader_lock()
+        self.assertIsInstance(reader, _prwlock.RWLockContext)
+        with reader:
+            self.assertEqual(self.rwlock.nlocks, 1)
+        with self.rwlock.writer_lock():
+            self.assertFalse(self.rwlock._core.try_acquire_read())
+        self.assertEqual(self.rwlock.nlocks, 0)
+        # Wrapped methods need the Python context managers
+        reentrant = prwlock.RWLock(reentrant=True)
+        self.assertNotIsInstance(reentrant.reader_lock(),
+                                 _prwlock.RWLockContext)
+        # Cores still in use by a context aren't detached from the memory
+        core = self.rwlock._core
+        self.assertFalse(self.rwlock._unbind_core(detach=True))
+        self.assertIsNotNone(core.owner)
+        with reader:
+            pass
+        core.unbind()
+        with self.assertRaises(ValueError):
+            with reader:
+                pass
+        self.assertIsNone(core.owner)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Handing locks to the workers of a process pool.
+
+Passing a lock as an argument of every task pickles it with each task, and
+attaches to it again in the worker every time. Installing locks with the
+initializer of the pool does that once per worker instead, after which
+tasks look them up by name:
+
+    pool = Pool(initializer=install_locks, initargs=({'cache': rwlock},))
+
+    def task(key):
+        with installed_lock('cache').reader_lock():
+            ...
+"""
+
+_installed = {}     # Locks installed in this process, by name
+
+
+def install_locks(locks, initializer=None, initargs=()):
+    """Makes the locks of the mapping *locks* available to installed_lock()
+    under their keys. Meant to be the *initializer* of a process pool, in
+    which case *initializer* is called with *initargs* afterwards, if
+    given, for pools that need an initializer of their own."""
+    _installed.update(locks)
+    if initializer is not None:
+        initializer(*initargs)
+
+
+def installed_lock(name):
+    """Returns the lock install_locks() installed as *name*"""
+    try:
+        return _installed[name]
+    except KeyError:
+        raise KeyError('No lock installed as {!r}'.format(name))
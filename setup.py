@@ -6,7 +6,7 @@ https://github.com/pypa/sampleproject
 """
 
 # Always prefer setuptools over distutils
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 # To use a consistent encoding
 from codecs import open
 from os import path
@@ -22,8 +22,15 @@ with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
 
 if platform.system() == 'Windows':
     test_module = 'prwlock.tests.test_wrwlock'
+    ext_modules = []
 else:
-    test_module = 'prwlock.tests.test_prwlock'
+    test_module = 'prwlock.tests.suite'
+    # The accelerator is optional: when it can't be built, prwlock falls
+    # back to calling pthreads through ctypes
+    ext_modules = [
+        Extension('prwlock._speedups', ['prwlock/_speedups.c'],
+                  libraries=['pthread'], optional=True),
+    ]
 
 setup(
     name='prwlock',
@@ -54,5 +61,6 @@ setup(
     ],
     keywords='rwlock posix process-shared process',
     packages=find_packages(),
+    ext_modules=ext_modules,
     test_suite=test_module,
 )